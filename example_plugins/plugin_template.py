@@ -27,6 +27,10 @@ def command1_handler(cmd_word, args, message, proc, config, twitch_monitor):
     Handler function for 'command1', called whenever someone sends '@BotName !command1'
     in discord
 
+    Handler functions may also be coroutine functions ("async def"), in which case
+    they will be run on the bot's main event loop. This is useful for commands that
+    need to do I/O (e.g. HTTP requests, or reading discord message history).
+
     :param str cmd_word: Command word used to invoke the command, will always be 'command1' in this case.
 
     :param str args: The remaining text of the command string after the command word. For example, \
@@ -68,6 +72,13 @@ class PluginTemplate(PluginModule):
     !command1 (see !help command1)
     """
 
+    # Gateway intents and member cache flags needed by this plugin, if any (see
+    # discord.Intents and discord.MemberCacheFlags). The bot only asks discord for
+    # the intents needed by enabled plugins.
+    plugin_intents = []
+    plugin_member_cache_flags = []
+    plugin_needs_all_members = False
+
     def startup(self):
         """
         Called once on bot startup, after config file is loaded
@@ -14,6 +14,7 @@ from nedry.discord_bot import DiscordBot
 from nedry.twitch_monitor import TwitchMonitor
 from nedry.config import BotConfigManager
 from nedry.plugin import PluginModuleManager
+from nedry.event_capture import EventRecorder
 
 # Import built-in plugin modules
 from nedry.builtin_plugins import builtin_plugin_modules
@@ -39,6 +40,8 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('config_file', default=None, nargs='?',
             help="Path to bot config file (default=%(default)s)")
+    parser.add_argument('--capture', default=None, dest='capture_file',
+            help="Record all events to this file, for replaying later with 'python -m nedry.replay'")
 
     args = parser.parse_args()
     config = None
@@ -64,17 +67,40 @@ def main():
         logger.info("migrated config file from version %s to version %s" % (result.old_version, result.version_reached))
         config.save_to_file()
 
-    random.seed(time.time())
-
     # Make sure stream start messages are valid
     for m in config.config.stream_start_messages:
         if not utils.validate_format_tokens(m):
             logger.error("%s: unrecognized format token in config file stream start messages" % config.filename)
             return
 
+    run_bot(config, args.capture_file)
+
+def run_bot(config, capture_file=None, shard_ids=None, shard_count=None, primary=True):
+    """
+    Set up plugins and run the bot until it is stopped
+
+    :param config: BotConfigManager instance, with configuration already loaded
+    :param str capture_file: If set, record all events to this file
+    :param list shard_ids: IDs of the gateway shards to connect (see nedry.launcher).\
+        If None, a single shard is connected.
+    :param int shard_count: Total number of shards, across all worker processes
+    :param bool primary: False if this is a worker process that does not handle the\
+        main guild. Such workers do not wait for the main guild to send the startup\
+        message or to start monitoring twitch streams.
+    """
+    random.seed(time.time())
+
+    # Write configuration changes to the config file in the background
+    config.start()
+
     monitor = TwitchMonitor(config)
 
-    bot = DiscordBot(config, monitor)
+    bot = DiscordBot(config, monitor, shard_ids=shard_ids, shard_count=shard_count)
+
+    recorder = None
+    if capture_file is not None:
+        recorder = EventRecorder(capture_file)
+        recorder.start()
 
     plugin_manager = PluginModuleManager(bot, config.config.plugin_directories)
 
@@ -91,8 +117,9 @@ def main():
     bot.plugin_manager = plugin_manager
 
 
-    connect_thread = threading.Thread(target=wait_for_guild_avail, args=(config, bot))
-    connect_thread.start()
+    if primary:
+        connect_thread = threading.Thread(target=wait_for_guild_avail, args=(config, bot))
+        connect_thread.start()
 
     # KeyboardInterrupt will not be bubbled up, instead it will just
     # cause this function to return silently
@@ -100,6 +127,8 @@ def main():
 
     logger.info("Stopping")
     bot.stop()                         # Shut down discord client
+    if recorder is not None:
+        recorder.stop()                # Close event capture file
     plugin_manager.stop()              # Disable all plugins
     plugin_manager.shutdown_plugins()  # Shut down all plugins
     config.stop()                      # Shut down config file manager
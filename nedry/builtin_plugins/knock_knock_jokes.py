@@ -1,6 +1,7 @@
 import random
 from difflib import SequenceMatcher
 import logging
+import threading
 
 from nedry.event_types import EventType
 from nedry import events
@@ -44,14 +45,14 @@ class JokeState(object):
     LISTENING_2 = 4   # response to 'whos there' seen, and we have sent 'xx who?'
 
 
-def joke_exists(joke, config):
+def joke_exists(joke, jokes):
     """
     Check if a joke that we heard is *similar* (but not exactly the same, a-la difflib)
     to one that we already know. WOuld be a shame to have 3 copies of the same joke
     because somebody mispelled a word.
     """
     joke_concat = ' '.join(joke)
-    available_jokes = BUILTIN_JOKES + config.config.jokes
+    available_jokes = BUILTIN_JOKES + jokes
 
     for j in available_jokes:
         j_concat = ' '.join(j)
@@ -69,10 +70,12 @@ class KnockKnockJoke(object):
     command) and listening to jokes (triggered by '@BotName knock knock').
 
     Either one of those triggers creates a new KnockKnockJoke object for the channel it was triggered on.
+    Jokes are remembered separately for each guild, in the guild's configuration.
     """
-    def __init__(self, config, telling, author):
+    def __init__(self, config, guild_config, telling, author):
         self.complete = False
         self.config = config
+        self.guild_config = guild_config
         self.author = author
         self.state = JokeState.TELLING_1 if telling else JokeState.LISTENING_1
         self.is_joke_teller = author.id in config.config.discord_joke_tellers
@@ -80,7 +83,7 @@ class KnockKnockJoke(object):
         self.joke_in_progress = []
 
         if telling:
-            available_jokes = BUILTIN_JOKES + config.config.jokes
+            available_jokes = BUILTIN_JOKES + guild_config.jokes
             chosen_joke = random.choice(available_jokes)
             self.joke_in_progress = [chosen_joke[0], chosen_joke[1]]
 
@@ -89,35 +92,33 @@ class KnockKnockJoke(object):
         Handle a bot mention on a channel with a knock-knock joke in progress
 
 
-        :param str text: message text with the bot mention stripped out
+        :param ParsedMessage text: message text with the bot mention stripped out
         """
         ret = None
 
         if self.state == JokeState.TELLING_1:
             strings = ["who there", "who's there", "whos there", "who is there"]
-            cleaned_text = ' '.join(text.strip().lower().split())
             for s in strings:
-                if cleaned_text.startswith(s):
+                if text.normalized.startswith(s):
                     # next response seen
                     ret = "%s %s " % (self.author.mention, self.joke_in_progress[0])
                     self.state = JokeState.TELLING_2
 
         elif self.state == JokeState.TELLING_2:
-            cleaned_text = ' '.join(text.strip().lower().split())
-            if cleaned_text.startswith('%s who' % self.joke_in_progress[0].lower()):
+            if text.normalized.startswith('%s who' % self.joke_in_progress[0].lower()):
                 # Next response seen, finished telling the joke
                 ret = "%s %s" % (self.author.mention, self.joke_in_progress[1])
                 self.complete = True
 
         elif self.state == JokeState.LISTENING_1:
             # Just send back the response "XX who?"
-            resp_1 = text.strip()
+            resp_1 = str(text)
             self.joke_in_progress.append(resp_1)
             self.state = JokeState.LISTENING_2
             return "%s %s who?" % (self.author.mention, resp_1)
 
         elif self.state == JokeState.LISTENING_2:
-            resp_2 = text.strip()
+            resp_2 = str(text)
             self.joke_in_progress.append(resp_2)
 
             responses = ['what a great joke!', 'great joke!', 'good joke!',
@@ -127,11 +128,13 @@ class KnockKnockJoke(object):
             if self.is_joke_teller:
                 # If the user is a joke teller, we should remember this joke.
                 # First, check if we already have the same joke.
-                if joke_exists(self.joke_in_progress, self.config):
+                if joke_exists(self.joke_in_progress, self.guild_config.jokes):
                     ret += " I think I already know that one though."
                 else:
                     ret += " I'll remember that one :)"
-                    self.config.config.jokes.append([self.joke_in_progress[0], self.joke_in_progress[1]])
+                    with self.config.lock:
+                        self.guild_config.jokes.append([self.joke_in_progress[0], self.joke_in_progress[1]])
+
                     self.config.save_to_file()
 
             self.complete = True
@@ -155,18 +158,12 @@ Example:
 @BotName !joke
 """
 
-# Tracks in-progress knock knock jokes by channel ID
+# Tracks in-progress knock knock jokes by channel ID. Written by the !joke command
+# handler (on a command worker thread) and by mention handlers (on the event loop).
+channel_data_lock = threading.Lock()
 channel_data = {}
 
 
-def joke_command_handler(cmd_word, args, message, proc, config, twitch_monitor):
-    """
-    Handler for !joke command
-    """
-    channel_data[message.channel.id] = KnockKnockJoke(config, True, message.author)
-    return "%s knock knock!" % message.author.mention
-
-
 class KnockKnockJokes(PluginModule):
     """
     Plugin for interactive knock-knock jokes. Adds a new "!joke" command, which
@@ -197,41 +194,79 @@ class KnockKnockJokes(PluginModule):
     !joke (see !help joke)
     """
 
-    def _on_mention(self, message, text_without_mention):
-        ret = None
-        joke_in_progress = None
-        chanid = message.channel.id
+    def __init__(self, *args, **kwargs):
+        super(KnockKnockJokes, self).__init__(*args, **kwargs)
+        self._last_joke_message_id = None
+
+    def _joke_command_handler(self, cmd_word, args, message, proc, config, twitch_monitor):
+        """
+        Handler for !joke command
+        """
+        joke = KnockKnockJoke(config, proc.bot.guild_config(message.guild_id), True, message.author)
+        with channel_data_lock:
+            channel_data[message.channel.id] = joke
+            self._update_joke_subscription()
 
-        # Figure out the current knock-knock-joke state on the message channel
-        if chanid in channel_data:
-            joke_in_progress = channel_data[chanid]
+        return "%s knock knock!" % message.author.mention
 
-        if joke_in_progress is not None:
+    def _update_joke_subscription(self):
+        # Only channels with a joke in progress need to see every mention.
+        # Must be called with channel_data_lock held.
+        events.subscribe(EventType.DISCORD_BOT_MENTION, self._on_joke_mention,
+                         channel_ids=channel_data.keys())
+
+    def _on_joke_mention(self, message, text_without_mention):
+        # Mention on a channel with a knock-knock joke in progress
+        chanid = message.channel.id
+        with channel_data_lock:
+            joke_in_progress = channel_data.get(chanid, None)
+            if joke_in_progress is None:
+                return
+
+            self._last_joke_message_id = message.id
             ret = joke_in_progress.parse(text_without_mention)
             if joke_in_progress.complete:
-                channel_data[chanid] = None
-        else:
-            cleaned = ''.join(text_without_mention.split()).lower()
-            if cleaned.startswith('knockknock'):
-                # Someone is telling us a joke
-                new_joke = KnockKnockJoke(self.discord_bot.config, False, message.author)
-                channel_data[chanid] = new_joke
-                ret = "%s who's there?" % message.author.mention
+                del channel_data[chanid]
+                self._update_joke_subscription()
 
         if ret is not None:
             self.discord_bot.send_message(message.channel, ret)
 
+    def _on_knock_knock(self, message, text_without_mention):
+        # Mention starting with 'knock', on any channel
+        if not text_without_mention.normalized.startswith(('knock knock', 'knockknock')):
+            return
+
+        chanid = message.channel.id
+        guild_config = self.discord_bot.guild_config(self.discord_bot.guild_id_for_channel(message.channel))
+
+        with channel_data_lock:
+            if (chanid in channel_data) or (message.id == self._last_joke_message_id):
+                # Message is part of a joke already in progress on this channel
+                return
+
+            # Someone is telling us a joke
+            channel_data[chanid] = KnockKnockJoke(self.discord_bot.config, guild_config, False, message.author)
+            self._update_joke_subscription()
+
+        self.discord_bot.send_message(message.channel, "%s who's there?" % message.author.mention)
+
     def open(self):
         """
         Enables plugin operation; subscribe to events and/or initialize things here
         """
-        events.subscribe(EventType.DISCORD_BOT_MENTION, self._on_mention)
-        self.discord_bot.add_command("joke", joke_command_handler, False, HELPTEXT)
+        with channel_data_lock:
+            self._update_joke_subscription()
+
+        events.subscribe(EventType.DISCORD_BOT_MENTION, self._on_knock_knock, text_prefix="knock")
+        self.discord_bot.add_command("joke", self._joke_command_handler, False, HELPTEXT)
 
     def close(self):
         """
         Disables plugin operation; unsubscribe from events and/or tear down things here
         """
-        events.unsubscribe(EventType.DISCORD_BOT_MENTION, self._on_mention)
+        events.unsubscribe(EventType.DISCORD_BOT_MENTION, self._on_joke_mention)
+        events.unsubscribe(EventType.DISCORD_BOT_MENTION, self._on_knock_knock)
         self.discord_bot.remove_command("joke")
-        channel_data.clear()
+        with channel_data_lock:
+            channel_data.clear()
@@ -1,5 +1,4 @@
 import logging
-import asyncio
 import random
 
 from nedry import utils
@@ -8,8 +7,6 @@ from nedry.plugin import PluginModule
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-main_event_loop = asyncio.get_event_loop()
-
 
 APOLOGIES = [
     "I am deeply sorry for any inconvenience caused.",
@@ -88,14 +85,22 @@ Example:
 
 
 async def _mock_last_message(bot, channel, user_id):
+    def _not_a_command(message):
+        return not message.content.strip().startswith(bot.mention())
+
+    message = bot.message_cache.last_message_by(channel.id, user_id, _not_a_command)
+    if message is not None:
+        return utils.mockify_text(message.content)
+
+    # Message may be older than the cache, ask discord
     async for message in channel.history(limit=100):
-        content = message.content.strip()
-        if (message.author.id == user_id) and not content.startswith(bot.mention()):
-            bot.send_message(channel, utils.mockify_text(message.content))
-            break
+        if (message.author.id == user_id) and _not_a_command(message):
+            return utils.mockify_text(message.content)
+
+    return None
 
 
-def mock_command_handler(cmd_word, args, message, proc, config, twitch_monitor):
+async def mock_command_handler(cmd_word, args, message, proc, config, twitch_monitor):
     args = args.lower().split()
     if len(args) == 0:
         return proc.usage_msg("Please mention the user you want to mock.", cmd_word)
@@ -104,7 +109,7 @@ def mock_command_handler(cmd_word, args, message, proc, config, twitch_monitor):
     if user_id is None:
         return "Please mention the user you wish to mock (e.g. '!mock @eknyquist)"
 
-    asyncio.run_coroutine_threadsafe(_mock_last_message(proc.bot, message.channel, user_id), main_event_loop)
+    return await _mock_last_message(proc.bot, message.channel, user_id)
 
 
 def apologize_command_handler(cmd_word, args, message, proc, config, twitch_monitor):
@@ -1,4 +1,6 @@
 from nedry.plugin import PluginModule
+from nedry.event_types import EventType
+from nedry import events
 
 from pytimeparse.timeparse import timeparse
 
@@ -83,6 +85,15 @@ class Scheduler(object):
         self._stop_event = threading.Event()
         self._lock = threading.Lock()
 
+        # IDs of guilds whose saved events have been loaded. Events are saved in the
+        # configuration of the guild they belong to, so that each guild's events are
+        # only ever written by the bot process that handles that guild.
+        self._loaded_guilds = set()
+
+        # Commands run on multiple worker threads, so adding/removing events (which
+        # stops and restarts the thread) must not interleave. Never held by the thread.
+        self._update_lock = threading.Lock()
+
     def has_active_events(self):
         with self._lock:
             event_count = len(self._active_events)
@@ -95,13 +106,19 @@ class Scheduler(object):
             self._thread.join()
             self._thread = None
 
+            # Thread may have exited on its own without seeing the stop event
+            self._stop_event.clear()
+
     def start(self):
         if self._thread is None:
             # Remove all expired events
             utcnow = _utc_time()
-            while self._active_events[0].expiry_time <= utcnow:
+            while self._active_events and (self._active_events[0].expiry_time <= utcnow):
                 self._active_events.pop(0)
 
+            if not self._active_events:
+                return
+
             self._thread = threading.Thread(target=self._thread_task)
             self._thread.daemon = True
             self._thread.start()
@@ -139,8 +156,9 @@ class Scheduler(object):
                 elif event.event_type == ScheduledEventType.CHANNEL_MESSAGE:
                     text = event.event_data[0]
                     channel_name = event.event_data[1]
+                    guild_id = _event_guild_id(event, self._discord_bot)
 
-                    channel = self._discord_bot.get_channel_by_name(channel_name)
+                    channel = self._discord_bot.get_channel_by_name(channel_name, guild_id)
                     if not channel:
                         logger.error("unable to find channel '%s'" % channel_name)
                         continue
@@ -191,21 +209,42 @@ class Scheduler(object):
         return index == 0
 
     def save_scheduled_events(self):
-        if PLUGIN_NAME in self._discord_bot.config.config.plugin_data:
-            del self._discord_bot.config.config.plugin_data[PLUGIN_NAME]
+        bot = self._discord_bot
 
-        scheduled_events = []
+        # Guilds with no events left still need their saved events cleared
+        events_by_guild = {guild_id: [] for guild_id in self._loaded_guilds}
         for event in self._active_events:
-            scheduled_events.append(event.to_json())
+            events_by_guild.setdefault(_event_guild_id(event, bot), []).append(event.to_json())
+
+        with bot.config.lock:
+            for guild_id, scheduled_events in events_by_guild.items():
+                bot.guild_config(guild_id).plugin_data[PLUGIN_NAME] = scheduled_events
+
+        bot.config.save_to_file()
+
+    def load_scheduled_events(self, guild_id=None):
+        """
+        Load saved events for a guild, if they have not already been loaded
+
+        :param int guild_id: discord guild ID. If None, events for the main guild (and\
+            DM reminders that were set in a DM, or before guild IDs were stored) are loaded.
 
-        self._discord_bot.config.config.plugin_data[PLUGIN_NAME] = scheduled_events
-        self._discord_bot.config.save_to_file()
+        :return: number of events loaded
+        :rtype: int
+        """
+        if guild_id is None:
+            guild_id = self._discord_bot.guild_id
 
-    def load_scheduled_events(self):
+        if guild_id in self._loaded_guilds:
+            return 0
+
+        self._loaded_guilds.add(guild_id)
         events_loaded = 0
-        if PLUGIN_NAME in self._discord_bot.config.config.plugin_data:
+        plugin_data = self._discord_bot.guild_config(guild_id).plugin_data
+
+        if PLUGIN_NAME in plugin_data:
             with self._lock:
-                for event_data in self._discord_bot.config.config.plugin_data[PLUGIN_NAME]:
+                for event_data in plugin_data[PLUGIN_NAME]:
                     event = ScheduledEvent.from_json(event_data)
 
                     if _utc_time() >= event.expiry_time:
@@ -217,40 +256,53 @@ class Scheduler(object):
 
         return events_loaded
 
+    def load_guild_events(self, guild_id):
+        """
+        Load saved events for a guild that has just become available, and make sure
+        the thread is running if any events were loaded
+
+        :param int guild_id: discord guild ID
+        """
+        with self._update_lock:
+            self.stop()
+            self.load_scheduled_events(guild_id)
+            self.start()
+
     def add_event(self, mins_from_now, event_type, *event_data):
         expiry_time_secs = int(_utc_time() + (mins_from_now * 60))
         event = ScheduledEvent(mins_from_now * 60, expiry_time_secs, event_type, *event_data)
 
-        with self._lock:
-            if self._active_events:
-                # Other events are active, stop the thread before modifying the list
-                self.stop()
+        with self._update_lock:
+            # Stop the thread before modifying the list. The thread needs self._lock,
+            # so it must not be held while waiting for the thread to stop.
+            self.stop()
 
-            self._add_active_event(event)
+            with self._lock:
+                self._add_active_event(event)
 
-            # Save state of scheduled event queue
-            self.save_scheduled_events()
+                # Save state of scheduled event queue
+                self.save_scheduled_events()
 
-        # (Re)Start thread
-        self.start()
+            # (Re)Start thread
+            self.start()
 
         return event
 
     def remove_events(self, events):
-        with self._lock:
-            for e in events:
-                if e not in self._active_events:
-                    raise ValueError()
+        with self._update_lock:
+            with self._lock:
+                for e in events:
+                    if e not in self._active_events:
+                        raise ValueError()
 
-            if self._active_events:
-                # Other events are active, stop the thread before modifying the list
-                self.stop()
+            self.stop()
 
-            for e in events:
-                self._active_events.remove(e)
+            with self._lock:
+                for e in events:
+                    self._active_events.remove(e)
 
-        # (Re)Start thread
-        self.start()
+            # (Re)Start thread
+            self.start()
 
     def get_events_of_type(self, event_type):
         with self._lock:
@@ -284,12 +336,28 @@ def _dump_reminders(user):
 
     return ret
 
-def _dump_scheduled(user):
+def _event_guild_id(event, bot):
+    # Scheduled events store the ID of the guild they were created in after the time
+    # description, so they are only handled by the bot process that handles that guild.
+    # Events created before guild IDs were stored belong to the main guild.
+    if len(event.event_data) > 3:
+        return event.event_data[3]
+
+    return bot.guild_id
+
+def _guild_channel_events(bot, guild_id):
     """
-    Get description of all scheduled messages
+    Get all scheduled channel messages for a single guild
+    """
+    return [e for e in scheduler.get_events_of_type(ScheduledEventType.CHANNEL_MESSAGE)
+            if _event_guild_id(e, bot) == guild_id]
+
+def _dump_scheduled(user, bot, guild_id):
+    """
+    Get description of all scheduled messages for a single guild
     """
     events = []
-    for e in scheduler.get_events_of_type(ScheduledEventType.CHANNEL_MESSAGE):
+    for e in _guild_channel_events(bot, guild_id):
         events.append("```\n%d. !schedule %s %s in %s (%s until scheduled message)```" %
                       (len(events) + 1, e.event_data[1], e.event_data[0], e.event_data[2],
                        e.time_remaining_string()))
@@ -508,7 +576,8 @@ def remind_command_handler(cmd_word, args, message, proc, config, twitch_monitor
                                 ScheduledEventType.DM_MESSAGE,
                                 msg,
                                 message.author.id,
-                                timedesc)
+                                timedesc,
+                                message.guild_id)
 
     # Save event for this user ID, for the "unremind last" command
     lastreminder_by_user[message.author.id] = event
@@ -527,7 +596,7 @@ def schedule_command_handler(cmd_word, args, message, proc, config, twitch_monit
                               "```!schedule channel-name Hey Guys, 10 mins have elapsed! in 10 minutes```",
                               cmd_word)
     if not args.strip():
-        return _dump_scheduled(message.author)
+        return _dump_scheduled(message.author, proc.bot, message.guild_id)
 
     fields = args.lower().split(maxsplit=1)
     if len(fields) != 2:
@@ -554,7 +623,7 @@ def schedule_command_handler(cmd_word, args, message, proc, config, twitch_monit
         return "Sorry, '%s' is too short, must be at least 1 minute in the future" % timedesc
 
 
-    channel = proc.bot.get_channel_by_name(channel_name)
+    channel = proc.bot.get_channel_by_name(channel_name, message.guild_id)
     if not channel:
         return "Can't find a discord channel called '%s', are you sure that's right?" % channel_name
 
@@ -562,7 +631,8 @@ def schedule_command_handler(cmd_word, args, message, proc, config, twitch_monit
                                 ScheduledEventType.CHANNEL_MESSAGE,
                                 msg,
                                 channel_name,
-                                timedesc)
+                                timedesc,
+                                message.guild_id)
 
     # Save event for this user ID, for the "unschedule last" command
     lastsched_by_user[message.author.id] = event
@@ -646,7 +716,7 @@ def unschedule_command_handler(cmd_word, args, message, proc, config, twitch_mon
         return proc.usage_msg("Please provide some arguments.", cmd_word)
 
     if args[0].lower() == "all":
-        events_to_remove = scheduler.get_events_of_type(ScheduledEventType.CHANNEL_MESSAGE)
+        events_to_remove = _guild_channel_events(proc.bot, message.guild_id)
         scheduler.remove_events(events_to_remove)
         return "%s OK! removed all scheduled messages" % message.author.mention
 
@@ -665,9 +735,7 @@ def unschedule_command_handler(cmd_word, args, message, proc, config, twitch_mon
         return ("OK! removed this scheduled message:\n```!schedule %s %s in %s```" %
                 (removed.event_data[1], removed.event_data[0], removed.event_data[2]))
 
-    all_events = []
-    for e in scheduler.get_events_of_type(ScheduledEventType.CHANNEL_MESSAGE):
-        all_events.append(e)
+    all_events = _guild_channel_events(proc.bot, message.guild_id)
 
     if not all_events:
         return "%s No scheduled messages to remove" % message.author.mention
@@ -725,6 +793,9 @@ class Schedule(PluginModule):
     !unschedule (see !help unschedule)
     """
 
+    # Reminder recipients are looked up by user ID when reminders expire
+    plugin_needs_all_members = True
+
     def __init__(self, *args, **kwargs):
         super(Schedule, self).__init__(*args, **kwargs)
         self.open_count = 0
@@ -739,8 +810,9 @@ class Schedule(PluginModule):
         self.discord_bot.add_command("unremind", unremind_command_handler, False, UNREMIND_HELPTEXT)
         scheduler.set_discord_bot(self.discord_bot)
 
-        if self.open_count == 0:
-            # Only want to do this on first open
+        if (self.open_count == 0) and self.discord_bot.handles_guild():
+            # Only want to do this on first open, and only in the bot process that
+            # handles the main guild (other processes would send the same DM reminders)
             scheduler.load_scheduled_events()
 
         self.open_count += 1
@@ -748,6 +820,26 @@ class Schedule(PluginModule):
         if scheduler.has_active_events():
             scheduler.start()
 
+        # Events for other guilds are loaded when each guild becomes available
+        events.subscribe(EventType.DISCORD_GUILD_AVAILABLE, self._on_guild_available)
+        for guild_id, state in list(self.discord_bot.guild_states.items()):
+            if state.is_available():
+                self._load_guild_events(guild_id)
+
+    def _on_guild_available(self, guild):
+        self._load_guild_events(guild.id)
+
+    def _load_guild_events(self, guild_id):
+        # Loading events restarts the scheduler thread, which means waiting for it to
+        # stop, so it must not be done on the event loop
+        executor = self.discord_bot.command_executor
+        if executor.is_running() and executor.submit(PLUGIN_NAME, scheduler.load_guild_events, guild_id):
+            return
+
+        thread = threading.Thread(target=scheduler.load_guild_events, args=(guild_id,))
+        thread.daemon = True
+        thread.start()
+
     def close(self):
         """
         Disables plugin operation; unsubscribe from events and/or tear down things here
@@ -756,5 +848,6 @@ class Schedule(PluginModule):
         self.discord_bot.remove_command("remindme")
         self.discord_bot.remove_command("unremind")
         self.discord_bot.remove_command("unschedule")
+        events.unsubscribe(EventType.DISCORD_GUILD_AVAILABLE, self._on_guild_available)
         scheduler.stop()
         scheduler.set_discord_bot(None)
@@ -40,10 +40,6 @@ TIME_FACTOR_MAX_SECONDS = 3600 * 24 * 7    # 7 days
 INACTIVITY_RESET_SECONDS = 3600 * 24 * 28  # 28 days
 
 
-# Stores all discord user data at runtime, in a dict keyed by user ID
-discord_users_by_id = {}
-
-
 class DiscordUser(VersionedObject):
     # Discord user ID
     user_id = None
@@ -64,36 +60,23 @@ class SocialCreditConfig(VersionedObject):
     discord_users = ListField(DiscordUser)
 
 
-def _record_user(user_id):
-    if user_id not in discord_users_by_id:
-        discord_users_by_id[user_id] = DiscordUser()
-        discord_users_by_id[user_id].user_id = user_id
+def _record_user(users, user_id):
+    if user_id not in users:
+        users[user_id] = DiscordUser()
+        users[user_id].user_id = user_id
 
-def _record_message(message):
-    inactivity_secs = time.time() - discord_users_by_id[message.author.id].last_msg_time
+def _record_message(users, message):
+    inactivity_secs = time.time() - users[message.author.id].last_msg_time
     if inactivity_secs >= INACTIVITY_RESET_SECONDS:
         # If discord user has been inactive for a long time, reset their score
-        discord_users_by_id[message.author.id] = DiscordUser()
-        discord_users_by_id[message.author.id].user_id = message.author.id
-
-    if message.channel.id not in discord_users_by_id[message.author.id].channels_visited:
-        discord_users_by_id[message.author.id].channels_visited[message.channel.id] = 0
-
-    discord_users_by_id[message.author.id].channels_visited[message.channel.id] += 1
-    discord_users_by_id[message.author.id].last_msg_time = time.time()
-
-def _on_discord_message_received(message):
-    _record_user(message.author.id)
-    _record_message(message)
+        users[message.author.id] = DiscordUser()
+        users[message.author.id].user_id = message.author.id
 
-def _on_bot_command_received(message, text):
-    if text.startswith(COMMAND_PREFIX + "socialcredit"):
-        # Don't add points for requesting credit score
-        return
+    if message.channel.id not in users[message.author.id].channels_visited:
+        users[message.author.id].channels_visited[message.channel.id] = 0
 
-    _record_user(message.author.id)
-    _record_message(message)
-    discord_users_by_id[message.author.id].bot_commands_sent += 1
+    users[message.author.id].channels_visited[message.channel.id] += 1
+    users[message.author.id].last_msg_time = time.time()
 
 def _calculate_score(user):
     # Number of channels user has sent a message in
@@ -115,8 +98,9 @@ def _calculate_score(user):
 
     return int((total_message_count + (channel_count * 10) + user.bot_commands_sent) * time_factor)
 
-def _leaderboard(bot):
-    users = [(u, _calculate_score(u)) for u in discord_users_by_id.values()]
+def _leaderboard(bot, users):
+    # Copy user list, since it may be modified by event handlers while we iterate
+    users = [(u, _calculate_score(u)) for u in list(users.values())]
     users.sort(key=lambda x: x[1], reverse=True)
 
     leaders = []
@@ -126,21 +110,6 @@ def _leaderboard(bot):
 
     return "Social Credit Leaderboard:\n```%s```" % '\n'.join(leaders)
 
-def socialcredit_command_handler(cmd_word, args, message, proc, config, twitch_monitor):
-    if args:
-        args = args.split()
-        if args[0] == "top":
-            return _leaderboard(proc.bot)
-        else:
-            return f"{message.author.mention} unrecognized argument, see '{COMMAND_PREFIX}help {cmd_word}'"
-
-    if message.author.id not in discord_users_by_id:
-        score = 0
-    else:
-        score = _calculate_score(discord_users_by_id[message.author.id])
-
-    return f"{message.author.mention} Your score is {score:,}"
-
 
 class SocialCredit(PluginModule):
     """
@@ -165,47 +134,105 @@ class SocialCredit(PluginModule):
     !socialcredit (see !help socialcredit)
     """
 
-    def startup(self):
-        """
-        Called once on bot startup, after config file is loaded
-        """
-        if PLUGIN_NAME in self.discord_bot.config.config.plugin_data:
-            config_data = self.discord_bot.config.config.plugin_data[PLUGIN_NAME]
+    # Leaderboard looks up users by user ID
+    plugin_needs_all_members = True
+
+    def __init__(self, *args, **kwargs):
+        super(SocialCredit, self).__init__(*args, **kwargs)
+
+        # Discord user data for each guild, keyed by guild ID. Each value is a dict of
+        # DiscordUser objects keyed by user ID, loaded from the guild's configuration
+        # the first time it is needed.
+        self._users_by_guild = {}
+
+    def _guild_users(self, guild_id):
+        users = self._users_by_guild.get(guild_id, None)
+        if users is not None:
+            return users
+
+        users = {}
+        config_data = self.discord_bot.guild_config(guild_id).plugin_data.get(PLUGIN_NAME, None)
+        if config_data:
             config = SocialCreditConfig()
             Serializer(config).from_dict(config_data)
 
             # Load users into dict
             for user in config.discord_users:
-                discord_users_by_id[user.user_id] = user
+                users[user.user_id] = user
 
-            # Clear list of discord users in config object
-            self.discord_bot.config.config.plugin_data[PLUGIN_NAME] = []
+        return self._users_by_guild.setdefault(guild_id, users)
+
+    def _message_users(self, message):
+        return self._guild_users(self.discord_bot.guild_id_for_channel(message.channel))
+
+    async def _on_discord_message_received(self, message):
+        users = self._message_users(message)
+        _record_user(users, message.author.id)
+        _record_message(users, message)
+
+    async def _on_bot_command_received(self, message, text):
+        if text.command_word == "socialcredit":
+            # Don't add points for requesting credit score
+            return
+
+        users = self._message_users(message)
+        _record_user(users, message.author.id)
+        _record_message(users, message)
+        users[message.author.id].bot_commands_sent += 1
+
+    def _socialcredit_command_handler(self, cmd_word, args, message, proc, config, twitch_monitor):
+        users = self._guild_users(message.guild_id)
+
+        if args:
+            args = args.split()
+            if args[0] == "top":
+                return _leaderboard(proc.bot, users)
+            else:
+                return f"{message.author.mention} unrecognized argument, see '{COMMAND_PREFIX}help {cmd_word}'"
+
+        if message.author.id not in users:
+            score = 0
+        else:
+            score = _calculate_score(users[message.author.id])
+
+        return f"{message.author.mention} Your score is {score:,}"
+
+    def startup(self):
+        """
+        Called once on bot startup, after config file is loaded
+        """
+        # Users for other guilds are loaded when each guild is first seen
+        self._guild_users(self.discord_bot.guild_id)
 
     def shutdown(self):
         """
         Called once when bot shuts down / is killed
         """
-        config = SocialCreditConfig()
+        for guild_id, users in self._users_by_guild.items():
+            config = SocialCreditConfig()
+
+            # Populate new config object with all discord user data
+            for user_id in users:
+                config.discord_users.append(users[user_id])
 
-        # Populate new config object with all discord user data
-        for user_id in discord_users_by_id:
-            config.discord_users.append(discord_users_by_id[user_id])
+            with self.discord_bot.config.lock:
+                self.discord_bot.guild_config(guild_id).plugin_data[PLUGIN_NAME] = Serializer(config).to_dict()
 
-        self.discord_bot.config.config.plugin_data[PLUGIN_NAME] = Serializer(config).to_dict()
         self.discord_bot.config.save_to_file()
 
     def open(self):
         """
         Enables plugin operation; subscribe to events and/or initialize things here
         """
-        self.discord_bot.add_command("socialcredit", socialcredit_command_handler, False, SOCIALCREDIT_HELPTEXT)
-        events.subscribe(EventType.DISCORD_MESSAGE_RECEIVED, _on_discord_message_received)
-        events.subscribe(EventType.BOT_COMMAND_RECEIVED, _on_bot_command_received)
+        self.discord_bot.add_command("socialcredit", self._socialcredit_command_handler, False,
+                                     SOCIALCREDIT_HELPTEXT)
+        events.subscribe(EventType.DISCORD_MESSAGE_RECEIVED, self._on_discord_message_received)
+        events.subscribe(EventType.BOT_COMMAND_RECEIVED, self._on_bot_command_received)
 
     def close(self):
         """
         Disables plugin operation; unsubscribe from events and/or tear down things here
         """
         self.discord_bot.remove_command("socialcredit")
-        events.unsubscribe(EventType.DISCORD_MESSAGE_RECEIVED, _on_discord_message_received)
-        events.unsubscribe(EventType.BOT_COMMAND_RECEIVED, _on_bot_command_received)
+        events.unsubscribe(EventType.DISCORD_MESSAGE_RECEIVED, self._on_discord_message_received)
+        events.unsubscribe(EventType.BOT_COMMAND_RECEIVED, self._on_bot_command_received)
@@ -235,7 +235,9 @@ class Stories(PluginModule):
             session = stories_by_channel[chan_id]
             serialized[str(chan_id)] = session.to_json()
 
-        self.discord_bot.config.config.plugin_data[PLUGIN_NAME] = serialized
+        with self.discord_bot.config.lock:
+            self.discord_bot.config.config.plugin_data[PLUGIN_NAME] = serialized
+
         self.discord_bot.config.save_to_file()
 
     def open(self):
@@ -1,4 +1,6 @@
+import asyncio
 import requests
+import aiohttp
 import random
 import html
 import threading
@@ -12,6 +14,7 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 REQUEST_TIMEOUT_S = 5.0
+COMMAND_TIMEOUT_S = 15.0
 PLUGIN_NAME = "trivia"
 PLUGIN_VERSION = "1.0.0"
 
@@ -82,9 +85,10 @@ class TriviaSession(object):
                     f'```{correct_choice}. {self.trivia.correct_answer}```\n')
 
             score = None
+            guild_config = self.discord_bot.guild_config(self.discord_bot.guild_id_for_channel(self.channel))
             if correct_answers:
                 # First correct answer always gets 2 points
-                score = _increment_score(self.discord_bot.config, correct_answers[0].id, 2)
+                score = _increment_score(self.discord_bot.config, guild_config, correct_answers[0].id, 2)
 
             if not correct_answers:
                 resp += "Unfortunately, nobody picked that answer :("
@@ -94,7 +98,7 @@ class TriviaSession(object):
                          f"(total score: {score})")
             else:
                 for answer in correct_answers[1:]:
-                    _ = _increment_score(self.discord_bot.config, answer.id, 1)
+                    _ = _increment_score(self.discord_bot.config, guild_config, answer.id, 1)
 
                 win_mention = correct_answers[0].mention
                 mentions = utils.list_to_english([f"{x.mention}" for x in correct_answers[1:]])
@@ -102,8 +106,9 @@ class TriviaSession(object):
                 resp += (f"{mentions} also picked the right answer, so they get 1 point.")
 
             # Delete trivia session
-            if self.channel.id in trivia_by_channel:
+            if trivia_by_channel.get(self.channel.id, None) is self:
                 del trivia_by_channel[self.channel.id]
+                _update_mention_subscription()
 
             self.discord_bot.send_message(self.channel, resp)
 
@@ -117,7 +122,7 @@ def populate_categories():
             if n.lower() in d["name"].lower():
                 categories_by_id[int(d["id"])] = d["name"]
 
-def get_trivia_question():
+async def get_trivia_question():
 
     dburl = "https://opentdb.com/api.php?amount=1"
 
@@ -125,8 +130,10 @@ def get_trivia_question():
     if category_ids:
         dburl += f"&category={random.choice(category_ids)}"
 
-    resp = requests.get(url=dburl, timeout=REQUEST_TIMEOUT_S)
-    attrs = resp.json()
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_S)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with session.get(dburl) as resp:
+            attrs = await resp.json()
 
     q = attrs["results"][0]
 
@@ -180,23 +187,26 @@ MIN_TIME_SECONDS = 10
 DEFAULT_TIME_SECONDS = 60
 
 
-def _increment_score(config, user_id, num=1):
-    if PLUGIN_NAME not in config.config.plugin_data:
-        config.config.plugin_data[PLUGIN_NAME] = {}
-
+def _increment_score(config, guild_config, user_id, num=1):
+    # Scores are kept separately for each guild
     user_id = str(user_id)
 
-    score = 0
-    if user_id in config.config.plugin_data[PLUGIN_NAME]:
-        score = config.config.plugin_data[PLUGIN_NAME][user_id]
+    with config.lock:
+        if PLUGIN_NAME not in guild_config.plugin_data:
+            guild_config.plugin_data[PLUGIN_NAME] = {}
+
+        score = 0
+        if user_id in guild_config.plugin_data[PLUGIN_NAME]:
+            score = guild_config.plugin_data[PLUGIN_NAME][user_id]
+
+        new_score = score + num
+        guild_config.plugin_data[PLUGIN_NAME][user_id] = new_score
 
-    new_score = score + num
-    config.config.plugin_data[PLUGIN_NAME][user_id] = new_score
     config.save_to_file()
     return new_score
 
 
-def trivia_command_handler(cmd_word, args, message, proc, config, twitch_monitor):
+async def trivia_command_handler(cmd_word, args, message, proc, config, twitch_monitor):
     with trivia_by_channel_lock:
         if message.channel.id in trivia_by_channel:
             return (f"{message.author.mention} A trivia question is already in progress "
@@ -216,13 +226,24 @@ def trivia_command_handler(cmd_word, args, message, proc, config, twitch_monitor
     else:
         time_secs = DEFAULT_TIME_SECONDS
 
-    q = get_trivia_question()
+    try:
+        q = await get_trivia_question()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return f"{message.author.mention} Sorry, I wasn't able to fetch a trivia question right now"
+
     answers = "\n".join(["```%d. %s```" % (i + 1, q.answers[i]) for i in range(len(q.answers))])
 
     with trivia_by_channel_lock:
+        # Check again, another !trivia command may have started a session on this
+        # channel while we were waiting for the question
+        if message.channel.id in trivia_by_channel:
+            return (f"{message.author.mention} A trivia question is already in progress "
+                    f"on this channel, wait until it finishes")
+
         session = TriviaSession(q, time_secs, message.channel, proc.bot)
         session.start_thread()
         trivia_by_channel[message.channel.id] = session
+        _update_mention_subscription()
 
     return ("%s\n\n%s\n\n You have %d seconds to respond with the number of your "
             "desired answer, make sure to mention me!\n\n(Example: \"@%s 1\")" %
@@ -231,13 +252,14 @@ def trivia_command_handler(cmd_word, args, message, proc, config, twitch_monitor
 
 def trivia_scores_command_handler(cmd_word, args, message, proc, config, twitch_monitor):
     score_data = []
+    scores = proc.bot.guild_config(message.guild_id).plugin_data.get(PLUGIN_NAME, {})
 
-    for userid in config.config.plugin_data[PLUGIN_NAME]:
+    for userid in scores:
         user = proc.bot.client.get_user(int(userid))
         if not user:
             continue
 
-        score_data.append((user.name, config.config.plugin_data[PLUGIN_NAME][userid]))
+        score_data.append((user.name, scores[userid]))
 
     score_data.sort(key=lambda x: x[1], reverse=True)
     lines = '\n'.join([f"{x[0]}: {x[1]}" for x in score_data])
@@ -245,6 +267,47 @@ def trivia_scores_command_handler(cmd_word, args, message, proc, config, twitch_
     return f"Trivia scores for all participating discord users:\n```{lines}```"
 
 
+def _handle_trivia_answer(session, message, text_without_mention):
+    choice = str(text_without_mention)
+    max_choice = len(session.trivia.answers)
+
+    try:
+        intchoice = int(choice)
+    except ValueError:
+        intchoice = None
+
+    if intchoice is not None:
+        if (intchoice <= 0) or (intchoice > max_choice):
+            intchoice = None
+
+    if intchoice is None:
+        return (f"{message.author.mention} '{choice}' is not a valid choice, "
+                f"please pick a number between 1-{max_choice}")
+    else:
+        # Check if we already have an answer to this question from this user
+        for author, intchoice in session.responses:
+            if author.id == message.author.id:
+                return f"{message.author.mention} I already have an answer from you"
+
+        session.responses.append((message.author, intchoice))
+        return (f"{message.author.mention} OK, your answer has been recorded")
+
+
+def _on_mention(message, text_without_mention):
+    with trivia_by_channel_lock:
+        session = trivia_by_channel.get(message.channel.id, None)
+        if session is not None:
+            resp = _handle_trivia_answer(session, message, text_without_mention)
+            if resp:
+                session.discord_bot.send_message(message.channel, resp)
+
+
+def _update_mention_subscription():
+    # Only channels with a trivia question in progress need to see mentions.
+    # Must be called with trivia_by_channel_lock held.
+    events.subscribe(EventType.DISCORD_BOT_MENTION, _on_mention, channel_ids=trivia_by_channel.keys())
+
+
 class Trivia(PluginModule):
     """
     Plugin for starting an interactive trivia session in the current discord channel
@@ -263,46 +326,19 @@ class Trivia(PluginModule):
     !triviascores (see !help triviascores)
     """
 
-    def _handle_trivia_answer(self, session, message, text_without_mention):
-        choice = text_without_mention.strip()
-        max_choice = len(session.trivia.answers)
-
-        try:
-            intchoice = int(text_without_mention.strip())
-        except ValueError:
-            intchoice = None
-
-        if intchoice is not None:
-            if (intchoice <= 0) or (intchoice > max_choice):
-                intchoice = None
-
-        if intchoice is None:
-            return (f"{message.author.mention} '{choice}' is not a valid choice, "
-                    f"please pick a number between 1-{max_choice}")
-        else:
-            # Check if we already have an answer to this question from this user
-            for author, intchoice in session.responses:
-                if author.id == message.author.id:
-                    return f"{message.author.mention} I already have an answer from you"
-
-            session.responses.append((message.author, intchoice))
-            return (f"{message.author.mention} OK, your answer has been recorded")
-
-    def _on_mention(self, message, text_without_mention):
-        with trivia_by_channel_lock:
-            session = trivia_by_channel.get(message.channel.id, None)
-            if session is not None:
-                resp = self._handle_trivia_answer(session, message, text_without_mention)
-                if resp:
-                    self.discord_bot.send_message(message.channel, resp)
+    # Scoreboard looks up players by user ID
+    plugin_needs_all_members = True
 
     def open(self):
         """
         Enables plugin operation; subscribe to events and/or initialize things here
         """
         populate_categories()
-        events.subscribe(EventType.DISCORD_BOT_MENTION, self._on_mention)
-        self.discord_bot.add_command("trivia", trivia_command_handler, False, TRIVIA_HELPTEXT)
+        with trivia_by_channel_lock:
+            _update_mention_subscription()
+
+        self.discord_bot.add_command("trivia", trivia_command_handler, False, TRIVIA_HELPTEXT,
+                                     timeout_secs=COMMAND_TIMEOUT_S)
         self.discord_bot.add_command("triviascores", trivia_scores_command_handler, False, TRIVIA_SCORES_HELPTEXT)
 
     def close(self):
@@ -317,6 +353,7 @@ class Trivia(PluginModule):
 
             trivia_by_channel.clear()
 
+        events.unsubscribe(EventType.DISCORD_BOT_MENTION, _on_mention)
         categories_by_id.clear()
         self.discord_bot.remove_command("trivia")
         self.discord_bot.remove_command("triviascores")
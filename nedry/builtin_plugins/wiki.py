@@ -1,6 +1,8 @@
-import requests
+import asyncio
 import logging
 
+import aiohttp
+
 from nedry import utils
 from nedry.plugin import PluginModule
 
@@ -9,29 +11,35 @@ logger.setLevel(logging.INFO)
 
 WIKI_URL = 'https://en.wikipedia.org/w/api.php'
 REQUEST_TIMEOUT_S = 5.0
+COMMAND_TIMEOUT_S = 15.0
 
 
-def _wiki_summary_by_page_title(title):
+async def _get_json(session, url, params):
+    # Any request errors are treated the same as "no results"
+    try:
+        async with session.get(url, params=params) as response:
+            return await response.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+
+async def _wiki_summary_by_page_title(session, title):
     params = {
         'action': 'query',
         'format': 'json',
         'titles': title,
         'prop': 'extracts',
-        'exintro': True,
-        'explaintext': True,
+        'exintro': 'true',
+        'explaintext': 'true',
     }
 
-    # Use the search API to search for pages related to text
-    try:
-        response = requests.get(WIKI_URL, params=params, timeout=REQUEST_TIMEOUT_S)
-    except:
+    data = await _get_json(session, WIKI_URL, params)
+    if data is None:
         return None
 
-    data = response.json()
     page = next(iter(data['query']['pages'].values()))
     return page['extract'].strip()
 
-def get_wiki_summary(search_text):
+async def get_wiki_summary(session, search_text):
     params = {
             'action': 'query',
             'format': 'json',
@@ -40,23 +48,18 @@ def get_wiki_summary(search_text):
             'srsearch': search_text
     }
 
-    # Use the search API to search for pages related to text
-    try:
-        response = requests.get(WIKI_URL, params=params, timeout=REQUEST_TIMEOUT_S)
-    except:
+    data = await _get_json(session, WIKI_URL, params)
+    if data is None:
         return None
 
-    data = response.json()
-
     if not data['query']['search']:
         # No results
         return None
 
     # Just take the 1st search result
-    return _wiki_summary_by_page_title(data['query']['search'][0]['title'])
+    return await _wiki_summary_by_page_title(session, data['query']['search'][0]['title'])
 
-def get_random_wiki_summary():
-    url = 'https://en.wikipedia.org/w/api.php'
+async def get_random_wiki_summary(session):
     params = {
             'action': 'query',
             'format': 'json',
@@ -66,14 +69,11 @@ def get_random_wiki_summary():
             'rnlimit': 1
     }
 
-    try:
-        response = requests.get(url, params=params, timeout=REQUEST_TIMEOUT_S)
-    except:
+    data = await _get_json(session, WIKI_URL, params)
+    if data is None:
         return None
 
-    data = response.json()
-
-    return _wiki_summary_by_page_title(data['query']['random'][0]['title'])
+    return await _wiki_summary_by_page_title(session, data['query']['random'][0]['title'])
 
 
 HELPTEXT = """
@@ -90,16 +90,19 @@ Examples:
 """
 
 
-def wiki_command_handler(cmd_word, args, message, proc, config, twitch_monitor):
+async def wiki_command_handler(cmd_word, args, message, proc, config, twitch_monitor):
     """
     Handler for !wiki command
     """
     search_text = args
-    if not search_text:
-        # If no search text provided, just get a random wiki page
-        result = get_random_wiki_summary()
-    else:
-        result = get_wiki_summary(search_text)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_S)
+
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        if not search_text:
+            # If no search text provided, just get a random wiki page
+            result = await get_random_wiki_summary(session)
+        else:
+            result = await get_wiki_summary(session, search_text)
 
     if not result:
         return "No results found, sorry :("
@@ -134,7 +137,10 @@ class Wikipedia(PluginModule):
         """
         Enables plugin operation; subscribe to events and/or initialize things here
         """
-        self.discord_bot.add_command("wiki", wiki_command_handler, False, HELPTEXT)
+        # Identical searches received while one is in progress share its result. A search
+        # makes up to 2 requests, each with its own timeout.
+        self.discord_bot.add_command("wiki", wiki_command_handler, False, HELPTEXT, single_flight=True,
+                                     timeout_secs=COMMAND_TIMEOUT_S)
 
     def close(self):
         """
@@ -0,0 +1,114 @@
+# Implements a ChannelIndex class, for looking up a guild's text channels by name
+# or ID without scanning the whole channel list every time.
+
+
+def _channel_sort_key(channel):
+    # Same order as discord.Guild.text_channels
+    return (channel.position, channel.id)
+
+
+class ChannelIndex(object):
+    """
+    Index of text channels by name and by ID. Built from a full list of channels,
+    and then kept up to date by adding, removing and updating single channels.
+
+    If more than one channel has the same name, lookups by name return the channel
+    that comes first in the guild's channel list (lowest position, then lowest ID),
+    which is the same channel a linear scan of discord.Guild.text_channels would find.
+
+    Updates must all happen on the same thread (the main event loop), but lookups
+    may be done from any thread.
+    """
+    def __init__(self):
+        # Channel name is stored alongside each channel, since discord.py updates
+        # channel objects in place when a channel is renamed
+        self._by_id = {}
+        self._by_name = {}
+
+    def rebuild(self, channels):
+        """
+        Discard all indexed channels, and index the given channels instead
+
+        :param channels: list of discord.py channel objects
+        """
+        by_id = {}
+        by_name = {}
+
+        for channel in channels:
+            by_id[channel.id] = (channel.name, channel)
+            by_name.setdefault(channel.name, []).append(channel)
+
+        for name in by_name:
+            by_name[name] = tuple(sorted(by_name[name], key=_channel_sort_key))
+
+        self._by_id = by_id
+        self._by_name = by_name
+
+    def clear(self):
+        """
+        Discard all indexed channels
+        """
+        self.rebuild([])
+
+    def _set_name_entries(self, name, channels):
+        # Entries are replaced rather than modified, so readers on other threads
+        # never see a partially updated entry
+        if channels:
+            self._by_name[name] = tuple(sorted(channels, key=_channel_sort_key))
+        else:
+            self._by_name.pop(name, None)
+
+    def add(self, channel):
+        """
+        Add a channel to the index, replacing any indexed channel with the same ID
+
+        :param channel: discord.py channel object
+        """
+        self.remove(channel)
+        self._by_id[channel.id] = (channel.name, channel)
+        self._set_name_entries(channel.name, list(self._by_name.get(channel.name, ())) + [channel])
+
+    def remove(self, channel):
+        """
+        Remove a channel from the index, if it is indexed
+
+        :param channel: discord.py channel object
+        """
+        old = self._by_id.pop(channel.id, None)
+        if old is None:
+            return
+
+        old_name, _ = old
+        entries = [c for c in self._by_name.get(old_name, ()) if c.id != channel.id]
+        self._set_name_entries(old_name, entries)
+
+    def get_by_name(self, name):
+        """
+        Get a channel by name
+
+        :param str name: channel name
+
+        :return: discord.py channel object, or None if there is no channel with this name
+        """
+        entries = self._by_name.get(name, None)
+        if not entries:
+            return None
+
+        return entries[0]
+
+    def get_by_id(self, channel_id):
+        """
+        Get a channel by ID
+
+        :param int channel_id: channel ID
+
+        :return: discord.py channel object, or None if there is no channel with this ID
+        """
+        entry = self._by_id.get(channel_id, None)
+        if entry is None:
+            return None
+
+        return entry[1]
+
+    def __len__(self):
+        return len(self._by_id)
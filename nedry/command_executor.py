@@ -0,0 +1,190 @@
+# Implements a CommandExecutor class that runs bot command handlers on a bounded
+# pool of worker threads, so that slow handlers don't stall the discord.py event loop.
+
+import collections
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class QueuedJob(object):
+    """
+    Represents a single job waiting to be run by a CommandExecutor
+    """
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.enqueue_time = time.monotonic()
+
+
+class CommandExecutor(object):
+    """
+    Runs jobs on a bounded pool of worker threads. Jobs submitted with the same
+    key (e.g. a discord channel ID) are always run one at a time, in the order in
+    which they were submitted. Jobs with different keys may run concurrently.
+    """
+    def __init__(self, num_workers, max_queued=1000):
+        """
+        :param int num_workers: Number of worker threads. If less than 1, the\
+            executor will not start, and callers should run jobs inline instead.
+        :param int max_queued: Maximum number of jobs that may be waiting to run\
+            at any one time. Jobs submitted when the queue is full are rejected.
+        """
+        self.num_workers = num_workers
+        self.max_queued = max_queued
+
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = {}           # Deque of waiting jobs, keyed by job key
+        self._ready = queue.Queue()  # Keys that have a job ready to run
+        self._threads = []
+        self._queued = 0
+        self._running = 0
+        self._stopping = False
+
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._total_wait_secs = 0.0
+        self._max_wait_secs = 0.0
+
+    def is_running(self):
+        return bool(self._threads)
+
+    def start(self):
+        """
+        Start all worker threads. Does nothing if the number of workers is less than 1.
+        """
+        if self._threads or (self.num_workers < 1):
+            return
+
+        self._stopping = False
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._worker_task, name="nedry-cmd-worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        logger.debug("started %d command worker threads" % self.num_workers)
+
+    def stop(self, timeout=5.0):
+        """
+        Stop accepting new jobs, wait for all queued jobs to finish, and then
+        stop all worker threads
+
+        :param float timeout: Max. time to wait for queued jobs to finish, in seconds
+        """
+        if not self._threads:
+            return
+
+        logger.debug("Stopping")
+        with self._idle:
+            self._stopping = True
+            self._idle.wait_for(lambda: (self._queued + self._running) == 0, timeout)
+
+        for _ in self._threads:
+            self._ready.put(None)
+
+        for thread in self._threads:
+            thread.join(timeout)
+
+        self._threads = []
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Queue a job to run on a worker thread
+
+        :param key: Jobs sharing the same key are run in order, one at a time
+        :param func: Function to run
+        :param args: Positional arguments to pass to func
+        :param kwargs: Keyword arguments to pass to func
+
+        :return: True if the job was queued, False if it was rejected
+        :rtype: bool
+        """
+        with self._lock:
+            if self._stopping or (self._queued >= self.max_queued):
+                self._rejected += 1
+                return False
+
+            if key not in self._pending:
+                # No jobs for this key are queued or running, key is ready to run
+                self._pending[key] = collections.deque()
+                self._ready.put(key)
+
+            self._pending[key].append(QueuedJob(func, args, kwargs))
+            self._queued += 1
+            self._submitted += 1
+
+        return True
+
+    def queue_depth(self):
+        with self._lock:
+            return self._queued
+
+    def metrics(self):
+        """
+        Get a snapshot of executor metrics
+
+        :return: dict of metric values, keyed by metric name
+        :rtype: dict
+        """
+        with self._lock:
+            started = self._completed + self._failed + self._running
+            avg_wait_ms = (self._total_wait_secs / started) * 1000.0 if started else 0.0
+
+            return {
+                "workers": len(self._threads),
+                "queue_depth": self._queued,
+                "active_keys": len(self._pending),
+                "running": self._running,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "avg_wait_ms": round(avg_wait_ms, 2),
+                "max_wait_ms": round(self._max_wait_secs * 1000.0, 2)
+            }
+
+    def _worker_task(self):
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+
+            with self._lock:
+                job = self._pending[key].popleft()
+                self._queued -= 1
+                self._running += 1
+
+                wait_secs = time.monotonic() - job.enqueue_time
+                self._total_wait_secs += wait_secs
+                self._max_wait_secs = max(self._max_wait_secs, wait_secs)
+
+            failed = False
+            try:
+                job.func(*job.args, **job.kwargs)
+            except Exception:
+                failed = True
+                logger.exception("unhandled exception in command worker")
+
+            with self._idle:
+                self._running -= 1
+                if failed:
+                    self._failed += 1
+                else:
+                    self._completed += 1
+
+                if self._pending[key]:
+                    # More jobs queued for this key, put it back in line
+                    self._ready.put(key)
+                else:
+                    del self._pending[key]
+
+                self._idle.notify_all()
@@ -0,0 +1,565 @@
+# Implements a CommandLogWriter class, which writes the command log file on a
+# background thread, rotates it when it gets too large or too old, and indexes it
+# so that recent commands can be found without reading the whole file.
+
+import array
+import bisect
+import collections
+import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+from nedry.parsed_message import COMMAND_PREFIX
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Buffered records are written when this many records are waiting...
+FLUSH_RECORDS = 100
+
+# ...or when the oldest buffered record has been waiting this long, in seconds
+FLUSH_INTERVAL_SECS = 1.0
+
+# Max. time to wait for buffered records to be written before answering a query, in seconds
+QUERY_FLUSH_TIMEOUT_SECS = 5.0
+
+# Number of most recent records kept in memory, so that queries with no user or command
+# filter can be answered without reading the log file
+RECENT_RECORDS = 500
+
+# Format of the timestamp shown for each command by format_record
+TIMESTAMP_FORMAT = "%m/%d/%Y %H:%M:%S"
+
+# Format of the timestamp added to the names of rotated log files
+ROTATED_TIMESTAMP_FORMAT = "%Y%m%d-%H%M%S"
+
+
+def make_record(timestamp, user_id, user_name, channel_id, guild_id, command, args):
+    """
+    Create a command log record
+
+    :param float timestamp: time the command was received, as a UNIX timestamp
+    :param int user_id: discord ID of the user who sent the command
+    :param str user_name: name of the user who sent the command
+    :param int channel_id: discord ID of the channel the command was sent on
+    :param int guild_id: discord ID of the guild the command was sent in
+    :param str command: command word, without prefix
+    :param str args: command arguments
+
+    :return: command log record
+    :rtype: dict
+    """
+    return {
+        "time": timestamp,
+        "user_id": user_id,
+        "user_name": user_name,
+        "channel_id": channel_id,
+        "guild_id": guild_id,
+        "command": command,
+        "args": args
+    }
+
+
+def format_record(record):
+    """
+    Format a command log record as a single line of text
+
+    :param dict record: command log record
+
+    :return: formatted record
+    :rtype: str
+    """
+    timestamp = datetime.datetime.utcfromtimestamp(record["time"]).strftime(TIMESTAMP_FORMAT)
+    command_text = ("%s%s %s" % (COMMAND_PREFIX, record["command"], record["args"])).strip()
+    return "[%s] [%s (%d)] %s" % (timestamp, record["user_name"], record["user_id"], command_text)
+
+
+def _parse_record(line):
+    # Returns None if the line is not a command log record (e.g. the plain text
+    # command log written by older versions)
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+
+    if not isinstance(record, dict) or ("time" not in record):
+        return None
+
+    return record
+
+
+class CommandLogIndex(object):
+    """
+    In-memory index of the records in a command log file. Holds the file offset and
+    time of each record, and the record numbers for each user ID and command word,
+    in compact arrays.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.offsets = array.array('Q')
+        self.times = array.array('d')
+        self.by_user = {}       # Array of record numbers, keyed by user ID
+        self.by_command = {}    # Array of record numbers, keyed by command word
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def add(self, offset, record):
+        """
+        Index a record
+
+        :param int offset: offset of the record in the log file, in bytes
+        :param dict record: command log record
+        """
+        num = len(self.offsets)
+        self.offsets.append(offset)
+        self.times.append(record["time"])
+        self.by_user.setdefault(record["user_id"], array.array('I')).append(num)
+        self.by_command.setdefault(record["command"], array.array('I')).append(num)
+
+    def find(self, count, user_id=None, command=None, since=None):
+        """
+        Find the most recent records matching all of the given filters
+
+        :param int count: max. number of records to find
+        :param int user_id: only find records for commands sent by this user
+        :param str command: only find records for this command word
+        :param float since: only find records at or after this time, as a UNIX timestamp
+
+        :return: list of record numbers, oldest first
+        :rtype: list
+        """
+        if count <= 0:
+            return []
+
+        first = 0 if since is None else bisect.bisect_left(self.times, since)
+
+        lists = []
+        if user_id is not None:
+            lists.append(self.by_user.get(user_id, ()))
+        if command is not None:
+            lists.append(self.by_command.get(command, ()))
+
+        if not lists:
+            return list(range(max(first, len(self.offsets) - count), len(self.offsets)))
+
+        # Walk all record number lists backwards, newest first, keeping record
+        # numbers that appear in every list
+        ret = []
+        pos = [len(l) - 1 for l in lists]
+        while (len(ret) < count) and min(pos) >= 0:
+            values = [lists[i][pos[i]] for i in range(len(lists))]
+            lowest = min(values)
+            if lowest < first:
+                break
+
+            if max(values) == lowest:
+                ret.append(lowest)
+                pos = [p - 1 for p in pos]
+            else:
+                # Skip straight past all record numbers newer than the lowest one, in each list
+                pos = [bisect.bisect_right(lists[i], lowest, 0, pos[i]) - 1 if values[i] > lowest else pos[i]
+                       for i in range(len(lists))]
+
+        ret.reverse()
+        return ret
+
+
+class _FlushRequest(object):
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class CommandLogWriter(object):
+    """
+    Appends command log records to a file from a background thread, so that callers
+    (e.g. the discord.py event loop) never wait for disk I/O. Records are buffered and
+    written in batches, one JSON object per line, and the log file is rotated when it
+    grows beyond a maximum size, or when the first record in it is older than a maximum age.
+
+    Rotated log files are renamed with a timestamp suffix (e.g. "commands.txt.20240131-120000"),
+    and optionally compressed with gzip. Only the newest 'backup_count' rotated files are kept.
+
+    Records in the current log file are indexed as they are written, so that the most
+    recent records, optionally filtered by user, command word or time, can be read
+    without scanning the file. The newest RECENT_RECORDS records are also kept in memory.
+    """
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, max_age_secs=30 * 24 * 60 * 60,
+                 backup_count=5, compress=False):
+        """
+        :param str filename: log file name
+        :param int max_bytes: Rotate the log file when it is larger than this many bytes.\
+            If 0, the log file is never rotated because of its size.
+        :param int max_age_secs: Rotate the log file when the first record in it is older than\
+            this many seconds. If 0, the log file is never rotated because of its age.
+        :param int backup_count: Max. number of rotated log files to keep
+        :param bool compress: If True, rotated log files are compressed with gzip
+        """
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.max_age_secs = max_age_secs
+        self.backup_count = backup_count
+        self.compress = compress
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._fh = None
+        self._size = 0
+        self._segment_start = None
+
+        # Held while the index is changed, and while records are read using the index,
+        # so that the log file is not rotated in the middle of a read
+        self._index_lock = threading.Lock()
+        self._index = CommandLogIndex()
+
+        # Most recent records, including records that are still queued
+        self._recent_lock = threading.Lock()
+        self._recent = collections.deque(maxlen=RECENT_RECORDS)
+
+        self._metrics_lock = threading.Lock()
+        self._records_written = 0
+        self._flushes = 0
+        self._rotations = 0
+        self._write_errors = 0
+        self._queries = 0
+        self._total_flush_secs = 0.0
+        self._max_flush_secs = 0.0
+        self._total_query_secs = 0.0
+
+    def is_running(self):
+        return self._thread is not None
+
+    def start(self):
+        """
+        Open and index the log file, and start the writer thread
+
+        :return: True if the log file could be opened, False otherwise
+        :rtype: bool
+        """
+        if self._thread is not None:
+            return True
+
+        try:
+            self._open()
+        except OSError:
+            logger.exception("failed to open command log file %s" % self.filename)
+            return False
+
+        self._thread = threading.Thread(target=self._writer_task, name="nedry-command-log")
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def write(self, record):
+        """
+        Queue a record to be written to the log file. Never blocks.
+
+        :param dict record: command log record, see make_record
+        """
+        with self._recent_lock:
+            self._recent.append(record)
+
+        self._queue.put(record)
+
+    def flush(self, timeout=None):
+        """
+        Wait until all records queued so far have been written to the log file
+
+        :param float timeout: Max. time to wait, in seconds. If None, wait forever.
+
+        :return: True if all records were written, False if timed out
+        :rtype: bool
+        """
+        if self._thread is None:
+            return True
+
+        request = _FlushRequest()
+        self._queue.put(request)
+        return request.done.wait(timeout)
+
+    def close(self, timeout=5.0):
+        """
+        Write all queued records to the log file, and stop the writer thread
+
+        :param float timeout: Max. time to wait for queued records to be written, in seconds
+        """
+        if self._thread is None:
+            return
+
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("timed out waiting for command log to be written, %d records may be lost" %
+                           self._queue.qsize())
+
+        self._thread = None
+
+    def query(self, count, user_id=None, command=None, since=None):
+        """
+        Get the most recent records in the current log file (not including rotated log
+        files) that match all of the given filters. Only the matching records are read
+        from the log file. If no user or command filter is given, and no more than\
+        RECENT_RECORDS records are requested, records are not read from the log file at\
+        all; in that case, records from before the log file was last rotated may be included.
+
+        :param int count: max. number of records to get
+        :param int user_id: only get commands sent by this user
+        :param str command: only get commands with this command word
+        :param float since: only get commands received at or after this time, as a UNIX timestamp
+
+        :return: list of command log records, oldest first
+        :rtype: list
+        """
+        start = time.monotonic()
+        ret = None
+
+        if (user_id is None) and (command is None):
+            ret = self._query_recent(count, since)
+
+        if ret is None:
+            ret = self._query_index(count, user_id, command, since)
+
+        elapsed = time.monotonic() - start
+        with self._metrics_lock:
+            self._queries += 1
+            self._total_query_secs += elapsed
+
+        return ret
+
+    def _query_recent(self, count, since):
+        # Returns None if the records in memory might not include all of the requested records
+        if count <= 0:
+            return []
+
+        with self._recent_lock:
+            if (count > len(self._recent)) and (len(self._recent) == self._recent.maxlen):
+                return None
+
+            records = list(self._recent)[-count:]
+
+        return [r for r in records if (since is None) or (r["time"] >= since)]
+
+    def _query_index(self, count, user_id, command, since):
+        if not self.flush(QUERY_FLUSH_TIMEOUT_SECS):
+            logger.warning("timed out waiting for command log to be written, query may be missing records")
+
+        ret = []
+
+        with self._index_lock:
+            nums = self._index.find(count, user_id, command, since)
+            if nums:
+                try:
+                    with open(self.filename, 'rb') as fh:
+                        for num in nums:
+                            fh.seek(self._index.offsets[num])
+                            record = _parse_record(fh.readline())
+                            if record is not None:
+                                ret.append(record)
+                except OSError:
+                    logger.exception("failed to read command log file %s" % self.filename)
+
+        return ret
+
+    def metrics(self):
+        """
+        Get a snapshot of command log metrics
+
+        :return: dict of metric values, keyed by metric name
+        :rtype: dict
+        """
+        with self._index_lock:
+            indexed = len(self._index)
+
+        with self._metrics_lock:
+            avg_flush_ms = (self._total_flush_secs / self._flushes) * 1000.0 if self._flushes else 0.0
+            avg_query_ms = (self._total_query_secs / self._queries) * 1000.0 if self._queries else 0.0
+
+            return {
+                "queue_depth": self._queue.qsize(),
+                "records_written": self._records_written,
+                "records_indexed": indexed,
+                "flushes": self._flushes,
+                "rotations": self._rotations,
+                "write_errors": self._write_errors,
+                "queries": self._queries,
+                "avg_flush_ms": round(avg_flush_ms, 2),
+                "max_flush_ms": round(self._max_flush_secs * 1000.0, 2),
+                "avg_query_ms": round(avg_query_ms, 2)
+            }
+
+    def _open(self):
+        # Index all records in any existing log file. Log files written by older versions
+        # (plain text, one line per command) are rotated first, so that the current log
+        # file only ever contains records.
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'rb') as fh:
+                first_line = fh.readline()
+
+            if first_line.strip() and (_parse_record(first_line) is None):
+                logger.info("rotating command log file %s, since it is not in the current format" % self.filename)
+                self._rotate()
+                return
+
+        self._fh = open(self.filename, 'ab')
+        self._size = self._fh.tell()
+        self._segment_start = None
+
+        last_records = collections.deque(maxlen=RECENT_RECORDS)
+        with self._index_lock, open(self.filename, 'rb') as fh:
+            self._index.clear()
+            offset = 0
+            for line in fh:
+                record = _parse_record(line)
+                if record is not None:
+                    if self._segment_start is None:
+                        self._segment_start = record["time"]
+
+                    self._index.add(offset, record)
+                    last_records.append(record)
+
+                offset += len(line)
+
+        # Records written before the log was opened go before any records queued since
+        with self._recent_lock:
+            last_records.extend(self._recent)
+            self._recent = last_records
+
+    def _should_rotate(self):
+        if self._size == 0:
+            return False
+
+        if (self.max_bytes > 0) and (self._size >= self.max_bytes):
+            return True
+
+        if (self.max_age_secs > 0) and (self._segment_start is not None):
+            return (time.time() - self._segment_start) >= self.max_age_secs
+
+        return False
+
+    def _rotated_filenames(self):
+        # Rotated log files, oldest first
+        return sorted(glob.glob(glob.escape(self.filename) + ".*"), key=os.path.getmtime)
+
+    def _rotate(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+        timestamp = datetime.datetime.utcnow().strftime(ROTATED_TIMESTAMP_FORMAT)
+        rotated = "%s.%s" % (self.filename, timestamp)
+        suffix = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + ".gz"):
+            rotated = "%s.%s-%d" % (self.filename, timestamp, suffix)
+            suffix += 1
+
+        with self._index_lock:
+            os.replace(self.filename, rotated)
+            self._index.clear()
+
+        if self.compress:
+            with open(rotated, 'rb') as fin, gzip.open(rotated + ".gz", 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+
+            os.remove(rotated)
+
+        rotated_files = self._rotated_filenames()
+        for old in rotated_files[:max(0, len(rotated_files) - self.backup_count)]:
+            os.remove(old)
+
+        self._fh = open(self.filename, 'ab')
+        self._size = 0
+        self._segment_start = None
+
+        with self._metrics_lock:
+            self._rotations += 1
+
+        logger.debug("rotated command log to %s" % rotated)
+
+    def _write_records(self, records):
+        start = time.monotonic()
+
+        try:
+            if self._fh is None:
+                self._fh = open(self.filename, 'ab')
+                self._size = self._fh.tell()
+
+            if self._should_rotate():
+                self._rotate()
+
+            if self._segment_start is None:
+                self._segment_start = records[0]["time"]
+
+            lines = [(json.dumps(r) + "\n").encode() for r in records]
+            self._fh.write(b"".join(lines))
+            self._fh.flush()
+        except OSError:
+            logger.exception("failed to write %d records to command log file %s" % (len(records), self.filename))
+            with self._metrics_lock:
+                self._write_errors += 1
+
+            # File may have been partially written, find the end of the file again on the next write
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+            return
+
+        with self._index_lock:
+            for i in range(len(records)):
+                self._index.add(self._size, records[i])
+                self._size += len(lines[i])
+
+        elapsed = time.monotonic() - start
+        with self._metrics_lock:
+            self._records_written += len(records)
+            self._flushes += 1
+            self._total_flush_secs += elapsed
+            self._max_flush_secs = max(self._max_flush_secs, elapsed)
+
+    def _writer_task(self):
+        pending = []
+        oldest_pending = 0.0
+        stopping = False
+
+        while not stopping:
+            timeout = None
+            if pending:
+                timeout = max(0.0, FLUSH_INTERVAL_SECS - (time.monotonic() - oldest_pending))
+
+            flush_request = None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                # Flush interval has expired, nothing new to write
+                pass
+            else:
+                if item is None:
+                    stopping = True
+                elif isinstance(item, _FlushRequest):
+                    flush_request = item
+                else:
+                    if not pending:
+                        oldest_pending = time.monotonic()
+
+                    pending.append(item)
+
+            expired = pending and ((time.monotonic() - oldest_pending) >= FLUSH_INTERVAL_SECS)
+            if pending and (stopping or expired or (flush_request is not None) or (len(pending) >= FLUSH_RECORDS)):
+                self._write_records(pending)
+                pending = []
+
+            if flush_request is not None:
+                flush_request.done.set()
+
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
@@ -3,23 +3,48 @@
 #
 # All of the handler functions for commands are also implemented here.
 
+import asyncio
+import concurrent.futures
 import datetime
-import os
 import time
 import logging
-from difflib import SequenceMatcher
+import threading
 
 from nedry import __version__ as version
 from nedry import quotes
 from nedry import utils
+from nedry.command_log import CommandLogWriter, make_record, format_record
+from nedry.command_stats import CommandStats, CommandProfiler
+from nedry.command_watchdog import CommandWatchdog
+from nedry.fuzzy_index import FuzzyIndex
+from nedry.rate_limiter import CommandRateLimiter
+from nedry.response_cache import ResponseCache, SingleFlight
+from nedry.plugin import current_plugin_name
 from nedry.twitch_monitor import InvalidTwitchUser
+from nedry.parsed_message import ParsedMessage, COMMAND_PREFIX
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+main_event_loop = asyncio.get_event_loop()
+
+# Max. number of regular (not async) command handlers that may still be running after
+# timing out. Commands with a timeout are refused while this many are stuck, so that
+# a handler that hangs forever can't use up an unlimited number of threads.
+MAX_ABANDONED_HANDLERS = 16
+
+# Max. number of seconds to wait for the response of an identical command that is
+# already running, for commands that have no timeout of their own
+DEFAULT_SHARED_WAIT_SECS = 30.0
+
+
+class CommandTimeoutError(Exception):
+    """
+    Raised when a command handler does not finish within the command's timeout
+    """
+    pass
 
-COMMAND_PREFIX = "!"
 
 CMD_HELP_HELP = """
 {0} [command]
@@ -137,15 +162,19 @@ Example:
 """
 
 CMD_CMDHISTORY_HELP = """
-{0} [entry_count]
+{0} [entry_count] [user:user] [cmd:command] [since:time]
 
 Show the last few entries in the command log file. If no count is given then the
-last 25 entries are shown.
+last 25 entries are shown. Entries can be filtered by the user who sent the command
+(user mention or user ID), by command word, and by time (e.g. "2h" or "7d" for the
+last 2 hours or 7 days, or a date like "2024-01-31").
 
 Examples:
 
-@BotName !{0}     (show last 25 entries)
-@BotName !{0} 5   (show last 5 entries)
+@BotName !{0}                        (show last 25 entries)
+@BotName !{0} 5                      (show last 5 entries)
+@BotName !{0} user:@eknyquist        (show last 25 entries from user 'eknyquist')
+@BotName !{0} 10 cmd:wiki since:1d   (show last 10 'wiki' commands from the last day)
 """
 
 CMD_QUOTE_HELP = """
@@ -272,6 +301,38 @@ Example:
 @BotName !removephrases 3 4 5
 """
 
+CMD_METRICS_HELP = """
+{0}
+
+Shows runtime metrics tracked by the bot, e.g. the number of commands waiting to
+be handled, and how long commands are waiting before being handled.
+
+Example:
+
+@BotName !metrics
+"""
+
+CMD_PERF_HELP = """
+{0} [command | reset | profile command [count]]
+
+Shows how many times each command has been run, how many times it failed or timed
+out, and how long it took (average, 50th/95th/99th percentile and maximum, in milliseconds).
+Responses that were cached, or shared with an identical command that was already
+running, are not counted.
+
+With "profile", the next few invocations of a command (1 if no count is given) are
+run under the python profiler, and the functions with the largest cumulative time
+are sent to this channel once they have finished. The full profile data is also
+written to a file on the bot's host.
+
+Examples:
+
+@BotName !{0}                    (show statistics for all commands)
+@BotName !{0} wiki               (show statistics for the 'wiki' command)
+@BotName !{0} reset              (clear all statistics)
+@BotName !{0} profile wiki 5     (profile the next 5 'wiki' commands)
+"""
+
 CMD_SAY_HELP = """
 {0} [stuff to say]
 
@@ -286,13 +347,34 @@ Example:
 
 class Command(object):
     """
-    Represents all data required to handle a single command
+    Represents all data required to handle a single command. The handler may
+    be either a regular function, or a coroutine function ("async def"), in which
+    case it will be run on the main event loop.
+
+    Commands added by a plugin are owned by that plugin, and can only be used in
+    guilds where the plugin is enabled.
+
+    If cache_response is True, the command's response must only depend on the command
+    arguments, whether the sender is an admin, the guild, and the bot's configuration, and
+    responses are cached. If single_flight is True (or cache_response is True), identical
+    commands received while the command is already running share one response.
+
+    If timeout_secs is set, the sender is told the command failed if the handler does not
+    finish in time. Coroutine handlers are cancelled; regular handlers can't be stopped,
+    so they are run on their own thread, and their response is thrown away if they finish
+    after the timeout.
     """
-    def __init__(self, word, handler, admin_only, helptext):
+    def __init__(self, word, handler, admin_only, helptext, owner=None, cache_response=False,
+                 single_flight=False, timeout_secs=None):
         self.word = word.lower()
         self.handler = handler
         self.helptext = helptext
         self.admin_only = admin_only
+        self.owner = owner
+        self.cache_response = cache_response
+        self.single_flight = single_flight or cache_response
+        self.timeout_secs = timeout_secs
+        self.is_async = asyncio.iscoroutinefunction(handler)
 
     def help(self):
         return "```%s```" % self.helptext.format(self.word)
@@ -325,10 +407,11 @@ class MessageData(object):
     """
     Represents all required data related to the author and channel of a received command
     """
-    def __init__(self, channel, author, is_admin):
+    def __init__(self, channel, author, is_admin, guild_id=None):
         self.channel = channel
         self.author = author
         self.is_admin = is_admin
+        self.guild_id = guild_id
 
 
 class ChannelData(object):
@@ -349,19 +432,35 @@ class CommandProcessor(object):
         self.config = config
         self.bot = bot
         self.cmds = {x.word: x for x in command_list}
-        self.command_log_buf = []
+        self.cmd_index = FuzzyIndex(self.cmds)
         self.mocking_enabled = True
-        self.log_filename = None
+        self.command_log = None
         self.channel_data = {}
         self.start_time = time.time()
 
-        try:
-            # Check if command log file path is accessible
-            _ = open(config.config.command_log_file, 'a')
-        except:
-            pass
-        else:
-            self.log_filename = config.config.command_log_file
+        if config.config.command_log_file:
+            command_log = CommandLogWriter(config.config.command_log_file,
+                                           max_bytes=int(config.config.command_log_max_mb * 1024 * 1024),
+                                           max_age_secs=int(config.config.command_log_max_age_days * 24 * 60 * 60),
+                                           backup_count=config.config.command_log_backup_count,
+                                           compress=config.config.command_log_compress)
+
+            if command_log.start():
+                self.command_log = command_log
+
+        self.rate_limiter = CommandRateLimiter(config.config.command_rate_limit_user,
+                                               config.config.command_rate_limit_admin,
+                                               config.config.command_rate_limit_channel,
+                                               config.config.command_rate_limit_commands)
+
+        self.response_cache = ResponseCache()
+        self.single_flight = SingleFlight()
+        self.command_stats = CommandStats()
+        self.profiler = CommandProfiler()
+        self._config_generation = config.generation
+
+        # Started along with the command worker threads
+        self.watchdog = CommandWatchdog(config.config.command_watchdog_secs)
 
     def uptime_seconds(self):
         return time.time() - self.start_time
@@ -375,82 +474,137 @@ class CommandProcessor(object):
 
         return self.channel_data[channel_id][ident]
 
-    def add_command(self, cmd_word, cmd_handler, admin_only, helptext):
-        cmd = Command(cmd_word, cmd_handler, admin_only, helptext)
+    def add_command(self, cmd_word, cmd_handler, admin_only, helptext, cache_response=False,
+                    single_flight=False, timeout_secs=None):
+        cmd = Command(cmd_word, cmd_handler, admin_only, helptext, current_plugin_name(),
+                      cache_response, single_flight, timeout_secs)
         if cmd.word in self.cmds:
             raise ValueError("Command '%s' already exists" % cmd.word)
 
         self.cmds[cmd.word] = cmd
+        self.cmd_index.add(cmd.word)
+        self.response_cache.invalidate()
 
     def remove_command(self, cmd_word):
         if cmd_word in self.cmds:
             del self.cmds[cmd_word]
+            self.cmd_index.remove(cmd_word)
+            self.response_cache.invalidate()
 
-    def close(self):
-        logger.debug("Stopping")
-        if self.log_filename is not None:
-            self._flush_command_log_buf()
+    def _check_config_generation(self):
+        # Cached responses may depend on anything in the configuration
+        generation = self.config.generation
+        if generation != self._config_generation:
+            self._config_generation = generation
+            self.response_cache.invalidate()
+
+    def cached_response(self, key, func):
+        """
+        Get a response from the response cache, or create and cache it if there is
+        no valid cached response. Cached responses are dropped whenever commands are
+        added or removed, plugins are enabled or disabled, or the configuration is saved.
+
+        :param key: cache key, must be hashable
+        :param func: function to call with no arguments to create the response
+
+        :return: response
+        :rtype: str
+        """
+        self._check_config_generation()
 
-    def _flush_command_log_buf(self):
-        if self.command_log_buf:
-            with open(self.log_filename, 'a') as fh:
-                fh.write("\n".join(self.command_log_buf) + "\n")
+        resp = self.response_cache.get(key)
+        if resp is None:
+            generation = self.response_cache.generation()
+            resp = func()
+            self.response_cache.put(key, resp, generation)
 
-            self.command_log_buf = []
+        return resp
 
-    def _log_command_event(self, message):
-        if self.log_filename is None:
+    def close(self):
+        logger.debug("Stopping")
+        self.watchdog.stop()
+        if self.command_log is not None:
+            self.command_log.close()
+
+    def _log_valid_command(self, msg_data, command, argtext):
+        if self.command_log is None:
             return
 
-        timestamp = datetime.datetime.utcnow().strftime("%m/%d/%Y %H:%M:%S")
-        msg_to_write = "[%s] %s" % (timestamp, message)
-        self.command_log_buf.append(msg_to_write)
+        record = make_record(time.time(), msg_data.author.id, msg_data.author.name, msg_data.channel.id,
+                             msg_data.guild_id, command, argtext)
+        self.command_log.write(record)
 
-        if len(self.command_log_buf) >= 10:
-            self._flush_command_log_buf()
+    def command_history(self, last=25, user_id=None, command=None, since=None):
+        """
+        Get the most recent commands from the command log
 
-    def _log_valid_command(self, author, command_text):
-        msg = "[%s (%d)] %s" % (author.name, author.id, command_text)
-        self._log_command_event(msg)
+        :param int last: max. number of commands to get
+        :param int user_id: only get commands sent by this user
+        :param str command: only get commands with this command word
+        :param float since: only get commands received at or after this time, as a UNIX timestamp
 
-    def command_history(self, last=25):
-        if not self.log_filename:
+        :return: list of formatted commands, oldest first, or None if command logging is disabled
+        :rtype: list
+        """
+        if self.command_log is None:
             return None
 
-        if not os.path.isfile(self.log_filename):
-            return None
+        return [format_record(r) for r in self.command_log.query(last, user_id, command, since)]
 
-        if len(self.command_log_buf) >= last:
-            # All requested lines are in memory
-            return self.command_log_buf[-last:]
+    def check_rate_limit(self, channel, author, text):
+        """
+        Check whether a command is allowed by the configured rate limits. Should be called
+        once for each received command, before the command is queued or processed.
 
-        lines_in_file = last - len(self.command_log_buf)
+        :param channel: Discord channel object
+        :param author: User object from discord.py, the user who wrote the message
+        :param str text: Command text. May be a ParsedMessage, in which case the text\
+            is not parsed again.
 
-        with open(self.log_filename, 'r') as fh:
-            lines = [l.strip() for l in fh.readlines()]
+        :return: tuple of the form (allowed, response). If allowed is False, the command\
+            should be dropped, and response is a message to send back to discord, or None\
+            if the user has already been told to slow down.
+        :rtype: tuple
+        """
+        if not self.rate_limiter.is_enabled():
+            return True, None
+
+        if not isinstance(text, ParsedMessage):
+            text = ParsedMessage(text)
+
+        is_admin = author.id in self.config.config.discord_admin_users
+        allowed, retry_after, notify = self.rate_limiter.check(author.id, channel.id, text.command_word, is_admin)
+        if allowed:
+            return True, None
+
+        if not notify:
+            return False, None
 
-        return lines[-lines_in_file:] + self.command_log_buf
+        return False, ("%s Slow down! Please wait %d seconds before using that command again."
+                       % (author.mention, max(1, int(retry_after + 0.999))))
 
-    def help(self, include_admin=True):
+    def _command_enabled(self, cmd, guild_id):
+        # Commands owned by a plugin are only available in guilds where the plugin is enabled
+        return (cmd.owner is None) or self.bot.plugin_enabled_in_guild(cmd.owner, guild_id)
+
+    def help(self, include_admin=True, guild_id=None):
         """
         Get the text for a discord message showing all available commands
+
+        :param bool include_admin: If False, admin-only commands are not shown
+        :param int guild_id: Only show commands that are available in this guild. If None,\
+            commands available in the main guild are shown.
         """
+        cmds = [self.cmds[x] for x in self.cmds if self._command_enabled(self.cmds[x], guild_id)]
         if include_admin:
-            cmd_names = [self.cmds[x].help_oneline() for x in self.cmds]
+            cmd_names = [x.help_oneline() for x in cmds]
         else:
-            cmd_names = [self.cmds[x].help_oneline() for x in self.cmds if not self.cmds[x].admin_only]
+            cmd_names = [x.help_oneline() for x in cmds if not x.admin_only]
 
         return "Available commands:\n```%s```" % "\n".join(cmd_names)
 
     def _nearest_command(self, unrec_cmd_word):
-        sorted_cmd_words = []
-
-        for cmd_word in self.cmds.keys():
-            ratio = SequenceMatcher(None, cmd_word, unrec_cmd_word).ratio()
-            sorted_cmd_words.append((cmd_word, ratio))
-
-        sorted_cmd_words.sort(reverse=True, key=lambda x: x[1])
-        return sorted_cmd_words[0]
+        return self.cmd_index.nearest(unrec_cmd_word)
 
     def process_command(self, channel, author, text):
         """
@@ -459,21 +613,32 @@ class CommandProcessor(object):
 
         :param channel: Discord channel object
         :param author: User object from discord.py, the user who wrote the message
-        :param str text: Command text to parse
+        :param str text: Command text to parse. May be a ParsedMessage, in which case\
+            the text is not parsed again.
 
-        :return: Response to send back to discord
+        :return: Response to send back to discord. If the command handler is a\
+            coroutine function, then a concurrent.futures.Future is returned instead,\
+            which will resolve to the response once the handler has finished running\
+            on the main event loop.
         :rtype: str
         """
-        text = text.strip()
-        if not text.startswith(COMMAND_PREFIX):
+        if not isinstance(text, ParsedMessage):
+            text = ParsedMessage(text)
+
+        if not text.is_command:
             # Not a command, do nothing
             return None
 
-        words = text.lstrip(COMMAND_PREFIX).split()
-        command = words[0].lower().strip()
-        argtext = text.lstrip(COMMAND_PREFIX + command)
+        command = text.command_word
+        argtext = text.arg_text
+
+        # No bot when commands are processed on their own, e.g. in benchmarks
+        guild_id = None if self.bot is None else self.bot.guild_id_for_channel(channel)
+        msg_data = MessageData(channel, author, author.id in self.config.config.discord_admin_users, guild_id)
 
-        msg_data = MessageData(channel, author, author.id in self.config.config.discord_admin_users)
+        if (command in self.cmds) and not self._command_enabled(self.cmds[command], guild_id):
+            return ("Sorry %s, the '%s' command is part of the '%s' plugin, which is not enabled here."
+                    % (author.mention, command, self.cmds[command].owner))
 
         if command in self.cmds:
             if self.cmds[command].admin_only and not msg_data.is_admin:
@@ -483,11 +648,25 @@ class CommandProcessor(object):
 
             # Log received command
             if command != 'cmdhistory':
-                self._log_valid_command(author, text)
+                self._log_valid_command(msg_data, command, argtext)
 
             # Run command handler
-            handler = self.cmds[command].handler
-            return handler(command, argtext, msg_data, self, self.config, self.twitch_monitor)
+            cmd = self.cmds[command]
+            handler_args = (command, argtext, msg_data, self, self.config, self.twitch_monitor)
+
+            try:
+                if not cmd.single_flight:
+                    resp = self._run_handler(cmd, handler_args)
+                else:
+                    key = (command, ' '.join(argtext.split()).lower(), msg_data.is_admin, guild_id)
+                    resp = self._run_shared_handler(cmd, key, handler_args)
+            except CommandTimeoutError:
+                return self._timeout_response(command, author)
+
+            if isinstance(resp, concurrent.futures.Future) and (cmd.timeout_secs is not None):
+                resp = self._timeout_future_response(resp, command, author)
+
+            return resp
 
         nearest, ratio = self._nearest_command(command)
         ret = f"Sorry, I don't recognize the command `{command}`."
@@ -496,6 +675,186 @@ class CommandProcessor(object):
 
         return ret
 
+    def _timeout_response(self, command, author):
+        return ("Sorry %s, the '%s' command took too long and was cancelled, please try again later."
+                % (author.mention, command))
+
+    def _timeout_future_response(self, future, command, author):
+        # Resolves to the timeout response instead of raising CommandTimeoutError
+        ret = concurrent.futures.Future()
+
+        def _on_done(fut):
+            try:
+                ret.set_result(fut.result())
+            except CommandTimeoutError:
+                ret.set_result(self._timeout_response(command, author))
+            except Exception as e:
+                ret.set_exception(e)
+
+        future.add_done_callback(_on_done)
+        return ret
+
+    def _run_handler(self, cmd, handler_args):
+        if cmd.is_async:
+            coro = self._run_async_handler(cmd, handler_args)
+            return asyncio.run_coroutine_threadsafe(coro, main_event_loop)
+
+        if cmd.timeout_secs is None:
+            return self._call_handler(cmd, handler_args)
+
+        return self._run_handler_with_timeout(cmd, handler_args)
+
+    def _call_handler(self, cmd, handler_args):
+        profile = self.profiler.start(cmd.word)
+        token = self.watchdog.begin(cmd.word)
+        start = time.monotonic()
+        error = False
+
+        try:
+            return cmd.handler(*handler_args)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.watchdog.end(token)
+            self._handler_finished(cmd, time.monotonic() - start, error, profile)
+
+    def _run_handler_with_timeout(self, cmd, handler_args):
+        if self.watchdog.abandoned_count() >= MAX_ABANDONED_HANDLERS:
+            logger.warning("too many stuck command handlers, not running '%s'" % cmd.word)
+            raise CommandTimeoutError(cmd.word)
+
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        lock = threading.Lock()
+        state = {"finished": False, "abandoned": False}
+
+        def _handler_task():
+            try:
+                future.set_result(self._call_handler(cmd, handler_args))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with lock:
+                    state["finished"] = True
+                    if state["abandoned"]:
+                        self.watchdog.abandoned_finished()
+
+        thread = threading.Thread(target=_handler_task, name="nedry-cmd-%s" % cmd.word)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            return future.result(cmd.timeout_secs)
+        except concurrent.futures.TimeoutError:
+            if future.done():
+                # Raised by the handler itself
+                raise
+
+        # Handler thread can't be stopped, leave it running and forget about the response
+        with lock:
+            state["abandoned"] = not state["finished"]
+            self.watchdog.timed_out(cmd.word, cmd.timeout_secs, state["abandoned"])
+
+        self.command_stats.record_timeout(cmd.word)
+        raise CommandTimeoutError(cmd.word)
+
+    async def _run_async_handler(self, cmd, handler_args):
+        # Profiling starts and stops on the event loop, so any other coroutines that run
+        # while the handler is waiting will show up in the profile too
+        profile = self.profiler.start(cmd.word)
+        task = asyncio.ensure_future(cmd.handler(*handler_args))
+        token = self.watchdog.begin(cmd.word, task)
+        start = time.monotonic()
+        error = False
+
+        try:
+            if cmd.timeout_secs is None:
+                return await task
+
+            return await asyncio.wait_for(task, cmd.timeout_secs)
+        except asyncio.TimeoutError:
+            if not task.cancelled():
+                # Raised by the handler itself
+                error = True
+                raise
+
+            self.watchdog.timed_out(cmd.word, cmd.timeout_secs)
+            self.command_stats.record_timeout(cmd.word)
+            raise CommandTimeoutError(cmd.word)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.watchdog.end(token)
+            self._handler_finished(cmd, time.monotonic() - start, error, profile)
+
+    def _handler_finished(self, cmd, elapsed_secs, error, profile):
+        self.command_stats.record(cmd.word, elapsed_secs, error)
+        if profile is None:
+            return
+
+        result = self.profiler.finish(cmd.word, profile)
+        if result is not None:
+            report, filename, channel = result
+            logger.info("wrote profile of '%s' command to %s" % (cmd.word, filename))
+            self.bot.send_message(channel, "```%s```\nFull profile data written to %s" % (report, filename))
+
+    def _run_shared_handler(self, cmd, key, handler_args):
+        if cmd.cache_response:
+            self._check_config_generation()
+            resp = self.response_cache.get(key)
+            if resp is not None:
+                return resp
+
+        future, leader = self.single_flight.join(key)
+        if not leader:
+            # Identical command is already running, use its response. This may be on the
+            # event loop (if there are no command worker threads), so don't wait forever.
+            if cmd.is_async:
+                return future
+
+            wait_secs = cmd.timeout_secs
+            if wait_secs is None:
+                wait_secs = DEFAULT_SHARED_WAIT_SECS
+
+            try:
+                return future.result(wait_secs)
+            except concurrent.futures.TimeoutError:
+                if future.done():
+                    # Raised by the handler itself
+                    raise
+
+            raise CommandTimeoutError(cmd.word)
+
+        generation = self.response_cache.generation()
+
+        def _finish(resp, exception):
+            self.single_flight.finish(key, resp, exception)
+            if (exception is None) and cmd.cache_response and isinstance(resp, str):
+                self.response_cache.put(key, resp, generation)
+
+        try:
+            resp = self._run_handler(cmd, handler_args)
+        except Exception as e:
+            _finish(None, e)
+            raise
+
+        if isinstance(resp, concurrent.futures.Future):
+            def _on_done(fut):
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    _finish(None, e)
+                else:
+                    _finish(result, None)
+
+            resp.add_done_callback(_on_done)
+        else:
+            _finish(resp, None)
+
+        return resp
+
     def usage_msg(self, msg, cmd_word):
         ret = msg + "\n\n"
         ret += "For more information see:\n```@%s !help %s```" % (self.bot.client.user.name, cmd_word)
@@ -512,7 +871,8 @@ def cmd_help(cmd_word, args, message, proc, config, twitch_monitor):
     if len(args) == 0:
         return (("See list of available commands below. Use the help command again "
                 "and write another command word after 'help' (e.g. `@%s !help wiki`) "
-                "to get help with a specific command.\n" % bot_name) + proc.help(include_admin=message.is_admin))
+                "to get help with a specific command.\n" % bot_name) + proc.help(include_admin=message.is_admin,
+                                                                           guild_id=message.guild_id))
 
     cmd = args[0].strip()
     if cmd.startswith(COMMAND_PREFIX):
@@ -523,24 +883,66 @@ def cmd_help(cmd_word, args, message, proc, config, twitch_monitor):
 
     return proc.cmds[cmd].help().replace('BotName', bot_name)
 
-def cmd_cmdhistory(cmd_word, args, message, proc, config, twitch_monitor):
-    default_count = False
-    args = args.lower().split()
-
-    if len(args) == 0:
-        count = 25
-        default_count = True
-    else:
+def _parse_since(text):
+    # Parse a relative time (e.g. "30m", "2h", "7d") or a UTC date (e.g. "2024-01-31"),
+    # and return it as a UNIX timestamp, or None if the text can't be parsed
+    units = {"m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+    if text and (text[-1] in units):
         try:
-            count = int(args[0])
+            return time.time() - (float(text[:-1]) * units[text[-1]])
         except ValueError:
-            return "Command expects an integer, cannot convert '%s' to an integer" % args[0]
+            return None
+
+    try:
+        dt = datetime.datetime.strptime(text, "%Y-%m-%d")
+    except ValueError:
+        return None
+
+    return dt.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+def cmd_cmdhistory(cmd_word, args, message, proc, config, twitch_monitor):
+    default_count = True
+    count = 25
+    filters = {}
+
+    for arg in args.lower().split():
+        if arg.startswith("user:"):
+            value = arg[len("user:"):]
+            user_id = utils.parse_mention(value)
+            if user_id is None:
+                try:
+                    user_id = int(value)
+                except ValueError:
+                    return "Please mention a user, or give a user ID, after 'user:' (e.g. 'user:@eknyquist')"
+
+            filters["user_id"] = user_id
+        elif arg.startswith("cmd:"):
+            filters["command"] = arg[len("cmd:"):].lstrip(COMMAND_PREFIX)
+        elif arg.startswith("since:"):
+            since = _parse_since(arg[len("since:"):])
+            if since is None:
+                return "Unable to parse time '%s', use e.g. 'since:2h', 'since:7d' or 'since:2024-01-31'" % arg
+            filters["since"] = since
+        else:
+            try:
+                count = int(arg)
+            except ValueError:
+                return "Command expects an integer, cannot convert '%s' to an integer" % arg
+
+            default_count = False
+
+    history = proc.command_history(count, **filters)
+    if history is None:
+        return "Command logging is not enabled."
+
+    if not history:
+        return "No matching commands found." if filters else "No commands have been logged yet."
 
     # HTTP request can't be larger than 2000 bytes
     max_len = 1600
     ret = ""
-    history = proc.command_history(count)
     actual_count = 0
+    num_found = len(history)
 
     history.reverse()
     for line in history:
@@ -550,9 +952,9 @@ def cmd_cmdhistory(cmd_word, args, message, proc, config, twitch_monitor):
         ret = line + "\n" + ret
         actual_count += 1
 
-    truncated = actual_count < count
+    truncated = actual_count < num_found
 
-    firstline = "Last %s commands" % (actual_count if default_count else count)
+    firstline = "Last %s %scommands" % (actual_count if default_count else num_found, "matching " if filters else "")
 
     if truncated and not default_count:
         firstline += " (exceeded max. message size so only showing last %d)" % actual_count
@@ -599,7 +1001,8 @@ def cmd_addstreamers(cmd_word, args, message, proc, config, twitch_monitor):
     except InvalidTwitchUser as e:
         return str(e)
 
-    config.config.streamers_to_monitor.extend([x.lower() for x in args])
+    with config.lock:
+        config.config.streamers_to_monitor.extend([x.lower() for x in args])
 
     config.save_to_file()
 
@@ -615,18 +1018,19 @@ def cmd_removestreamers(cmd_word, args, message, proc, config, twitch_monitor):
 
     twitch_monitor.remove_usernames(args)
 
-    for name in args:
-        try:
-            config.config.streamers_to_monitor.remove(name.lower())
-        except ValueError:
-            if len(args) == 1:
-                # If removing only one streamer, let the user know if they're trying
-                # to remove a streamer that doesn't exist
-                return "Streamer '%s' is not being monitored, nothing to remove" % args[0]
-            else:
-                # If removing multiple streamers at once, ignore any missing streamers
-                # and just continue without notifying
-                continue
+    with config.lock:
+        for name in args:
+            try:
+                config.config.streamers_to_monitor.remove(name.lower())
+            except ValueError:
+                if len(args) == 1:
+                    # If removing only one streamer, let the user know if they're trying
+                    # to remove a streamer that doesn't exist
+                    return "Streamer '%s' is not being monitored, nothing to remove" % args[0]
+                else:
+                    # If removing multiple streamers at once, ignore any missing streamers
+                    # and just continue without notifying
+                    continue
 
     config.save_to_file()
 
@@ -637,7 +1041,9 @@ def cmd_removestreamers(cmd_word, args, message, proc, config, twitch_monitor):
 
 def cmd_clearallstreamers(cmd_word, args, message, proc, config, twitch_monitor):
     twitch_monitor.clear_usernames()
-    config.config.streamers_to_monitor.clear()
+    with config.lock:
+        config.config.streamers_to_monitor.clear()
+
     config.save_to_file()
 
     return "OK, no streamers are being monitored any more."
@@ -654,7 +1060,9 @@ def cmd_nocompetition(cmd_word, args, message, proc, config, twitch_monitor):
     val = True if val == "true" else False
 
     if val != config.config.silent_when_host_streaming:
-        config.config.silent_when_host_streaming = val
+        with config.lock:
+            config.config.silent_when_host_streaming = val
+
         config.save_to_file()
 
     return ("OK! nocompetition %s. announcements will %sbe made during host's stream" %
@@ -691,7 +1099,9 @@ def cmd_addphrase(cmd_word, args, message, proc, config, twitch_monitor):
     if phrase in config.config.stream_start_messages:
         return "This phrase already exists"
 
-    config.config.stream_start_messages.append(phrase)
+    with config.lock:
+        config.config.stream_start_messages.append(phrase)
+
     config.save_to_file()
 
     return "OK! added the following phrase:\n```%s```" % phrase
@@ -720,8 +1130,9 @@ def cmd_removephrases(cmd_word, args, message, proc, config, twitch_monitor):
 
         phrases_to_remove.append(config.config.stream_start_messages[num - 1])
 
-    for p in phrases_to_remove:
-        config.config.stream_start_messages.remove(p)
+    with config.lock:
+        for p in phrases_to_remove:
+            config.config.stream_start_messages.remove(p)
 
     config.save_to_file()
 
@@ -736,16 +1147,18 @@ def cmd_say(cmd_word, args, message, proc, config, twitch_monitor):
     if len(args) < 1:
         return proc.usage_msg("Give me something to say!", cmd_word)
 
-    proc.bot.send_stream_announcement(" ".join(args))
-    return "OK! message sent to channel '%s'" % config.config.discord_channel_name
+    proc.bot.send_stream_announcement(" ".join(args), message.guild_id)
+    return "OK! message sent to channel '%s'" % proc.bot.guild_config(message.guild_id).discord_channel_name
 
 def cmd_plugins(cmd_word, args, message, proc, config, twitch_monitor):
-    enabled = proc.bot.plugin_manager.enabled_plugins()
-    disabled = proc.bot.plugin_manager.disabled_plugins()
-
-    if (not enabled) and (not disabled):
+    plugins = proc.bot.plugin_manager.enabled_plugins() + proc.bot.plugin_manager.disabled_plugins()
+    if not plugins:
         return "No plugins are loaded"
 
+    # Plugins are enabled and disabled separately for each guild
+    enabled = [x for x in plugins if proc.bot.plugin_enabled_in_guild(x.plugin_name, message.guild_id)]
+    disabled = [x for x in plugins if x not in enabled]
+
     def format_plugin_list(plugins):
         return["[%s] version %s: %s" % (x.plugin_name, x.plugin_version, x.plugin_short_description) for x in plugins]
 
@@ -779,14 +1192,7 @@ def cmd_plugson(cmd_word, args, message, proc, config, twitch_monitor):
             return proc.usage_msg("'%s' is not a valid plugin name" % n,
                                   cmd_word)
 
-    proc.bot.plugin_manager.enable_plugins(plugin_names=args)
-
-    enabled_plugins = [x.plugin_name.lower() for x in proc.bot.plugin_manager.enabled_plugins()]
-    if set(enabled_plugins) != set(config.config.enabled_plugins):
-        # If enabled plugins changed, save changes to config file
-        config.config.enabled_plugins = enabled_plugins
-        config.save_to_file()
-
+    proc.bot.set_plugins_enabled(args, True, message.guild_id)
     return "OK, the following plugins are enabled: %s" % ', '.join(args)
 
 def cmd_plugsoff(cmd_word, args, message, proc, config, twitch_monitor):
@@ -801,14 +1207,7 @@ def cmd_plugsoff(cmd_word, args, message, proc, config, twitch_monitor):
             return proc.usage_msg("'%s' is not a valid plugin name" % n,
                                   cmd_word)
 
-    proc.bot.plugin_manager.disable_plugins(plugin_names=args)
-
-    enabled_plugins = [x.plugin_name.lower() for x in proc.bot.plugin_manager.enabled_plugins()]
-    if set(enabled_plugins) != set(config.config.enabled_plugins):
-        # If enabled plugins changed, save changes to config file
-        config.config.enabled_plugins = enabled_plugins
-        config.save_to_file()
-
+    proc.bot.set_plugins_enabled(args, False, message.guild_id)
     return "OK, the following plugins are disabled: %s" % ', '.join(args)
 
 def cmd_pluginfo(cmd_word, args, message, proc, config, twitch_monitor):
@@ -823,12 +1222,13 @@ def cmd_pluginfo(cmd_word, args, message, proc, config, twitch_monitor):
                               cmd_word)
 
     plugin = proc.bot.plugin_manager.get_plugins_by_name([plugin_name])[0]
+    enabled = proc.bot.plugin_enabled_in_guild(plugin.plugin_name, message.guild_id)
 
     long_desc = plugin.plugin_long_description.strip()
     long_desc = '\n'.join([x.strip() for x in long_desc.split('\n')])
     lines = []
     lines.append("%s %s (%s)" % (plugin.plugin_name, plugin.plugin_version,
-                                 "enabled" if plugin.enabled else "disabled"))
+                                 "enabled" if enabled else "disabled"))
     lines.append("")
     lines.append(plugin.plugin_short_description)
     lines.append("")
@@ -848,23 +1248,26 @@ def cmd_twitchclientid(cmd_word, args, message, proc, config, twitch_monitor):
     if not twitch_monitor.reconnect(new_client_id, new_client_secret):
         return "Unable to connect to twitch using that client ID/secret, are you sure they're right?"
 
-    config.config.twitch_client_id = new_client_id
-    config.config.twitch_client_secret = new_client_secret
+    with config.lock:
+        config.config.twitch_client_id = new_client_id
+        config.config.twitch_client_secret = new_client_secret
+
     config.save_to_file()
 
     return "OK! successfully connected to twitch with your new client ID/secret"
 
 def cmd_announcechannel(cmd_word, args, message, proc, config, twitch_monitor):
     args = args.lower().split()
+    state = proc.bot.guild_state(message.guild_id)
     if len(args) == 0:
-        return "Current stream announcements channel is ```%s```" % config.config.discord_channel_name
+        return "Current stream announcements channel is ```%s```" % state.config.discord_channel_name
 
     channel_name = args[0].strip()
-    if not proc.bot.change_channel(channel_name):
+    if not proc.bot.change_channel(channel_name, message.guild_id):
+        guild_name = "this server" if state.guild is None else state.guild.name
         return ("Couldn't find a discord channel called '%s' in '%s', "
-                "are you sure that's the right name?" % (channel_name, proc.bot.guild.name))
+                "are you sure that's the right name?" % (channel_name, guild_name))
 
-    config.config.discord_channel_name = channel_name
     config.save_to_file()
 
     return "OK! stream announcements will now be sent to the '%s' channel" % channel_name
@@ -883,23 +1286,82 @@ def cmd_timezone(cmd_word, args, message, proc, config, twitch_monitor):
     if tz_obj is None:
         return f"{message.author.mention} Unable to find a timezone matching '{' '.join(args)}'"
 
-    try:
-        del config.config.timezones[str(message.author.id)]
-    except KeyError:
-        pass
+    with config.lock:
+        try:
+            del config.config.timezones[str(message.author.id)]
+        except KeyError:
+            pass
+
+        config.config.timezones[str(message.author.id)] = tz_obj.key
 
-    config.config.timezones[str(message.author.id)] = tz_obj.key
     config.save_to_file()
     return f"{message.author.mention} OK, your timezone is set to:\n```{tz_obj.key}```"
 
-def cmd_info(cmd_word, args, message, proc, config, twitch_monitor):
-    uptime_str = datetime.timedelta(seconds=proc.uptime_seconds())
+def cmd_perf(cmd_word, args, message, proc, config, twitch_monitor):
+    args = args.lower().split()
 
-    enabled = proc.bot.plugin_manager.enabled_plugins()
-    disabled = proc.bot.plugin_manager.disabled_plugins()
+    if args and (args[0] == "reset"):
+        proc.command_stats.reset()
+        return "Command statistics have been reset."
 
-    if (not enabled) and (not disabled):
-        return "No plugins are loaded"
+    if args and (args[0] == "profile"):
+        if len(args) < 2:
+            return proc.usage_msg("Please provide the command you want to profile.", cmd_word)
+
+        command = args[1].lstrip(COMMAND_PREFIX)
+        if command not in proc.cmds:
+            return "No command '%s' to profile" % command
+
+        count = 1
+        if len(args) > 2:
+            try:
+                count = int(args[2])
+            except ValueError:
+                return "Command expects an integer, cannot convert '%s' to an integer" % args[2]
+
+            if count < 1:
+                return "Number of commands to profile must be at least 1"
+
+        proc.profiler.request(command, count, message.channel)
+        return ("Profiling the next %d '%s' command(s), the results will be sent to this channel."
+                % (count, command))
+
+    command = args[0].lstrip(COMMAND_PREFIX) if args else None
+    rows = proc.command_stats.snapshot(command)
+    if not rows:
+        if command is None:
+            return "No commands have been run yet."
+
+        return "The '%s' command has not been run yet." % command
+
+    fmt = "%-16s %7s %6s %8s %9s %9s %9s %9s %9s"
+    lines = [fmt % ("command", "count", "errors", "timeouts", "avg", "p50", "p95", "p99", "max")]
+    for row in rows:
+        lines.append(fmt % (row["command"], row["count"], row["errors"], row["timeouts"], row["avg_ms"],
+                            row["p50_ms"], row["p95_ms"], row["p99_ms"], row["max_ms"]))
+
+    since = datetime.timedelta(seconds=int(time.time() - proc.command_stats.start_time))
+    ret = "Command latency in milliseconds, over the last %s:\n```\n%s\n```" % (since, "\n".join(lines))
+
+    pending = proc.profiler.pending()
+    if pending:
+        ret += "Waiting to profile: %s" % ", ".join(["%s (%d more)" % (c, pending[c]) for c in pending])
+
+    return ret
+
+def cmd_metrics(cmd_word, args, message, proc, config, twitch_monitor):
+    lines = []
+    for section, values in proc.bot.metrics().items():
+        lines.append("%s:" % section)
+        lines.extend(["    %s: %s" % (name, values[name]) for name in values])
+        lines.append("")
+
+    return "Bot metrics:\n```%s```" % '\n'.join(lines)
+
+def _info_details(guild_id, proc, config):
+    plugins = proc.bot.plugin_manager.enabled_plugins() + proc.bot.plugin_manager.disabled_plugins()
+    enabled = [x for x in plugins if proc.bot.plugin_enabled_in_guild(x.plugin_name, guild_id)]
+    disabled = [x for x in plugins if x not in enabled]
 
     def format_plugin_list(plugins, desc):
         return["    [%s] version %s: %s (%s)" % (x.plugin_name, x.plugin_version, x.plugin_short_description, desc) for x in plugins]
@@ -909,39 +1371,58 @@ def cmd_info(cmd_word, args, message, proc, config, twitch_monitor):
     disabled_desc = format_plugin_list(disabled, "disabled")
     plugins_str = '\n'.join(enabled_desc + disabled_desc)
 
-    admin_users = '\n'.join(["    %s (%s)" % (proc.bot.client.get_user(x).name, x) for x in config.config.discord_admin_users])
-    joke_tellers = '\n'.join(["    %s (%s)" % (proc.bot.client.get_user(x).name, x) for x in config.config.discord_joke_tellers])
+    def user_name(user_id):
+        # Users may not be cached if member chunking is not enabled
+        user = proc.bot.client.get_user(user_id)
+        return "unknown user" if user is None else user.name
+
+    admin_users = '\n'.join(["    %s (%s)" % (user_name(x), x) for x in config.config.discord_admin_users])
+    joke_tellers = '\n'.join(["    %s (%s)" % (user_name(x), x) for x in config.config.discord_joke_tellers])
+
+    return (f"Plugins:\n\n{plugins_str}\n\n"
+            f"Admin. users:\n\n{admin_users}\n\n"
+            f"Joke tellers:\n\n{joke_tellers}\n\n")
+
+def cmd_info(cmd_word, args, message, proc, config, twitch_monitor):
+    uptime_str = datetime.timedelta(seconds=proc.uptime_seconds())
+
+    if not (proc.bot.plugin_manager.enabled_plugins() or proc.bot.plugin_manager.disabled_plugins()):
+        return "No plugins are loaded"
+
+    # Everything except the uptime only changes when the config or plugins change
+    details = proc.cached_response(("info", message.guild_id),
+                                   lambda: _info_details(message.guild_id, proc, config))
 
     return (f"```Version: {version}\n"
-               f"Uptime: {uptime_str}\n\n"
-               f"Plugins:\n\n{plugins_str}\n\n"
-               f"Admin. users:\n\n{admin_users}\n\n"
-               f"Joke tellers:\n\n{joke_tellers}\n\n"
-               "```")
+            f"Uptime: {uptime_str}\n\n"
+            f"{details}"
+            "```")
 
 nedry_command_list = [
     # Commands available to everyone
-    Command("help", cmd_help, False, CMD_HELP_HELP),
+    Command("help", cmd_help, False, CMD_HELP_HELP, cache_response=True),
     Command("info", cmd_info, False, CMD_INFO_HELP),
-    Command("quote", cmd_quote, False, CMD_QUOTE_HELP),
+    Command("quote", cmd_quote, False, CMD_QUOTE_HELP, timeout_secs=10.0),
     Command("timezone", cmd_timezone, False, CMD_TIMEZONE_HELP),
 
     # Commands only available to admin users
-    Command("streamers", cmd_streamers, True, CMD_STREAMERS_HELP),
+    Command("streamers", cmd_streamers, True, CMD_STREAMERS_HELP, cache_response=True),
     Command("addstreamers", cmd_addstreamers, True, CMD_ADDSTREAMERS_HELP),
     Command("removestreamers", cmd_removestreamers, True, CMD_REMOVESTREAMERS_HELP),
     Command("clearallstreamers", cmd_clearallstreamers, True, CMD_CLEARALLSTREAMERS_HELP),
-    Command("phrases", cmd_phrases, True, CMD_PHRASES_HELP),
+    Command("phrases", cmd_phrases, True, CMD_PHRASES_HELP, cache_response=True),
     Command("testphrases", cmd_testphrases, True, CMD_TESTPHRASES_HELP),
     Command("addphrase", cmd_addphrase, True, CMD_ADDPHRASE_HELP),
     Command("removephrases", cmd_removephrases, True, CMD_REMOVEPHRASES_HELP),
     Command("nocompetition", cmd_nocompetition, True, CMD_NOCOMPETITION_HELP),
     Command("cmdhistory", cmd_cmdhistory, True, CMD_CMDHISTORY_HELP),
     Command("say", cmd_say, True, CMD_SAY_HELP),
-    Command("plugins", cmd_plugins, True, CMD_PLUGINS_HELP),
+    Command("plugins", cmd_plugins, True, CMD_PLUGINS_HELP, cache_response=True),
     Command("plugson", cmd_plugson, True, CMD_PLUGSON_HELP),
     Command("plugsoff", cmd_plugsoff, True, CMD_PLUGSOFF_HELP),
-    Command("pluginfo", cmd_pluginfo, True, CMD_PLUGINFO_HELP),
+    Command("pluginfo", cmd_pluginfo, True, CMD_PLUGINFO_HELP, cache_response=True),
     Command("twitchclientid", cmd_twitchclientid, True, CMD_TWITCHCLIENTID_HELP),
     Command("announcechannel", cmd_announcechannel, True, CMD_ANNOUNCECHANNEL_HELP),
+    Command("metrics", cmd_metrics, True, CMD_METRICS_HELP),
+    Command("perf", cmd_perf, True, CMD_PERF_HELP),
 ]
@@ -0,0 +1,280 @@
+# Implements a CommandStats class, which keeps counters and latency histograms for
+# each bot command, and a CommandProfiler class, which runs the next few invocations
+# of a command under cProfile.
+
+import cProfile
+import datetime
+import io
+import math
+import os
+import pstats
+import tempfile
+import threading
+import time
+
+# Upper bound of the first latency histogram bucket, in seconds
+HISTOGRAM_MIN_SECS = 0.0001
+
+# Upper bound of each histogram bucket is this much larger than the previous one
+HISTOGRAM_GROWTH = 1.5
+
+# Number of histogram buckets, enough to cover 0.1ms to a little over 2 minutes
+HISTOGRAM_BUCKETS = 36
+
+# Number of functions shown in profile reports
+PROFILE_REPORT_FUNCTIONS = 20
+
+
+class LatencyHistogram(object):
+    """
+    Histogram of latencies with a fixed number of exponentially sized buckets, so
+    that percentiles can be estimated (to within HISTOGRAM_GROWTH) in constant memory.
+    Not thread-safe.
+    """
+    def __init__(self):
+        self.counts = [0] * (HISTOGRAM_BUCKETS + 1)   # Last bucket holds anything larger
+        self.count = 0
+        self.total_secs = 0.0
+        self.max_secs = 0.0
+
+    @staticmethod
+    def _bucket(secs):
+        if secs <= HISTOGRAM_MIN_SECS:
+            return 0
+
+        return min(HISTOGRAM_BUCKETS, int(math.ceil(math.log(secs / HISTOGRAM_MIN_SECS, HISTOGRAM_GROWTH))))
+
+    @staticmethod
+    def _upper_bound(bucket):
+        return HISTOGRAM_MIN_SECS * (HISTOGRAM_GROWTH ** bucket)
+
+    def add(self, secs):
+        self.counts[self._bucket(secs)] += 1
+        self.count += 1
+        self.total_secs += secs
+        self.max_secs = max(self.max_secs, secs)
+
+    def percentile(self, pct):
+        """
+        Estimate a latency percentile
+
+        :param float pct: percentile to get, between 0.0 and 100.0
+
+        :return: estimated latency in seconds, or None if nothing has been added
+        :rtype: float
+        """
+        if self.count == 0:
+            return None
+
+        rank = max(1, int(math.ceil((pct / 100.0) * self.count)))
+        seen = 0
+        for bucket in range(len(self.counts)):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.max_secs, self._upper_bound(bucket))
+
+        return self.max_secs
+
+
+class _CommandCounters(object):
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        self.errors = 0
+        self.timeouts = 0
+
+
+class CommandStats(object):
+    """
+    Counters and latency histograms for each command word. Thread-safe.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._commands = {}   # _CommandCounters objects, keyed by command word
+        self.start_time = time.time()
+
+    def record(self, command, elapsed_secs, error=False):
+        """
+        Record one execution of a command handler
+
+        :param str command: command word
+        :param float elapsed_secs: time taken by the command handler, in seconds
+        :param bool error: True if the command handler raised an exception
+        """
+        with self._lock:
+            counters = self._counters(command)
+            counters.histogram.add(elapsed_secs)
+            if error:
+                counters.errors += 1
+
+    def record_timeout(self, command):
+        """
+        Record a command handler that did not finish within the command's timeout. The\
+        time taken by the handler is recorded separately, by record(), if it finishes.
+
+        :param str command: command word
+        """
+        with self._lock:
+            self._counters(command).timeouts += 1
+
+    def _counters(self, command):
+        counters = self._commands.get(command, None)
+        if counters is None:
+            counters = _CommandCounters()
+            self._commands[command] = counters
+
+        return counters
+
+    def reset(self):
+        with self._lock:
+            self._commands = {}
+            self.start_time = time.time()
+
+    def snapshot(self, command=None):
+        """
+        Get current statistics for all commands, or a single command
+
+        :param str command: command word. If None, all commands are included.
+
+        :return: list of dicts with the keys "command", "count", "errors", "timeouts", "avg_ms",\
+            "p50_ms", "p95_ms", "p99_ms" and "max_ms", sorted by total time spent\
+            in each command, largest first
+        :rtype: list
+        """
+        with self._lock:
+            items = [(c, self._commands[c]) for c in self._commands if (command is None) or (c == command)]
+            items.sort(key=lambda x: x[1].histogram.total_secs, reverse=True)
+
+            ret = []
+            for word, counters in items:
+                hist = counters.histogram
+                empty = hist.count == 0   # Only timeouts so far, no handler has finished
+                ret.append({
+                    "command": word,
+                    "count": hist.count,
+                    "errors": counters.errors,
+                    "timeouts": counters.timeouts,
+                    "avg_ms": 0.0 if empty else round((hist.total_secs / hist.count) * 1000.0, 2),
+                    "p50_ms": 0.0 if empty else round(hist.percentile(50) * 1000.0, 2),
+                    "p95_ms": 0.0 if empty else round(hist.percentile(95) * 1000.0, 2),
+                    "p99_ms": 0.0 if empty else round(hist.percentile(99) * 1000.0, 2),
+                    "max_ms": round(hist.max_secs * 1000.0, 2)
+                })
+
+            return ret
+
+
+class ProfileCapture(object):
+    """
+    Profiling requested for the next few invocations of a single command
+    """
+    def __init__(self, command, count, requested_by):
+        self.command = command
+        self.remaining = count
+        self.invocations = 0
+        self.requested_by = requested_by   # Anything the requester needs to get the report (e.g. channel)
+        self.stats = None
+
+
+class CommandProfiler(object):
+    """
+    Runs the next few invocations of a command under cProfile, and creates a report
+    showing the functions with the largest cumulative time, once all of the requested
+    invocations have finished.
+
+    Only one invocation is profiled at a time, since only one profiler can be active
+    at a time; invocations that start while another is being profiled are not profiled,
+    and don't count towards the number requested.
+    """
+    def __init__(self, output_dir=None):
+        """
+        :param str output_dir: Directory to write profile data to. If None, the system\
+            temporary directory is used.
+        """
+        self.output_dir = tempfile.gettempdir() if output_dir is None else output_dir
+        self._lock = threading.Lock()
+        self._captures = {}   # ProfileCapture objects, keyed by command word
+        self._active = False
+
+    def request(self, command, count, requested_by=None):
+        """
+        Profile the next invocations of a command, replacing any previous request
+        for the same command
+
+        :param str command: command word
+        :param int count: number of invocations to profile
+        :param requested_by: passed back with the report
+        """
+        with self._lock:
+            self._captures[command] = ProfileCapture(command, count, requested_by)
+
+    def pending(self):
+        """
+        :return: dict of number of invocations still to be profiled, keyed by command word
+        :rtype: dict
+        """
+        with self._lock:
+            return {c: self._captures[c].remaining for c in self._captures}
+
+    def start(self, command):
+        """
+        Start profiling an invocation of a command, if requested
+
+        :param str command: command word
+
+        :return: cProfile.Profile object, which has been enabled and must be passed to\
+            finish(), or None if this invocation should not be profiled
+        """
+        with self._lock:
+            capture = self._captures.get(command, None)
+            if (capture is None) or (capture.remaining <= 0) or self._active:
+                return None
+
+            capture.remaining -= 1
+            self._active = True
+
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, command, profile):
+        """
+        Stop profiling an invocation of a command
+
+        :param str command: command word
+        :param profile: value returned by start()
+
+        :return: tuple of the form (report, filename, requested_by) if this was the last\
+            requested invocation, otherwise None. 'report' is a text summary of the\
+            functions with the largest cumulative time, and 'filename' is the name of\
+            the file containing the full profile data, which can be loaded with pstats.
+        :rtype: tuple
+        """
+        profile.disable()
+
+        with self._lock:
+            self._active = False
+            capture = self._captures.get(command, None)
+            if capture is None:
+                return None
+
+            if capture.stats is None:
+                capture.stats = pstats.Stats(profile)
+            else:
+                capture.stats.add(profile)
+
+            capture.invocations += 1
+            if capture.remaining > 0:
+                return None
+
+            del self._captures[command]
+
+        timestamp = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        filename = os.path.join(self.output_dir, "nedry_profile_%s_%s.prof" % (command, timestamp))
+        capture.stats.dump_stats(filename)
+
+        stream = io.StringIO()
+        capture.stats.stream = stream
+        capture.stats.strip_dirs().sort_stats("cumulative").print_stats(PROFILE_REPORT_FUNCTIONS)
+
+        report = "Profile of %d invocations of '%s':\n%s" % (capture.invocations, command, stream.getvalue().strip())
+        return report, filename, capture.requested_by
@@ -0,0 +1,198 @@
+# Implements a CommandWatchdog class, which keeps track of running command handlers
+# and logs the stack of any handler that has been running for too long, so that the
+# call it is stuck in can be found.
+
+import itertools
+import logging
+import sys
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# How often to look for handlers that have been running for too long, as a fraction
+# of the watchdog threshold
+CHECK_INTERVAL_FRACTION = 0.25
+
+
+class RunningHandler(object):
+    """
+    A single command handler invocation being watched by a CommandWatchdog
+    """
+    def __init__(self, command, thread_id, task):
+        self.command = command
+        self.thread_id = thread_id   # Thread running the handler (for async handlers, the event loop)
+        self.task = task             # asyncio.Task running the handler, or None for regular handlers
+        self.start_time = time.monotonic()
+        self.reported = False
+
+
+class CommandWatchdog(object):
+    """
+    Keeps track of all running command handlers, and logs a warning, including the
+    current stack of the handler, for any handler that is still running 'threshold_secs'
+    after it started. Each handler invocation is reported once.
+    """
+    def __init__(self, threshold_secs):
+        """
+        :param float threshold_secs: Handlers running for longer than this are reported.\
+            If 0 or less, handlers are tracked but never reported.
+        """
+        self.threshold_secs = threshold_secs
+
+        self._lock = threading.Lock()
+        self._running = {}   # RunningHandler objects, keyed by token
+        self._tokens = itertools.count()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self._reported = 0
+        self._timeouts = 0
+        self._abandoned = 0
+
+    def start(self):
+        if (self._thread is not None) or (self.threshold_secs <= 0):
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._watchdog_task, name="nedry-cmd-watchdog")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        if self._thread is None:
+            return
+
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def begin(self, command, task=None):
+        """
+        Start watching a command handler. Must be called from the thread that runs the\
+        handler.
+
+        :param str command: command word
+        :param task: asyncio.Task running the handler, if the handler is a coroutine function
+
+        :return: token that must be passed to end() when the handler has finished
+        """
+        handler = RunningHandler(command, threading.get_ident(), task)
+        with self._lock:
+            token = next(self._tokens)
+            self._running[token] = handler
+
+        return token
+
+    def end(self, token):
+        """
+        Stop watching a command handler
+
+        :param token: value returned by begin()
+        """
+        with self._lock:
+            handler = self._running.pop(token, None)
+
+        if (handler is not None) and handler.reported:
+            logger.warning("command '%s' finished after %.1f seconds" %
+                           (handler.command, time.monotonic() - handler.start_time))
+
+    def timed_out(self, command, timeout_secs, abandoned=False):
+        """
+        Record a command handler that did not finish within its timeout
+
+        :param str command: command word
+        :param float timeout_secs: timeout of the command, in seconds
+        :param bool abandoned: True if the handler could not be cancelled, and is still\
+            running on its own thread
+        """
+        with self._lock:
+            self._timeouts += 1
+            if abandoned:
+                self._abandoned += 1
+
+        logger.warning("command '%s' did not finish within %.1f seconds%s" %
+                       (command, timeout_secs, " and is still running" if abandoned else ""))
+
+    def abandoned_finished(self):
+        """
+        Record that a handler which previously timed out, and could not be cancelled,\
+        has finished
+        """
+        with self._lock:
+            self._abandoned -= 1
+
+    def abandoned_count(self):
+        with self._lock:
+            return self._abandoned
+
+    def _format_stack(self, handler):
+        if handler.task is not None:
+            # An async handler that is waiting on something has no thread stack of its
+            # own, show where its coroutine is suspended instead. Task.get_stack() only
+            # shows the outermost coroutine, so follow the chain of awaited coroutines.
+            frames = []
+            coro = handler.task.get_coro()
+            while coro is not None:
+                frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+                if frame is None:
+                    break
+
+                frames.append((frame, frame.f_lineno))
+                coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+
+            if not frames:
+                return "(coroutine has finished)\n"
+
+            return "".join(traceback.StackSummary.extract(frames).format())
+
+        frame = sys._current_frames().get(handler.thread_id, None)
+        if frame is None:
+            return "(thread has exited)\n"
+
+        return "".join(traceback.format_stack(frame))
+
+    def check(self):
+        """
+        Report all handlers that have been running for longer than the threshold, and\
+        have not been reported yet
+        """
+        now = time.monotonic()
+        with self._lock:
+            overdue = [h for h in self._running.values()
+                       if (not h.reported) and ((now - h.start_time) >= self.threshold_secs)]
+            for handler in overdue:
+                handler.reported = True
+                self._reported += 1
+
+        for handler in overdue:
+            logger.warning("command '%s' has been running for %.1f seconds, current stack:\n%s" %
+                           (handler.command, now - handler.start_time, self._format_stack(handler)))
+
+    def metrics(self):
+        """
+        Get a snapshot of watchdog metrics
+
+        :return: dict of metric values, keyed by metric name
+        :rtype: dict
+        """
+        now = time.monotonic()
+        with self._lock:
+            longest = max([now - h.start_time for h in self._running.values()], default=0.0)
+            return {
+                "running": len(self._running),
+                "longest_running_secs": round(longest, 1),
+                "stuck_reports": self._reported,
+                "timeouts": self._timeouts,
+                "abandoned_running": self._abandoned
+            }
+
+    def _watchdog_task(self):
+        interval = self.threshold_secs * CHECK_INTERVAL_FRACTION
+        while not self._stop_event.wait(interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("error checking for stuck command handlers")
@@ -1,8 +1,14 @@
 # Implements a BotConfig class that handles saving/loading the bot .json
 # configuration file from disk.
 
+import copy
+import itertools
+import json
 import logging
+import os
+import tempfile
 import threading
+import time
 import zoneinfo
 
 from versionedobj import VersionedObject, Serializer, migration
@@ -10,8 +16,15 @@ from versionedobj import VersionedObject, Serializer, migration
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Key format for guild configurations in a SharedStateStore
+GUILD_CONFIG_KEY = "guild/%d"
+
+# BotConfig fields that are not shared with other worker processes by
+# BotConfigManager.share_changes()
+UNSHARED_CONFIG_FIELDS = ["version", "guilds"]
+
 class BotConfig(VersionedObject):
-    version = "1.6"
+    version = "1.12"
     twitch_client_id = ""
     twitch_client_secret = ""
     discord_bot_api_token = ""
@@ -31,8 +44,34 @@ class BotConfig(VersionedObject):
     discord_admin_users = []
     discord_joke_tellers = []
     command_log_file = None
+    command_log_max_mb = 10
+    command_log_max_age_days = 30
+    command_log_backup_count = 5
+    command_log_compress = False
+    command_rate_limit_user = [5, 12]
+    command_rate_limit_admin = [30, 120]
+    command_rate_limit_channel = [15, 40]
+    command_rate_limit_commands = {}
+    command_watchdog_secs = 10
     jokes = []
     timezones = {}
+    command_worker_threads = 4
+    command_queue_limit = 1000
+    message_cache_size = 200
+    message_cache_max_mb = 16
+    guilds = {}
+
+
+class GuildConfig(VersionedObject):
+    """
+    Configuration for a single discord guild, other than the guild set by
+    discord_server_id (which uses the fields of the same name in BotConfig)
+    """
+    version = "1.0"
+    discord_channel_name = ""
+    enabled_plugins = []
+    plugin_data = {}
+    jokes = []
 
 @migration(BotConfig, None, "1.0")
 def migrate_none_to_10(attrs):
@@ -70,15 +109,114 @@ def migrate_none_15_to_16(attrs):
     attrs["plugin_data"] = {}
     return attrs
 
+@migration(BotConfig, "1.6", "1.7")
+def migrate_none_16_to_17(attrs):
+    attrs["command_worker_threads"] = 4
+    attrs["command_queue_limit"] = 1000
+    return attrs
+
+@migration(BotConfig, "1.7", "1.8")
+def migrate_none_17_to_18(attrs):
+    attrs["message_cache_size"] = 200
+    attrs["message_cache_max_mb"] = 16
+    return attrs
+
+@migration(BotConfig, "1.8", "1.9")
+def migrate_none_18_to_19(attrs):
+    attrs["guilds"] = {}
+    return attrs
+
+@migration(BotConfig, "1.9", "1.10")
+def migrate_none_19_to_110(attrs):
+    attrs["command_log_max_mb"] = 10
+    attrs["command_log_max_age_days"] = 30
+    attrs["command_log_backup_count"] = 5
+    attrs["command_log_compress"] = False
+    return attrs
+
+@migration(BotConfig, "1.10", "1.11")
+def migrate_none_110_to_111(attrs):
+    attrs["command_rate_limit_user"] = [5, 12]
+    attrs["command_rate_limit_admin"] = [30, 120]
+    attrs["command_rate_limit_channel"] = [15, 40]
+    attrs["command_rate_limit_commands"] = {}
+    return attrs
+
+@migration(BotConfig, "1.11", "1.12")
+def migrate_none_111_to_112(attrs):
+    attrs["command_watchdog_secs"] = 10
+    return attrs
+
 
 class BotConfigManager(object):
-    SAVE_INTERVAL_SECS = 3600 # 1 hour
+    """
+    Loads and saves the bot configuration file. Once start() has been called, requested
+    saves are written by a background thread, SAVE_DEBOUNCE_SECS after the last request,
+    or SAVE_MAX_DELAY_SECS after the first request, whichever comes first, so that a
+    burst of changes is written to the file once.
+
+    Code that changes the configuration (including GuildConfig objects returned by
+    guild_config()) should hold 'lock' while doing so, and then call save_to_file().
+    The background thread holds 'lock' only while it copies the configuration.
+    """
+    SAVE_DEBOUNCE_SECS = 2.0
+    SAVE_MAX_DELAY_SECS = 30.0
+
+    # If the configuration is changed without holding 'lock' while it is being copied,
+    # the copy is taken again after this many seconds
+    SNAPSHOT_RETRY_SECS = 0.5
+
+    # Max. number of times stop() tries to copy the configuration
+    SNAPSHOT_ATTEMPTS = 5
 
     def __init__(self, filename):
         self.filename = filename
         self.config = BotConfig()
         self.serializer = Serializer(self.config)
         self.save_requested = threading.Event()
+        self.lock = threading.RLock()
+
+        self._save_cond = threading.Condition()
+        self._first_request_time = None
+        self._flush_deadline = None
+        self._flush_lock = threading.Lock()
+        self._flush_thread = None
+        self._stopping = False
+
+        self._save_requests = 0
+        self._flushes = 0
+        self._flush_failures = 0
+        self._snapshot_retries = 0
+        self._last_flush_ms = 0.0
+        self._max_flush_ms = 0.0
+        self._last_flush_bytes = 0
+        self._total_flush_bytes = 0
+
+        # Changes every time a save is requested, so that anything derived from the
+        # configuration can tell when it may have changed
+        self.generation = 0
+        self._generations = itertools.count(1)
+
+        # GuildConfig objects that have been loaded from self.config.guilds, keyed by guild ID
+        self._guild_configs = {}
+        self._guild_configs_lock = threading.Lock()
+
+        # When running as one of several worker processes, guild configurations are kept
+        # in a nedry.shared_state.SharedStateStore instead of the config file, and only
+        # one worker writes the config file
+        self.store = None
+        self.write_file = True
+
+        # When running as one of several worker processes, changes to the rest of the
+        # configuration are passed to this function (see share_changes()). Entries as
+        # last shared with, or received from, other workers are kept for comparison,
+        # along with the number of received changes applied so far, and how many had
+        # been applied when each entry was last received.
+        self._share_lock = threading.Lock()
+        self._share_func = None
+        self._shared_entries = None
+        self._applied_count = 0
+        self._applied_at = {}
 
     def load_from_file(self, filename=None):
         if filename is None:
@@ -87,29 +225,302 @@ class BotConfigManager(object):
         logger.debug(f"loading configuration file {filename}")
         return self.serializer.from_file(filename)
 
+    def start(self):
+        """
+        Start the background thread that writes the configuration file when a save
+        is requested. Without it, the file is only written by stop().
+        """
+        if self._flush_thread is not None:
+            return
+
+        self._stopping = False
+        self._flush_thread = threading.Thread(target=self._flush_task, name="nedry-config-flush")
+        self._flush_thread.daemon = True
+        self._flush_thread.start()
+
     def save_to_file(self):
-        self.save_requested.set()
+        now = time.monotonic()
+        with self._save_cond:
+            self.generation = next(self._generations)
+            if not self.save_requested.is_set():
+                self._first_request_time = now
+
+            self._flush_deadline = min(now + self.SAVE_DEBOUNCE_SECS,
+                                       self._first_request_time + self.SAVE_MAX_DELAY_SECS)
+            self._save_requests += 1
+            self.save_requested.set()
+            self._save_cond.notify()
+
         logger.debug("flush to config file requested")
 
+    def _request_retry(self, delay):
+        # Must be called with self._save_cond held
+        if not self.save_requested.is_set():
+            self._first_request_time = time.monotonic()
+            self._flush_deadline = self._first_request_time + delay
+            self.save_requested.set()
+
+    def _flush_delay(self):
+        # Time until requested save should be written, or None if no save requested
+        if not self.save_requested.is_set():
+            return None
+
+        return self._flush_deadline - time.monotonic()
+
+    def _flush_task(self):
+        while True:
+            with self._save_cond:
+                delay = self._flush_delay()
+                while (not self._stopping) and ((delay is None) or (delay > 0.0)):
+                    self._save_cond.wait(delay)
+                    delay = self._flush_delay()
+
+                if self._stopping:
+                    return
+
+            try:
+                self._check_flush_to_file()
+            except Exception:
+                logger.exception("failed to write config file %s" % self.filename)
+
+    def _snapshot(self):
+        # Must be called with self.lock held. Serializer.to_dict() shares dicts and lists
+        # with the configuration, so the configuration is copied by encoding it as compact
+        # JSON, which is quick. Decoding, formatting and writing are done without the lock.
+        # Returns (config JSON, guild config JSON keyed by guild ID).
+        guild_configs = {guild_id: json.dumps(Serializer(guild_config).to_dict())
+                         for guild_id, guild_config in self.loaded_guild_configs().items()}
+
+        return json.dumps(self.serializer.to_dict(self.config)), guild_configs
+
+    def share_changes(self, share_func):
+        """
+        Share changes to the configuration with other worker processes, which should\
+        pass them to apply_shared_changes(). Fields that are dicts are shared one key at\
+        a time, so that different workers can change different keys (e.g. the timezones\
+        of different users) at the same time. Other fields are shared whole. Guild\
+        configurations are not shared, they are kept in a SharedStateStore instead.
+
+        :param share_func: Called on the config flush thread with (changed entries,\
+            removed entries) whenever the configuration is saved and entries have changed\
+            since the last call, or since they were received from another worker. Changed\
+            entries are a dict of values keyed by entry, removed entries are a list of\
+            entries. Each entry is a tuple of (field name,) or (field name, dict key). If\
+            None, changes are not shared.
+        """
+        with self.lock:
+            config_data = json.loads(json.dumps(self.serializer.to_dict(self.config)))
+
+        with self._share_lock:
+            self._share_func = share_func
+            self._shared_entries = None if share_func is None else self._config_entries(config_data)
+            self._applied_at = {}
+
+    def _config_entries(self, config_data):
+        entries = {}
+        for name, value in config_data.items():
+            if name in UNSHARED_CONFIG_FIELDS:
+                continue
+
+            if isinstance(value, dict):
+                for key, item in value.items():
+                    entries[(name, key)] = item
+            else:
+                entries[(name,)] = value
+
+        return entries
+
+    def _share_entry_changes(self, config_data, applied_count):
+        # 'applied_count' is the value of self._applied_count when the snapshot was
+        # taken. Entries received from other workers since then are newer than the
+        # snapshot, so they are not compared.
+        entries = self._config_entries(config_data)
+
+        with self._share_lock:
+            if self._share_func is None:
+                return
+
+            current = lambda e: self._applied_at.get(e, 0) <= applied_count
+            changed = {e: v for e, v in entries.items() if current(e) and
+                       ((e not in self._shared_entries) or (self._shared_entries[e] != v))}
+            removed = [e for e in self._shared_entries if (e not in entries) and current(e)]
+            if (not changed) and (not removed):
+                return
+
+            self._shared_entries.update(changed)
+            for entry in removed:
+                del self._shared_entries[entry]
+
+            try:
+                self._share_func(changed, removed)
+            except Exception:
+                logger.exception("failed to share config changes")
+
+    def apply_shared_changes(self, changed, removed):
+        """
+        Apply configuration changes received from another worker process, and request\
+        a save
+
+        :param dict changed: changed entries, as passed to the share_changes() function
+        :param list removed: removed entries, as passed to the share_changes() function
+        """
+        with self.lock, self._share_lock:
+            self._applied_count += 1
+
+            for entry, value in changed.items():
+                if len(entry) == 2:
+                    getattr(self.config, entry[0])[entry[1]] = value
+                else:
+                    setattr(self.config, entry[0], value)
+
+                if self._shared_entries is not None:
+                    # Value in the config may be changed in place later, keep a copy
+                    self._shared_entries[entry] = copy.deepcopy(value)
+                    self._applied_at[entry] = self._applied_count
+
+            for entry in removed:
+                if len(entry) != 2:
+                    # Fields are never removed, only dict keys
+                    continue
+
+                getattr(self.config, entry[0]).pop(entry[1], None)
+                if self._shared_entries is not None:
+                    self._shared_entries.pop(entry, None)
+                    self._applied_at[entry] = self._applied_count
+
+        self.save_to_file()
+
+    def _write_file(self, data):
+        # Write to a temporary file in the same directory and rename it over the old
+        # file, so a crash while writing never leaves a partially written config file
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix=os.path.basename(self.filename) + ".",
+                                            suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+                fh.flush()
+                os.fsync(fh.fileno())
+
+            if os.path.exists(self.filename):
+                os.chmod(tmp_filename, os.stat(self.filename).st_mode & 0o777)
+
+            os.replace(tmp_filename, self.filename)
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+
+        if os.name == 'posix':
+            # Make sure the rename itself is on disk
+            dir_fd = os.open(dirname, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
     def _check_flush_to_file(self):
-        # If save was requested, flush current config data to file
-        if self.save_requested.is_set():
-            # Serialize to JSON string first (instead of serializing directly
-            # into the file), if there is an exception raised when serializing
-            # we don't want to blow away the old config data.
-            json_str = self.serializer.to_json(self.config, indent=4)
-
-            with open(self.filename, 'w') as fh:
-                fh.write(json_str)
-
-            self.save_requested.clear()
-            logger.debug(f"flushed new config to {self.filename}")
-        else:
-            logger.debug("No config changes to flush")
+        # If save was requested, copy the configuration and write it to file. Returns
+        # False if the configuration could not be copied, and will be copied again later.
+        with self._flush_lock:
+            with self._save_cond:
+                if not self.save_requested.is_set():
+                    logger.debug("No config changes to flush")
+                    return True
+
+                # Changes made from here on request another save
+                self.save_requested.clear()
+
+            try:
+                with self.lock:
+                    config_json, guild_configs = self._snapshot()
+                    applied_count = self._applied_count
+            except RuntimeError:
+                # Something changed the configuration without holding self.lock
+                logger.debug("config changed while taking snapshot, retrying")
+                with self._save_cond:
+                    self._snapshot_retries += 1
+                    self._request_retry(self.SNAPSHOT_RETRY_SECS)
+
+                return False
+
+            data = b""
+            start = time.monotonic()
+            try:
+                config_data = json.loads(config_json)
+                self._share_entry_changes(config_data, applied_count)
+
+                if self.store is not None:
+                    self.store.set_many({GUILD_CONFIG_KEY % guild_id: json.loads(attrs)
+                                         for guild_id, attrs in guild_configs.items()})
+                else:
+                    # Loaded guild configurations are saved in the "guilds" field
+                    for guild_id, attrs in guild_configs.items():
+                        config_data["guilds"][str(guild_id)] = json.loads(attrs)
+
+                if self.write_file:
+                    data = json.dumps(config_data, indent=4).encode('utf-8')
+                    self._write_file(data)
+            except Exception:
+                with self._save_cond:
+                    self._flush_failures += 1
+
+                    # Try again later, unless more changes are made before then
+                    self._request_retry(self.SAVE_MAX_DELAY_SECS)
+
+                raise
+
+            flush_ms = (time.monotonic() - start) * 1000.0
+            with self._save_cond:
+                self._flushes += 1
+                self._last_flush_ms = flush_ms
+                self._max_flush_ms = max(self._max_flush_ms, flush_ms)
+                self._last_flush_bytes = len(data)
+                self._total_flush_bytes += len(data)
+
+            if not self.write_file:
+                logger.debug(f"flushed guild configs to shared state store ({flush_ms:.1f}ms)")
+            else:
+                logger.debug(f"flushed new config to {self.filename} ({len(data)} bytes, {flush_ms:.1f}ms)")
+
+            return True
+
+    def metrics(self):
+        """
+        Get a snapshot of config file flush metrics
+
+        :return: dict of metric values, keyed by metric name
+        :rtype: dict
+        """
+        with self._save_cond:
+            return {
+                "save_requests": self._save_requests,
+                "flushes": self._flushes,
+                "failures": self._flush_failures,
+                "snapshot_retries": self._snapshot_retries,
+                "pending": self.save_requested.is_set(),
+                "last_flush_ms": round(self._last_flush_ms, 2),
+                "max_flush_ms": round(self._max_flush_ms, 2),
+                "last_flush_bytes": self._last_flush_bytes,
+                "total_flush_bytes": self._total_flush_bytes
+            }
 
     def stop(self):
         logger.debug("Stopping")
-        self._check_flush_to_file()
+        if self._flush_thread is not None:
+            with self._save_cond:
+                self._stopping = True
+                self._save_cond.notify()
+
+            self._flush_thread.join()
+            self._flush_thread = None
+
+        # Write any changes that were still waiting for the debounce time
+        for _ in range(self.SNAPSHOT_ATTEMPTS):
+            if self._check_flush_to_file():
+                break
+        else:
+            logger.error("config kept changing while being saved, %s was not written" % self.filename)
 
     def timezone_by_discord_user_id(self, discord_user_id):
         tz_info = None
@@ -118,3 +529,67 @@ class BotConfigManager(object):
             tz_info = zoneinfo.ZoneInfo(tz_name)
 
         return tz_info
+
+    def guild_config(self, guild_id):
+        """
+        Get the configuration for a discord guild. Configuration for guilds other than
+        the main guild (discord_server_id) is only deserialized the first time it is
+        requested, and is created with the main guild's enabled plugins if it does not
+        exist yet.
+
+        :param int guild_id: discord guild ID. If None, or the ID of the main guild,\
+            the main BotConfig object is returned.
+
+        :return: BotConfig or GuildConfig object. Both have the same discord_channel_name,\
+            enabled_plugins, plugin_data and jokes attributes.
+        """
+        if (guild_id is None) or (guild_id == self.config.discord_server_id):
+            return self.config
+
+        with self._guild_configs_lock:
+            guild_config = self._guild_configs.get(guild_id, None)
+            if guild_config is None:
+                guild_config = GuildConfig()
+                if self.store is None:
+                    attrs = self.config.guilds.get(str(guild_id), None)
+                else:
+                    attrs = self.store.get(GUILD_CONFIG_KEY % guild_id, None)
+
+                if attrs is None:
+                    guild_config.enabled_plugins = list(self.config.enabled_plugins)
+                else:
+                    Serializer(guild_config).from_dict(attrs)
+
+                self._guild_configs[guild_id] = guild_config
+
+            return guild_config
+
+    def loaded_guild_configs(self):
+        """
+        Get all guild configurations that have been loaded so far, not including the
+        main guild
+
+        :return: dict of GuildConfig objects, keyed by guild ID
+        :rtype: dict
+        """
+        with self._guild_configs_lock:
+            return dict(self._guild_configs)
+
+    def copy_guild_configs_to_store(self, store):
+        """
+        Copy all guild configurations from the config file into a shared state store,
+        skipping any guilds that already have a configuration in the store
+
+        :param store: nedry.shared_state.SharedStateStore instance
+
+        :return: number of guild configurations copied
+        :rtype: int
+        """
+        items = {}
+        for guild_id, attrs in self.config.guilds.items():
+            key = GUILD_CONFIG_KEY % int(guild_id)
+            if store.get(key, None) is None:
+                items[key] = attrs
+
+        store.set_many(items)
+        return len(items)
@@ -2,13 +2,25 @@
 # with discord's bot API
 import discord
 import asyncio
+import concurrent.futures
 import logging
 import random
 import threading
 
-from nedry.command_processor import CommandProcessor, nedry_command_list, COMMAND_PREFIX
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+from nedry.command_processor import CommandProcessor, nedry_command_list
+from nedry.command_executor import CommandExecutor
+from nedry.outbound import OutboundQueue
+from nedry.guild_state import GuildState
+from nedry.message_cache import MessageCache
+from nedry.launcher import shard_for_guild
 from nedry.event_types import EventType
-from nedry import events, utils
+from nedry import events, utils, parsed_message
 
 
 logger = logging.getLogger(__name__)
@@ -16,6 +28,23 @@ logger.setLevel(logging.INFO)
 
 main_event_loop = asyncio.get_event_loop()
 
+# Gateway intents needed by the bot itself, regardless of which plugins are enabled
+CORE_GATEWAY_INTENTS = ["guilds", "guild_messages", "dm_messages"]
+
+# Gateway intent needed for each discord.MemberCacheFlags flag
+MEMBER_CACHE_FLAG_INTENTS = {
+    "online": "presences",
+    "voice": "voice_states",
+    "joined": "members"
+}
+
+
+def _on_main_event_loop():
+    try:
+        return asyncio.get_running_loop() is main_event_loop
+    except RuntimeError:
+        return False
+
 
 class MessageResponse(object):
     """
@@ -36,25 +65,43 @@ class DiscordBot(object):
     Wraps some interactions with the discord bot API, handles running the
     CommandProcessor when commands are received from discord messages
     """
-    def __init__(self, config, twitch_monitor):
+    def __init__(self, config, twitch_monitor, client=None, shard_ids=None, shard_count=None):
+        """
+        :param config: BotConfigManager instance
+        :param twitch_monitor: TwitchMonitor instance
+        :param client: Client object to use for talking to discord. If None, a new\
+            discord.Client will be created by run(). Any object with the same interface may be\
+            used instead, e.g. nedry.fake_discord.FakeClient for running with no network.
+        :param list shard_ids: IDs of the gateway shards this bot should connect, when\
+            running as one of several worker processes (see nedry.launcher). If None, the\
+            bot connects a single shard that sees all guilds.
+        :param int shard_count: Total number of shards, across all worker processes.\
+            Required if shard_ids is set.
+        """
         self.message_limit = 1600
         self.token = config.config.discord_bot_api_token
         self.guild_id = config.config.discord_server_id
-        self.channel_name = config.config.discord_channel_name
         self.config = config
 
-        #intents = discord.Intents.default()
-        #intents.members = True
-        #intents.messages = True
-        #intents.message_content = True
-        #intents.guilds = True
-        #intents.guild_messages = True
-        #self.client = discord.Client(intents=intents)
-        self.client = discord.Client(intents=discord.Intents().all())
-        self.guild = None
+        # GuildState objects for all guilds seen so far, keyed by guild ID. The main
+        # guild (self.guild_id) is the one used for DMs and the guild/channel properties.
+        self.guild_states = {}
+
+        # If no client was provided, a discord.Client is created when the bot is run,
+        # after plugins have been enabled, so that it only asks for the gateway intents
+        # that are actually needed
+        self.client = client
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.gateway_intents = None
+        self._gateway_event_counts = {}
         self.cmdprocessor = CommandProcessor(config, self, twitch_monitor, nedry_command_list)
+        self.command_executor = CommandExecutor(config.config.command_worker_threads,
+                                                config.config.command_queue_limit)
+        self.outbound = OutboundQueue(main_event_loop, self.message_limit)
+        self.message_cache = MessageCache(config.config.message_cache_size,
+                                          config.config.message_cache_max_mb * 1024 * 1024)
         self.guild_available = threading.Event()
-        self.channel = None
         self.plugin_manager = None
 
         events.subscribe(EventType.TWITCH_STREAM_STARTED, self._on_twitch_stream_started)
@@ -62,30 +109,46 @@ class DiscordBot(object):
         events.subscribe(EventType.HOST_STREAM_ENDED, self._on_host_stream_ended)
         events.subscribe(EventType.BOT_COMMAND_RECEIVED, self._on_bot_command_received)
         events.subscribe(EventType.BOT_SENDING_MESSAGE, self._on_bot_sending_message)
+        events.set_owner_filter(self._plugin_enabled_for_message)
 
         self._host_streaming = False
 
+        if self.client is not None:
+            self._add_client_event_handlers()
+
+    def _add_client_event_handlers(self):
         @self.client.event
         async def on_guild_unavailable(guild):
             logger.info("disconnected from guild \"%s\"", guild.name)
-            self.guild = None
+            self.guild_state(guild.id).on_unavailable()
 
         @self.client.event
         async def on_guild_available(guild):
             logger.info("connected to guild \"%s\"", guild.name)
+            self._on_guild_available(guild)
+            await events.emit_async(EventType.DISCORD_GUILD_AVAILABLE, guild)
 
-            if self.guild_id == guild.id:
-                self.guild = guild
-
-                self.channel = self.get_channel_by_name(self.channel_name)
+        @self.client.event
+        async def on_guild_channel_create(channel):
+            state = self._indexing_guild_state(channel)
+            if state is not None:
+                state.channels.add(channel)
 
-            if self.channel is None:
-                logger.error("Unable to find discord channel '%s'" % self.channel_name)
+        @self.client.event
+        async def on_guild_channel_delete(channel):
+            state = self._indexing_guild_state(channel)
+            if state is not None:
+                state.channels.remove(channel)
 
-            self.guild_available.set()
+        @self.client.event
+        async def on_guild_channel_update(before, after):
+            state = self._indexing_guild_state(after)
+            if state is not None:
+                state.channels.add(after)
 
         @self.client.event
         async def on_connect():
+            parsed_message.set_bot_mentions([self.mention(), self.nickmention()])
             self.on_connect()
 
         @self.client.event
@@ -94,82 +157,253 @@ class DiscordBot(object):
 
         @self.client.event
         async def on_member_join(member):
-            self.on_member_join(member)
+            await self.on_member_join(member)
+
+        @self.client.event
+        async def on_message_edit(before, after):
+            self.message_cache.update(after)
+
+        @self.client.event
+        async def on_raw_message_delete(payload):
+            self.message_cache.remove(payload.channel_id, payload.message_id)
+
+        @self.client.event
+        async def on_raw_bulk_message_delete(payload):
+            for message_id in payload.message_ids:
+                self.message_cache.remove(payload.channel_id, message_id)
+
+        @self.client.event
+        async def on_socket_response(msg):
+            event_name = msg.get("t", None)
+            if event_name is not None:
+                self._gateway_event_counts[event_name] = self._gateway_event_counts.get(event_name, 0) + 1
 
         @self.client.event
         async def on_message(message):
+            self.message_cache.add(message)
+
             if message.author.id == self.client.user.id:
                 # Ignore messages from ourself
                 return
 
-            if (self.mention() in message.content) or (self.nickmention() in message.content):
-                self.on_mention(message)
+            parsed = parsed_message.parse(message)
+            if parsed.mentions_bot:
+                await self.on_mention(message, parsed)
             else:
-                self.on_message(message)
-
-    async def _send_dm_async(self, member, message):
-        channel = await member.create_dm()
-        await channel.send(message)
+                await self.on_message(message)
 
     def send_dm(self, member, message):
         messages = self._split_message_on_limit(message)
-        for m in messages:
-            asyncio.run_coroutine_threadsafe(self._send_dm_async(member, m), main_event_loop)
+        for i in range(len(messages)):
+            self.outbound.send_dm(member, messages[i], i == (len(messages) - 1))
 
-    def get_channel_by_name(self, name):
-        if self.guild is None:
-            return None
+    @property
+    def guild(self):
+        # discord.py guild object for the main guild, or None if it is not available
+        return self.guild_state(self.guild_id).guild
 
-        for c in self.guild.text_channels:
-            if c.name == name:
-                return c
+    @property
+    def channel(self):
+        # Stream announcements channel for the main guild
+        return self.guild_state(self.guild_id).channel
 
-        return None
+    @property
+    def channels(self):
+        # ChannelIndex for the main guild
+        return self.guild_state(self.guild_id).channels
 
-    def _channel_response(self, channel, resp):
-        self.send_message(channel, resp.response_data)
+    def guild_state(self, guild_id=None):
+        """
+        Get the runtime state for a guild, creating it if this guild has not been seen yet
 
-    def _split_message_on_limit(self, message):
-        msgs = []
-        code_marker_count = 0
-        current_message = ""
-        inside_code_marker = False
+        :param int guild_id: discord guild ID. If None, the main guild is used.
+
+        :return: state for the guild
+        :rtype: nedry.guild_state.GuildState
+        """
+        if guild_id is None:
+            guild_id = self.guild_id
+
+        state = self.guild_states.get(guild_id, None)
+        if state is None:
+            state = self.guild_states.setdefault(guild_id, GuildState(guild_id, self.guild_config(guild_id)))
+
+        return state
 
-        for line in message.split("\n"):
-            if len(current_message) + len(line) > self.message_limit:
-                # This line would exceed message limit, time for a new message
-                if (code_marker_count % 6) != 0:
-                    inside_code_marker = not inside_code_marker
+    def guild_config(self, guild_id=None):
+        """
+        Get the configuration for a guild. The main guild uses the top-level fields of
+        the bot configuration, and every other guild has its own GuildConfig.
+
+        :param int guild_id: discord guild ID. If None, the main guild is used.
+
+        :return: BotConfig or GuildConfig object
+        """
+        if (guild_id is None) or (guild_id == self.guild_id):
+            return self.config.config
+
+        return self.config.guild_config(guild_id)
+
+    def handles_guild(self, guild_id=None):
+        """
+        Check if this bot receives events for a guild. Always True unless the bot is one\
+        of several worker processes (see nedry.launcher), each connecting some of the shards.
+
+        :param int guild_id: discord guild ID. If None, the main guild is used.
+
+        :return: True if the guild is on one of the shards this bot connects
+        :rtype: bool
+        """
+        if guild_id is None:
+            guild_id = self.guild_id
 
-                code_marker_count = 0
+        if self.shard_ids is None:
+            return True
 
-                if inside_code_marker:
-                    current_message += '\n```'
+        return shard_for_guild(guild_id, self.shard_count) in self.shard_ids
 
-                msgs.append(current_message)
-                current_message = "```" + line + '\n'
-                continue
+    def guild_id_for_channel(self, channel):
+        """
+        Get the ID of the guild a channel belongs to. DM channels belong to the main guild.
+
+        :param channel: discord.py channel object
+
+        :return: discord guild ID
+        :rtype: int
+        """
+        guild = getattr(channel, "guild", None)
+        if guild is None:
+            return self.guild_id
+
+        return guild.id
+
+    def plugin_enabled_in_guild(self, plugin_name, guild_id=None):
+        """
+        Check whether a plugin is enabled in a specific guild
+
+        :param str plugin_name: plugin name
+        :param int guild_id: discord guild ID. If None, the main guild is used.
+
+        :return: True if plugin is enabled in the guild
+        :rtype: bool
+        """
+        plugin_name = plugin_name.lower()
+        for name in self.guild_config(guild_id).enabled_plugins:
+            if name.lower() == plugin_name:
+                return True
+
+        return False
+
+    def _plugin_enabled_for_message(self, plugin_name, message):
+        return self.plugin_enabled_in_guild(plugin_name, self.guild_id_for_channel(message.channel))
+
+    def set_plugins_enabled(self, plugin_names, enabled, guild_id=None):
+        """
+        Enable or disable plugins in a single guild. Plugins are opened when they are
+        enabled in any guild, and closed once they are not enabled in any guild.
+
+        :param list plugin_names: names of plugins to enable or disable
+        :param bool enabled: True to enable plugins, False to disable them
+        :param int guild_id: discord guild ID. If None, the main guild is used.
+        """
+        plugin_names = [n.lower() for n in plugin_names]
+        guild_config = self.guild_config(guild_id)
+
+        names = [n.lower() for n in guild_config.enabled_plugins if n.lower() not in plugin_names]
+        if enabled:
+            names.extend(plugin_names)
+
+        if set(names) != set([n.lower() for n in guild_config.enabled_plugins]):
+            with self.config.lock:
+                guild_config.enabled_plugins = names
+
+            self.config.save_to_file()
+
+        if enabled:
+            self.plugin_manager.enable_plugins(plugin_names)
+        else:
+            in_use = set()
+            for state in list(self.guild_states.values()) + [self.guild_state(self.guild_id)]:
+                in_use.update([n.lower() for n in state.config.enabled_plugins])
+
+            self.plugin_manager.disable_plugins([n for n in plugin_names if n not in in_use])
+
+        self.cmdprocessor.response_cache.invalidate()
+
+    def _on_guild_available(self, guild):
+        state = self.guild_state(guild.id)
+        state.on_available(guild)
+
+        if state.channel is None:
+            if state.config.discord_channel_name or (guild.id == self.guild_id):
+                logger.error("Unable to find discord channel '%s' in guild \"%s\"" %
+                             (state.config.discord_channel_name, guild.name))
+
+        if guild.id == self.guild_id:
+            self.guild_available.set()
+        elif self.plugin_manager is not None:
+            # Open any plugins that are only enabled in this guild
+            self.plugin_manager.enable_plugins([n.lower() for n in state.config.enabled_plugins])
+
+    def _indexing_guild_state(self, channel):
+        # Only text channels are indexed, same as guild.text_channels. Returns the
+        # state for the channel's guild, or None if the channel should not be indexed.
+        if channel.type not in (discord.ChannelType.text, discord.ChannelType.news):
+            return None
+
+        state = self.guild_states.get(channel.guild.id, None)
+        if (state is None) or (not state.is_available()):
+            return None
+
+        return state
+
+    def get_channel_by_name(self, name, guild_id=None):
+        """
+        Get a text channel by name
+
+        :param str name: channel name
+        :param int guild_id: discord guild ID. If None, the main guild is used.
+
+        :return: discord.py channel object, or None if there is no channel with this name
+        """
+        state = self.guild_state(guild_id)
+        if not state.is_available():
+            return None
+
+        return state.channels.get_by_name(name)
+
+    def get_channel_by_id(self, channel_id, guild_id=None):
+        """
+        Get a text channel by ID
 
-            code_marker_count += line.count('```')
+        :param int channel_id: channel ID
+        :param int guild_id: discord guild ID. If None, the main guild is used.
 
-            if current_message == "```":
-                line = line.lstrip()
+        :return: discord.py channel object, or None if there is no channel with this ID
+        """
+        state = self.guild_state(guild_id)
+        if not state.is_available():
+            return None
 
-            current_message += line + "\n"
+        return state.channels.get_by_id(channel_id)
 
-        if current_message:
-            msgs.append(current_message)
+    def _channel_response(self, channel, resp):
+        self.send_message(channel, resp.response_data)
 
-        return msgs
+    def _split_message_on_limit(self, message):
+        return utils.split_message(message, self.message_limit)
 
-    def change_channel(self, new_channel_name):
+    def change_channel(self, new_channel_name, guild_id=None):
         name = new_channel_name.strip()
-        chan = self.get_channel_by_name(name)
+        chan = self.get_channel_by_name(name, guild_id)
         if chan is None:
             return False
 
-        self.channel_name = name
-        self.channel = chan
+        state = self.guild_state(guild_id)
+        with self.config.lock:
+            state.config.discord_channel_name = name
+
+        state.channel = chan
         return True
 
     def _on_twitch_stream_started(self, name, url):
@@ -182,7 +416,12 @@ class DiscordBot(object):
         fmt_args.update(utils.bot_fmt_tokens(self))
         fmt_args.update(utils.datetime_fmt_tokens())
         fmtstring = random.choice(self.config.config.stream_start_messages)
-        self.send_stream_announcement(fmtstring.format(**fmt_args))
+        message = fmtstring.format(**fmt_args)
+
+        # Announce in every guild that has an announcements channel
+        for guild_id, state in list(self.guild_states.items()):
+            if state.channel is not None:
+                self.send_stream_announcement(message, guild_id)
 
     def _on_host_stream_started(self):
         self._host_streaming = True
@@ -190,8 +429,10 @@ class DiscordBot(object):
     def _on_host_stream_ended(self):
         self._host_streaming = False
 
-    def add_command(self, cmd_word, cmd_handler, admin_only, helptext):
-        self.cmdprocessor.add_command(cmd_word, cmd_handler, admin_only, helptext)
+    def add_command(self, cmd_word, cmd_handler, admin_only, helptext, cache_response=False,
+                    single_flight=False, timeout_secs=None):
+        self.cmdprocessor.add_command(cmd_word, cmd_handler, admin_only, helptext, cache_response,
+                                      single_flight, timeout_secs)
 
     def remove_command(self, cmd_word):
         self.cmdprocessor.remove_command(cmd_word)
@@ -205,35 +446,251 @@ class DiscordBot(object):
     def nickmention(self):
         return"<@!%d>" % self.client.user.id
 
+    def _enabled_plugins(self):
+        if self.plugin_manager is None:
+            return []
+
+        return self.plugin_manager.enabled_plugins()
+
+    def required_intents(self, plugins=None):
+        """
+        Get the gateway intents, and member cache settings, needed by the bot itself
+        and by a list of plugins
+
+        :param plugins: list of PluginModule instances. If None, all enabled plugins\
+            are used.
+
+        :return: tuple of the form (intents, member_cache_flags, chunk_guilds), where\
+            'intents' is a discord.Intents object, 'member_cache_flags' is a\
+            discord.MemberCacheFlags object, and 'chunk_guilds' is True if all guild\
+            members must be fetched on startup
+        :rtype: tuple
+        """
+        if plugins is None:
+            plugins = self._enabled_plugins()
+
+        intent_names = set(CORE_GATEWAY_INTENTS)
+        cache_flag_names = set()
+        chunk_guilds = False
+
+        for plugin in plugins:
+            intent_names.update(plugin.plugin_intents)
+            cache_flag_names.update(plugin.plugin_member_cache_flags)
+            if plugin.plugin_needs_all_members:
+                chunk_guilds = True
+
+        if chunk_guilds:
+            # Members fetched on startup are only kept if the 'joined' flag is set
+            cache_flag_names.add("joined")
+
+        for name in cache_flag_names:
+            intent_names.add(MEMBER_CACHE_FLAG_INTENTS[name])
+
+        intents = discord.Intents.none()
+        for name in intent_names:
+            setattr(intents, name, True)
+
+        member_cache_flags = discord.MemberCacheFlags.none()
+        for name in cache_flag_names:
+            setattr(member_cache_flags, name, True)
+
+        return intents, member_cache_flags, chunk_guilds
+
+    def missing_intents(self, plugin):
+        """
+        Get the names of any gateway intents needed by a plugin, which the bot did
+        not ask for when it connected to discord
+
+        :param plugin: PluginModule instance
+
+        :return: list of intent names
+        :rtype: list
+        """
+        if self.gateway_intents is None:
+            return []
+
+        intents, _, _ = self.required_intents([plugin])
+        return [name for name, value in intents if value and not getattr(self.gateway_intents, name)]
+
     def run(self):
+        if self.client is None:
+            intents, member_cache_flags, chunk_guilds = self.required_intents()
+            logger.info("connecting with gateway intents: %s" %
+                        ", ".join([name for name, value in intents if value]))
+
+            self.gateway_intents = intents
+            if self.shard_ids is None:
+                self.client = discord.Client(intents=intents, member_cache_flags=member_cache_flags,
+                                             chunk_guilds_at_startup=chunk_guilds)
+            else:
+                logger.info("connecting shards %s of %d" % (self.shard_ids, self.shard_count))
+                self.client = discord.AutoShardedClient(intents=intents, member_cache_flags=member_cache_flags,
+                                                        chunk_guilds_at_startup=chunk_guilds,
+                                                        shard_ids=self.shard_ids,
+                                                        shard_count=self.shard_count)
+            self._add_client_event_handlers()
+
+        self.command_executor.start()
+        self.cmdprocessor.watchdog.start()
         self.client.run(self.token)
 
+    def gateway_metrics(self):
+        """
+        Get counts of events received from the discord gateway, by event name
+
+        :return: dict of event counts, keyed by event name
+        :rtype: dict
+        """
+        ret = dict(self._gateway_event_counts)
+        ret["total"] = sum(self._gateway_event_counts.values())
+
+        if resource is not None:
+            ret["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        return ret
+
     def stop(self):
         logger.debug("Stopping")
-        asyncio.run(self.client.close())
+
+        # Send (or cancel) queued messages while the client is still connected
+        self.outbound.close()
+
+        if self.client is not None:
+            asyncio.run(self.client.close())
+
+        self.command_executor.stop()
         self.cmdprocessor.close()
 
+    def metrics(self):
+        """
+        Get current values of all runtime metrics tracked by the bot
+
+        :return: dict of metric dicts, keyed by section name
+        :rtype: dict
+        """
+        ret = {
+            "command executor": self.command_executor.metrics(),
+            "outbound messages": self.outbound.metrics(),
+            "message cache": self.message_cache.metrics(),
+            "gateway events": self.gateway_metrics()
+        }
+
+        ret["response cache"] = self.cmdprocessor.response_cache.metrics()
+        ret["single flight"] = self.cmdprocessor.single_flight.metrics()
+        ret["command watchdog"] = self.cmdprocessor.watchdog.metrics()
+        ret["config flush"] = self.config.metrics()
+
+        if self.cmdprocessor.rate_limiter.is_enabled():
+            ret["command rate limits"] = self.cmdprocessor.rate_limiter.metrics()
+
+        if self.cmdprocessor.command_log is not None:
+            ret["command log"] = self.cmdprocessor.command_log.metrics()
+
+        return ret
+
     def _on_bot_sending_message(self, channel, message):
         messages = self._split_message_on_limit(message)
-        for m in messages:
-            asyncio.run_coroutine_threadsafe(channel.send(m), main_event_loop)
+        for i in range(len(messages)):
+            self.outbound.send(channel, messages[i], i == (len(messages) - 1))
 
     def send_message(self, channel, message):
         events.emit(EventType.BOT_SENDING_MESSAGE, channel, message)
 
-    def send_stream_announcement(self, message):
-        asyncio.run_coroutine_threadsafe(self.channel.send(message), main_event_loop)
+    def send_stream_announcement(self, message, guild_id=None):
+        self.outbound.send(self.guild_state(guild_id).channel, message)
+
+    async def iter_history(self, channel, limit=100, before=None):
+        """
+        Iterate over messages in a channel's history, newest first. Must be used on the
+        main event loop, e.g. from an async command handler. Messages are fetched from
+        discord one page at a time, as needed, unless enough recent messages are cached.
+
+        Example:
+
+            async for message in bot.iter_history(channel, limit=500):
+                ...
+
+        :param channel: discord.py channel object
+        :param int limit: Max. number of messages to iterate over
+        :param before: Only iterate over messages sent before this message\
+            (discord.py message object) or time (datetime.datetime object)
+        """
+        if before is None:
+            cached = self.message_cache.history(channel.id, limit)
+            if cached is not None:
+                for message in cached:
+                    yield message
+
+                return
+
+        async for message in channel.history(limit=limit, before=before):
+            yield message
+
+    def find_in_history(self, channel, predicate, limit=100, before=None):
+        """
+        Search a channel's history, newest first, for the first message that matches
+        a predicate. May be called from any thread; returns immediately.
+
+        :param channel: discord.py channel object
+        :param predicate: Function that accepts a discord.py message object, and returns\
+            True if the message is the one being searched for. Called on the main event loop.
+        :param int limit: Max. number of messages to search
+        :param before: Only search messages sent before this message or time
+
+        :return: Future which will resolve to the first matching discord.py message\
+            object, or None if no messages matched
+        :rtype: concurrent.futures.Future
+        """
+        async def _find():
+            async for message in self.iter_history(channel, limit, before):
+                if predicate(message):
+                    return message
+
+            return None
+
+        return asyncio.run_coroutine_threadsafe(_find(), main_event_loop)
+
+    def message_history_future(self, channel, limit=20, before=None):
+        """
+        Get the most recent messages in a channel's history. May be called from any
+        thread; returns immediately.
+
+        :param channel: discord.py channel object
+        :param int limit: Max. number of messages to get
+        :param before: Only get messages sent before this message or time
+
+        :return: Future which will resolve to a list of discord.py message objects,\
+            newest first
+        :rtype: concurrent.futures.Future
+        """
+        async def _get_messages():
+            return [m async for m in self.iter_history(channel, limit, before)]
+
+        return asyncio.run_coroutine_threadsafe(_get_messages(), main_event_loop)
 
-    def message_history(self, channel, limit=20):
-        async def _get_messages(chan, lim):
-            return await chan.history(limit=lim).flatten()
+    def message_history(self, channel, limit=20, before=None, timeout=10.0):
+        """
+        Get the most recent messages in a channel's history, blocking until they have
+        been fetched. Must not be called from the main event loop; coroutines should use
+        iter_history instead.
+
+        :param channel: discord.py channel object
+        :param int limit: Max. number of messages to get
+        :param before: Only get messages sent before this message or time
+        :param float timeout: Max. time to wait for messages, in seconds
 
-        fut = asyncio.run_coroutine_threadsafe(_get_messages(channel, limit), main_event_loop)
-        async def _await_fut():
-            await fut
+        :return: list of discord.py message objects, newest first
+        :rtype: list
+        """
+        if before is None:
+            cached = self.message_cache.history(channel.id, limit)
+            if cached is not None:
+                return cached
 
-        asyncio.run_coroutine_threadsafe(_await_fut(), main_event_loop)
-        return fut.result(1)
+        if _on_main_event_loop():
+            raise RuntimeError("message_history would deadlock on the main event loop, use iter_history")
+
+        return self.message_history_future(channel, limit, before).result(timeout)
 
     def on_connect(self):
         pass
@@ -241,8 +698,8 @@ class DiscordBot(object):
     def on_disconnect(self):
         pass
 
-    def on_member_join(self, member):
-        events.emit(EventType.NEW_DISCORD_MEMBER, member)
+    async def on_member_join(self, member):
+        await events.emit_async(EventType.NEW_DISCORD_MEMBER, member)
 
     def _send_processed_response(self, message, resp):
         if resp.channel is not None:
@@ -251,26 +708,68 @@ class DiscordBot(object):
         else:
             raise RuntimeError("malformed response: channel must be set")
 
-    def on_message(self, message):
-        events.emit(EventType.DISCORD_MESSAGE_RECEIVED, message)
+    async def on_message(self, message):
+        await events.emit_async(EventType.DISCORD_MESSAGE_RECEIVED, message)
 
     def _on_bot_command_received(self, discord_message, cmd_msg):
+        allowed, resp = self.cmdprocessor.check_rate_limit(discord_message.channel, discord_message.author, cmd_msg)
+        if not allowed:
+            if resp is not None:
+                self.send_message(discord_message.channel, resp)
+
+            return
+
+        if not self.command_executor.is_running():
+            # No worker threads, run the command handler inline
+            self._run_command(discord_message, cmd_msg)
+            return
+
+        # Commands from the same channel are keyed by channel ID, so that they
+        # are always handled in the order they were received
+        queued = self.command_executor.submit(discord_message.channel.id, self._run_command,
+                                              discord_message, cmd_msg)
+        if not queued:
+            logger.warning("command queue is full, dropping command '%s'" % cmd_msg)
+            self.send_message(discord_message.channel,
+                              "%s Sorry, I'm too busy right now, please try again in a moment" %
+                              discord_message.author.mention)
+
+    def _run_command(self, discord_message, cmd_msg):
         resp = self.cmdprocessor.process_command(discord_message.channel, discord_message.author, cmd_msg)
+        if isinstance(resp, concurrent.futures.Future):
+            # Async command handler is running on the event loop, send the response
+            # when it finishes instead of waiting for it here
+            resp.add_done_callback(lambda fut: self._on_async_command_done(discord_message, fut))
+            return
+
+        self._send_command_response(discord_message, resp)
+
+    def _on_async_command_done(self, discord_message, fut):
+        try:
+            resp = fut.result()
+        except Exception:
+            logger.exception("unhandled exception in async command handler")
+            return
+
+        self._send_command_response(discord_message, resp)
+
+    def _send_command_response(self, discord_message, resp):
         if resp is None:
             return
 
         resp_msg = MessageResponse(resp, channel=discord_message.channel)
         self._send_processed_response(discord_message, resp_msg)
 
-    def on_mention(self, message):
+    async def on_mention(self, message, parsed=None):
         if message.author.id == self.client.user.id:
             # Ignore mentions of ourself from ourself
             return
 
-        msg = message.content.replace(self.mention(), '', 1).strip()
+        if parsed is None:
+            parsed = parsed_message.parse(message)
 
-        if not msg.startswith(COMMAND_PREFIX):
+        if not parsed.is_command:
             # Emit mention event if message is not a command
-            events.emit(EventType.DISCORD_BOT_MENTION, message, msg)
+            await events.emit_async(EventType.DISCORD_BOT_MENTION, message, parsed)
         else:
-            events.emit(EventType.BOT_COMMAND_RECEIVED, message, msg)
+            await events.emit_async(EventType.BOT_COMMAND_RECEIVED, message, parsed)
@@ -0,0 +1,199 @@
+# Implements an EventRecorder class that captures all events seen by a running bot
+# to a JSONL file, so that they can be replayed offline later (see nedry.replay).
+
+import functools
+import json
+import logging
+import queue
+import threading
+import time
+
+from nedry import events, __version__ as version
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+CAPTURE_FORMAT_VERSION = 1
+
+# Record types for discord objects, reduced to plain data
+RECORD_MESSAGE = "msg"
+RECORD_USER = "user"
+RECORD_CHANNEL = "chan"
+RECORD_HEADER = "header"
+
+
+def _timestamp(dt):
+    return None if dt is None else dt.timestamp()
+
+def reduce_user(user):
+    return {
+        "_t": RECORD_USER,
+        "id": user.id,
+        "name": getattr(user, "name", None),
+        "nick": getattr(user, "display_name", None)
+    }
+
+def reduce_channel(channel):
+    guild = getattr(channel, "guild", None)
+    return {
+        "_t": RECORD_CHANNEL,
+        "id": channel.id,
+        "name": getattr(channel, "name", None),
+        "guild": None if guild is None else guild.id
+    }
+
+def reduce_message(message):
+    return {
+        "_t": RECORD_MESSAGE,
+        "id": message.id,
+        "chan": reduce_channel(message.channel),
+        "author": reduce_user(message.author),
+        "content": message.content,
+        "ts": _timestamp(getattr(message, "created_at", None))
+    }
+
+def reduce_event_arg(arg):
+    """
+    Reduce a single event argument to something that can be serialized as JSON.
+    Discord objects are reduced to plain records containing only IDs, names,
+    message text and timestamps.
+
+    :param arg: event argument to reduce
+
+    :return: reduced event argument
+    """
+    if (arg is None) or isinstance(arg, (str, int, float, bool)):
+        return arg
+
+    if hasattr(arg, "content") and hasattr(arg, "author") and hasattr(arg, "channel"):
+        return reduce_message(arg)
+
+    if hasattr(arg, "send") and hasattr(arg, "id") and not hasattr(arg, "create_dm"):
+        return reduce_channel(arg)
+
+    if hasattr(arg, "id") and hasattr(arg, "name"):
+        return reduce_user(arg)
+
+    return repr(arg)
+
+
+def load_capture(filename):
+    """
+    Read all captured events from a capture file
+
+    :param str filename: capture file to read
+
+    :return: list of tuples of the form (time_offset_secs, event_type, event_args)
+    :rtype: list
+    """
+    ret = []
+    with open(filename, 'r') as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+
+            attrs = json.loads(line)
+            if attrs.get("_t", None) == RECORD_HEADER:
+                if attrs["format"] != CAPTURE_FORMAT_VERSION:
+                    raise ValueError("%s: unsupported capture format %s" % (filename, attrs["format"]))
+
+                continue
+
+            ret.append((attrs["t"], attrs["e"], attrs["a"]))
+
+    return ret
+
+
+class EventRecorder(object):
+    """
+    Subscribes to all event types in nedry.events, and writes a compact JSONL
+    record of every emitted event to a file. Event arguments are reduced to plain
+    data on the thread that emitted the event, and records are written to the file
+    from a background thread, so that recording never makes event handlers wait
+    for disk I/O.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.events_recorded = 0
+        self._fh = None
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_time = None
+        self._handlers = {}
+
+    def start(self):
+        """
+        Open the capture file, and start recording events
+        """
+        if self._fh is not None:
+            return
+
+        self._fh = open(self.filename, 'w')
+        self._start_time = time.monotonic()
+        self._queue.put({"_t": RECORD_HEADER, "format": CAPTURE_FORMAT_VERSION,
+                         "nedry": version, "start": time.time()})
+
+        self._thread = threading.Thread(target=self._writer_task, name="nedry-event-capture")
+        self._thread.daemon = True
+        self._thread.start()
+
+        for event_type in events.all_event_types():
+            handler = functools.partial(self._on_event, event_type)
+            self._handlers[event_type] = handler
+
+            # Run first, so that we see the event even if another handler stops it
+            events.subscribe(event_type, handler, first=True)
+
+        logger.info("recording events to %s" % self.filename)
+
+    def stop(self):
+        """
+        Stop recording events, write all recorded events, and close the capture file
+        """
+        for event_type, handler in self._handlers.items():
+            events.unsubscribe(event_type, handler)
+
+        self._handlers = {}
+
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def _writer_task(self):
+        while True:
+            attrs = self._queue.get()
+            if attrs is None:
+                break
+
+            try:
+                self._fh.write(json.dumps(attrs, separators=(',', ':')) + '\n')
+                if self._queue.empty():
+                    # Caught up, write everything so far to the file
+                    self._fh.flush()
+            except OSError:
+                logger.exception("failed to write to capture file %s" % self.filename)
+
+        self._fh.flush()
+
+    def _on_event(self, event_type, *event_args):
+        attrs = {
+            "t": round(time.monotonic() - self._start_time, 6),
+            "e": event_type,
+            "a": [reduce_event_arg(x) for x in event_args]
+        }
+
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(attrs)
+                self.events_recorded += 1
@@ -20,6 +20,9 @@ class EventType(object):
     # Connected to discord server (this sometimes takes a few seconds after startup)
     DISCORD_CONNECTED = 3
 
+    # Discord guild became available, either on startup or after an outage
+    DISCORD_GUILD_AVAILABLE = 4
+
 
     # Events 1000 through 1999 are reserved for twitch-related events
 
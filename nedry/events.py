@@ -1,10 +1,113 @@
+import asyncio
+import heapq
 import logging
+import threading
 
 from nedry.event_types import EventType
+from nedry import parsed_message
+from nedry.plugin import current_plugin_name
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+main_event_loop = asyncio.get_event_loop()
+
+# Default max. time a coroutine handler may run for, before it is cancelled
+DEFAULT_HANDLER_TIMEOUT_SECS = 10.0
+
+# Event types which may be filtered by channel, guild, author and message text.
+# The first argument for all of these events is a discord.py message object.
+MESSAGE_EVENT_TYPES = [
+    EventType.DISCORD_MESSAGE_RECEIVED,
+    EventType.DISCORD_BOT_MENTION,
+    EventType.BOT_COMMAND_RECEIVED
+]
+
+
+class EventFilter(object):
+    """
+    Declarative filter for events in MESSAGE_EVENT_TYPES. A handler subscribed with
+    a filter will only be called for messages that match all of the filter's conditions.
+    """
+    def __init__(self, channel_ids=None, guild_id=None, author_id=None, text_prefix=None):
+        """
+        :param channel_ids: Set of discord channel IDs to match. If None, messages\
+            from any channel will match.
+        :param int guild_id: Discord guild ID to match. If None, messages from any\
+            guild will match.
+        :param int author_id: Discord user ID to match. If None, messages from any\
+            user will match.
+        :param str text_prefix: Message text must start with this string (case-insensitive,\
+            leading whitespace is ignored). For DISCORD_BOT_MENTION and BOT_COMMAND_RECEIVED\
+            events, the text after the bot mention is used. If None, any text will match.
+        """
+        self.channel_ids = None if channel_ids is None else frozenset(channel_ids)
+        self.guild_id = guild_id
+        self.author_id = author_id
+        self.text_prefix = None if text_prefix is None else text_prefix.lower()
+
+    def matches(self, message, text):
+        """
+        Check whether a message matches this filter
+
+        :param message: discord.py message object
+        :param ParsedMessage text: parsed message text
+
+        :return: True if message matches this filter
+        :rtype: bool
+        """
+        if (self.channel_ids is not None) and (message.channel.id not in self.channel_ids):
+            return False
+
+        if self.guild_id is not None:
+            if (message.guild is None) or (message.guild.id != self.guild_id):
+                return False
+
+        if (self.author_id is not None) and (message.author.id != self.author_id):
+            return False
+
+        if (self.text_prefix is not None) and not text.normalized.startswith(self.text_prefix):
+            return False
+
+        return True
+
+
+class Subscription(object):
+    """
+    Represents a single handler subscribed to a single event
+    """
+    def __init__(self, handler, timeout, event_filter, owner=None):
+        self.handler = handler
+        self.timeout = timeout
+        self.event_filter = event_filter
+        self.owner = owner
+        self.is_async = asyncio.iscoroutinefunction(handler)
+
+
+class SubscriptionIndex(object):
+    """
+    Read-only index of all subscriptions for a single event, split by handler type
+    and by channel filter
+    """
+    def __init__(self, subs):
+        self.sync_any_channel = []
+        self.sync_by_channel = {}
+        self.async_any_channel = []
+        self.async_by_channel = {}
+        self.positions = {id(subs[i]): i for i in range(len(subs))}
+
+        for sub in subs:
+            if sub.is_async:
+                any_channel, by_channel = self.async_any_channel, self.async_by_channel
+            else:
+                any_channel, by_channel = self.sync_any_channel, self.sync_by_channel
+
+            if (sub.event_filter is None) or (sub.event_filter.channel_ids is None):
+                any_channel.append(sub)
+            else:
+                for channel_id in sub.event_filter.channel_ids:
+                    by_channel.setdefault(channel_id, []).append(sub)
+
 
 class Event(object):
     """
@@ -12,22 +115,62 @@ class Event(object):
     """
     def __init__(self, event_type):
         self._event_type = event_type
-        self._handlers = []
+        self._subs = []
+        self._lock = threading.Lock()
+
+        # Index of self._subs, rebuilt whenever a handler is added or removed.
+        # Subscriptions with a channel filter are only stored under those channel IDs,
+        # so emitting an event never even looks at handlers for other channels.
+        self._index = SubscriptionIndex([])
+
+    def _find_subscription(self, handler):
+        for sub in self._subs:
+            if sub.handler == handler:
+                return sub
+
+        return None
 
-    def add_handler(self, handler, first=False):
+    def _rebuild_index(self):
+        # Replace the whole index in one assignment, so that threads emitting
+        # this event never see a partially updated index
+        self._index = SubscriptionIndex(self._subs)
+
+    def add_handler(self, handler, first=False, timeout=DEFAULT_HANDLER_TIMEOUT_SECS, event_filter=None,
+                    owner=None):
         """
-        Register a handler to this event
+        Register a handler to this event. If the handler is already registered,
+        its timeout and filter are replaced, and its position is unchanged.
 
-        :param handler: the handler to add
+        :param handler: the handler to add. May be a regular function, or a coroutine\
+            function, in which case it will be run on the main event loop.
         :param bool first: if True, handler will be inserted to the first position\
             of the handler list, so that it runs first when the event is emitted. Otherwise,\
-            handler will be appended to the list.
+            handler will be appended to the list. Has no effect for coroutine handlers,\
+            which are run concurrently.
+        :param float timeout: Max. time in seconds that a coroutine handler may run\
+            for before it is cancelled. Ignored for regular handlers.
+        :param EventFilter event_filter: If set, handler will only run for events\
+            that match this filter.
+        :param str owner: Name of the plugin that owns this handler. If set, handlers for\
+            events in MESSAGE_EVENT_TYPES only run if the owner filter allows it. If None,\
+            and the handler is already registered, the existing owner is kept.
         """
-        if handler not in self._handlers:
-            if first:
-                self._handlers.insert(0, handler)
+        with self._lock:
+            sub = self._find_subscription(handler)
+            if (owner is None) and (sub is not None):
+                owner = sub.owner
+
+            new_sub = Subscription(handler, timeout, event_filter, owner)
+
+            if sub is not None:
+                # Subscriptions may be in use by other threads, replace instead of modifying
+                self._subs[self._subs.index(sub)] = new_sub
+            elif first:
+                self._subs.insert(0, new_sub)
             else:
-                self._handlers.append(handler)
+                self._subs.append(new_sub)
+
+            self._rebuild_index()
 
         return self
 
@@ -37,18 +180,112 @@ class Event(object):
 
         :param handler: the handler to unregister
         """
-        try:
-            self._handlers.remove(handler)
-        except ValueError:
-            pass
+        with self._lock:
+            sub = self._find_subscription(handler)
+            if sub is not None:
+                self._subs.remove(sub)
+                self._rebuild_index()
 
         return self
 
-    def emit(self, *event_args, **event_kwargs):
-        for handler in self._handlers:
-            stop_processing_events = handler(*event_args, **event_kwargs)
+    def _matching_subs(self, index, is_async, event_args):
+        if is_async:
+            any_channel, by_channel = index.async_any_channel, index.async_by_channel
+        else:
+            any_channel, by_channel = index.sync_any_channel, index.sync_by_channel
+
+        if (not any_channel) and (not by_channel):
+            return []
+
+        if self._event_type not in MESSAGE_EVENT_TYPES:
+            # Filters are not allowed for other event types
+            return any_channel
+
+        message = event_args[0]
+        channel_subs = by_channel.get(message.channel.id, None)
+        if channel_subs:
+            # Merge channel-specific handlers with the others, keeping subscription order
+            candidates = heapq.merge(any_channel, channel_subs, key=lambda s: index.positions[id(s)])
+        else:
+            candidates = any_channel
+
+        text = event_args[1] if len(event_args) > 1 else parsed_message.parse(message)
+        owner_filter = _owner_filter
+
+        ret = []
+        for s in candidates:
+            if (s.event_filter is not None) and not s.event_filter.matches(message, text):
+                continue
+
+            if (s.owner is not None) and (owner_filter is not None) and not owner_filter(s.owner, message):
+                continue
+
+            ret.append(s)
+
+        return ret
+
+    def _parsed_args(self, event_args):
+        # Handlers for message events always get the message text as a ParsedMessage,
+        # even if the event was emitted with a plain string (e.g. by replay)
+        if (self._event_type in MESSAGE_EVENT_TYPES) and (len(event_args) > 1):
+            if not isinstance(event_args[1], parsed_message.ParsedMessage):
+                return (event_args[0], parsed_message.ParsedMessage(event_args[1])) + event_args[2:]
+
+        return event_args
+
+    def _run_sync_handlers(self, event_args, event_kwargs):
+        # Returns True if a handler asked to stop processing this event
+        for sub in self._matching_subs(self._index, False, event_args):
+            stop_processing_events = sub.handler(*event_args, **event_kwargs)
             if stop_processing_events:
-                break
+                return True
+
+        return False
+
+    async def _run_async_handler(self, sub, event_args, event_kwargs):
+        try:
+            await asyncio.wait_for(sub.handler(*event_args, **event_kwargs), sub.timeout)
+        except asyncio.TimeoutError:
+            logger.warning("event(%d) handler %s timed out after %.2fs" %
+                           (self._event_type, sub.handler.__qualname__, sub.timeout))
+        except Exception:
+            logger.exception("event(%d) handler %s failed" % (self._event_type, sub.handler.__qualname__))
+
+    async def _run_async_handlers(self, subs, event_args, event_kwargs):
+        await asyncio.gather(*[self._run_async_handler(s, event_args, event_kwargs) for s in subs])
+
+    def emit(self, *event_args, **event_kwargs):
+        """
+        Run all regular handlers in order on the calling thread, and then schedule
+        all coroutine handlers to run concurrently on the main event loop (without
+        waiting for them to finish). If any regular handler returns True, no further
+        handlers (regular or coroutine) are run.
+        """
+        event_args = self._parsed_args(event_args)
+        if self._run_sync_handlers(event_args, event_kwargs):
+            return self
+
+        subs = self._matching_subs(self._index, True, event_args)
+        if subs:
+            asyncio.run_coroutine_threadsafe(self._run_async_handlers(subs, event_args, event_kwargs),
+                                             main_event_loop)
+
+        return self
+
+    async def emit_async(self, *event_args, **event_kwargs):
+        """
+        Run all regular handlers in order, and then run all coroutine handlers
+        concurrently, returning once all coroutine handlers have finished or timed out.
+        If any regular handler returns True, no further handlers (regular or coroutine)
+        are run. Must be awaited on the main event loop.
+        """
+        event_args = self._parsed_args(event_args)
+        if self._run_sync_handlers(event_args, event_kwargs):
+            return self
+
+        subs = self._matching_subs(self._index, True, event_args)
+        if subs:
+            await self._run_async_handlers(subs, event_args, event_kwargs)
 
         return self
 
@@ -57,19 +294,66 @@ _event_typenames = [x for x in dir(EventType) if not callable(getattr(EventType,
 _event_types = [getattr(EventType, x) for x in _event_typenames]
 _events = {x: Event(x) for x in _event_types}
 
+# Function that decides whether a plugin's handlers should run for a message
+_owner_filter = None
+
+
+def all_event_types():
+    """
+    Get all valid event types
+
+    :return: list of all event types from nedry.event_types.EventType
+    :rtype: list
+    """
+    return list(_event_types)
 
-def subscribe(event_type, handler, first=False):
+def set_owner_filter(owner_filter):
     """
-    Subscribe to an event, handler will be called when event is emitted
+    Set the function used to decide whether handlers owned by a plugin should run
+    for a message. Handlers subscribed while a plugin is being opened are owned by
+    that plugin. Only applies to events in MESSAGE_EVENT_TYPES.
+
+    :param owner_filter: Function that accepts a plugin name and a discord.py message\
+        object, and returns False if that plugin's handlers should not run for the message.\
+        If None, all handlers run.
+    """
+    global _owner_filter
+    _owner_filter = owner_filter
+
+def subscribe(event_type, handler, first=False, timeout=DEFAULT_HANDLER_TIMEOUT_SECS,
+              channel_ids=None, guild_id=None, author_id=None, text_prefix=None):
+    """
+    Subscribe to an event, handler will be called when event is emitted. Subscribing
+    a handler that is already subscribed replaces its timeout and filters.
+
+    The channel_ids, guild_id, author_id and text_prefix filters may only be used
+    with events in MESSAGE_EVENT_TYPES. Handlers with a channel_ids filter are indexed
+    by channel ID, so they cost nothing when the event is emitted for other channels.
 
     :param nedry.event_types.EventType event_type: event type to subscribe to
-    :param handler: handler to run when event is emitted
+    :param handler: handler to run when event is emitted. May be a regular function,\
+        or a coroutine function, in which case it will run on the main event loop,\
+        concurrently with any other coroutine handlers for the same event.
     :param bool first: If true, this handler will run before other handlers when event is emitted
+    :param float timeout: Max. time in seconds that a coroutine handler may run for\
+        before it is cancelled. Ignored for regular handlers.
+    :param channel_ids: Only run handler for messages in one of these discord channel IDs
+    :param int guild_id: Only run handler for messages in this discord guild ID
+    :param int author_id: Only run handler for messages written by this discord user ID
+    :param str text_prefix: Only run handler for messages where the text (after any bot\
+        mention) starts with this string, case-insensitive
     """
     if event_type not in _events:
         raise ValueError("Invalid event type (%d)" % event_type)
 
-    _events[event_type].add_handler(handler, first)
+    event_filter = None
+    if (channel_ids, guild_id, author_id, text_prefix) != (None, None, None, None):
+        if event_type not in MESSAGE_EVENT_TYPES:
+            raise ValueError("Event type (%d) does not support filters" % event_type)
+
+        event_filter = EventFilter(channel_ids, guild_id, author_id, text_prefix)
+
+    _events[event_type].add_handler(handler, first, timeout, event_filter, current_plugin_name())
 
 def unsubscribe(event_type, handler):
     """
@@ -94,3 +378,17 @@ def emit(event_type, *event_args, **event_kwargs):
 
     logger.debug("event(%d), %s, %s" % (event_type, event_args, event_kwargs))
     _events[event_type].emit(*event_args, **event_kwargs)
+
+async def emit_async(event_type, *event_args, **event_kwargs):
+    """
+    Emit an event from the main event loop, all handlers will be called with provided
+    args. Regular handlers run first, in order, and then all coroutine handlers run
+    concurrently. Returns once all coroutine handlers have finished or timed out.
+
+    :param nedry.event_types.EventType event_type: event type to emit
+    """
+    if event_type not in _events:
+        raise ValueError("Invalid event type (%d)" % event_type)
+
+    logger.debug("event(%d), %s, %s" % (event_type, event_args, event_kwargs))
+    await _events[event_type].emit_async(*event_args, **event_kwargs)
@@ -0,0 +1,392 @@
+# Implements an in-process stand-in for the parts of discord.py used by nedry, so
+# that DiscordBot can be run end-to-end (on_message -> command processor -> send)
+# with no network connection, e.g. for replaying captured events or benchmarking.
+#
+# Usage:
+#
+#     client = FakeClient()
+#     guild = client.add_guild(1234, "my guild")
+#     channel = client.add_text_channel(guild, 5678, "general")
+#     member = client.add_member(guild, 999, "some_user")
+#     bot = DiscordBot(config, None, client=client)
+#     ...
+#     client.post_message(channel, member, "%s !help" % bot.mention())
+
+import asyncio
+import datetime
+import itertools
+import logging
+import os
+import threading
+import time
+
+import discord
+
+from nedry.discord_bot import DiscordBot, main_event_loop
+from nedry.config import BotConfigManager
+from nedry.plugin import PluginModuleManager
+from nedry.builtin_plugins import builtin_plugin_modules
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+FAKE_BOT_USER_ID = 1
+
+# Max. number of messages kept in each channel's history
+HISTORY_LIMIT = 1000
+
+
+class FakeSentMessage(object):
+    """
+    Record of a single message sent by the bot
+    """
+    def __init__(self, channel, content, send_time, latencies):
+        self.channel = channel
+        self.content = content
+        self.send_time = send_time
+
+        # Time in seconds between receiving each bot mention that this message is
+        # assumed to be in response to, and sending this message. Since the bot merges
+        # queued messages together, a single message may answer many mentions. Filled
+        # in by FakeClient.record_replies.
+        self.latencies = latencies
+
+
+class FakeHistoryIterator(object):
+    """
+    Stand-in for discord.iterators.HistoryIterator
+    """
+    def __init__(self, messages):
+        self._messages = messages
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for message in self._messages:
+            yield message
+
+    async def flatten(self):
+        return list(self._messages)
+
+
+class FakeGuild(object):
+    """
+    Stand-in for discord.Guild
+    """
+    def __init__(self, guild_id, name):
+        self.id = guild_id
+        self.name = name
+        self.text_channels = []
+        self.members = []
+
+    def get_member(self, user_id):
+        for member in self.members:
+            if member.id == user_id:
+                return member
+
+        return None
+
+    def get_channel(self, channel_id):
+        for channel in self.text_channels:
+            if channel.id == channel_id:
+                return channel
+
+        return None
+
+
+class FakeTextChannel(object):
+    """
+    Stand-in for discord.TextChannel. All messages sent to this channel are
+    recorded by the owning FakeClient.
+    """
+    def __init__(self, client, channel_id, name, guild, position=0):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.position = position
+        self.type = discord.ChannelType.text
+        self.mention = "<#%d>" % channel_id
+        self._client = client
+        self._history = []
+
+    def _add_to_history(self, message):
+        self._history.append(message)
+        if len(self._history) > HISTORY_LIMIT:
+            del self._history[:len(self._history) - HISTORY_LIMIT]
+
+    async def send(self, content):
+        message = FakeMessage(self._client.next_message_id(), self, self._client.user, content)
+        self._add_to_history(message)
+        self._client.record_send(self, content)
+        return message
+
+    def history(self, limit=100, before=None):
+        messages = self._history
+        if before is not None:
+            if isinstance(before, datetime.datetime):
+                messages = [m for m in messages if m.created_at < before]
+            else:
+                messages = [m for m in messages if m.id < before.id]
+
+        # Newest messages first, same as discord
+        return FakeHistoryIterator(messages[-limit:][::-1])
+
+
+class FakeDMChannel(FakeTextChannel):
+    """
+    Stand-in for discord.DMChannel
+    """
+    def __init__(self, client, recipient):
+        super(FakeDMChannel, self).__init__(client, recipient.id, "dm-%s" % recipient.name, None)
+        self.type = discord.ChannelType.private
+        self.recipient = recipient
+
+
+class FakeMember(object):
+    """
+    Stand-in for discord.Member and discord.User
+    """
+    def __init__(self, client, user_id, name, nick=None, guild=None, bot=False):
+        self.id = user_id
+        self.name = name
+        self.nick = nick
+        self.display_name = name if nick is None else nick
+        self.guild = guild
+        self.bot = bot
+        self.mention = "<@%d>" % user_id
+        self.dm_channel = None
+        self._client = client
+
+    async def create_dm(self):
+        if self.dm_channel is None:
+            self.dm_channel = FakeDMChannel(self._client, self)
+
+        return self.dm_channel
+
+
+class FakeMessage(object):
+    """
+    Stand-in for discord.Message
+    """
+    def __init__(self, message_id, channel, author, content):
+        self.id = message_id
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.created_at = datetime.datetime.utcnow()
+
+
+class FakeClient(object):
+    """
+    Stand-in for discord.Client. Holds fake guilds, channels and members, delivers
+    fake inbound messages to the registered client event handlers, and records
+    all outbound messages sent by the bot.
+    """
+    def __init__(self):
+        self.user = FakeMember(self, FAKE_BOT_USER_ID, "nedry", bot=True)
+        self.guilds = []
+        self.sent = []
+
+        self._handlers = {}
+        self._users = {}
+        self._channels = {}
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self._pending_mentions = {}
+        self._last_sent = {}     # Last FakeSentMessage sent on each channel, keyed by channel ID
+        self._closed = None
+
+    def event(self, coro):
+        """
+        Register a client event handler, same as discord.Client.event
+        """
+        self._handlers[coro.__name__] = coro
+        return coro
+
+    async def dispatch(self, event_name, *args):
+        """
+        Run the client event handler registered for the given event name, if any
+
+        :param str event_name: event name, e.g. "on_message"
+        """
+        handler = self._handlers.get(event_name, None)
+        if handler is not None:
+            await handler(*args)
+
+    def next_message_id(self):
+        return next(self._message_ids)
+
+    def add_guild(self, guild_id, name):
+        guild = FakeGuild(guild_id, name)
+        self.guilds.append(guild)
+        return guild
+
+    def add_text_channel(self, guild, channel_id, name):
+        channel = FakeTextChannel(self, channel_id, name, guild, len(guild.text_channels))
+        guild.text_channels.append(channel)
+        self._channels[channel_id] = channel
+        return channel
+
+    def add_member(self, guild, user_id, name, nick=None):
+        member = FakeMember(self, user_id, name, nick, guild)
+        if guild is not None:
+            guild.members.append(member)
+
+        self._users[user_id] = member
+        return member
+
+    def get_user(self, user_id):
+        return self._users.get(user_id, None)
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id, None)
+
+    def record_send(self, channel, content):
+        with self._lock:
+            sent = FakeSentMessage(channel, content, time.perf_counter(), [])
+            self.sent.append(sent)
+            self._last_sent[channel.id] = sent
+
+    def record_replies(self, channel, count):
+        """
+        Mark the oldest 'count' pending bot mentions on a channel as replied to by the\
+        last message sent on that channel. Set as the bot's OutboundQueue.sent_callback\
+        by create_offline_bot, so that each reply is counted once it has been sent in\
+        full, even if it was merged with other replies or split into several messages.
+
+        :param channel: channel the message was sent on
+        :param int count: number of complete replies in the message
+        """
+        with self._lock:
+            sent = self._last_sent.get(channel.id, None)
+            pending = self._pending_mentions.get(channel.id, [])
+            if (sent is None) or (not pending) or (count <= 0):
+                return
+
+            answered = pending[:count]
+            del pending[:count]
+            if not pending:
+                del self._pending_mentions[channel.id]
+
+            sent.latencies.extend([sent.send_time - t for t in answered])
+
+    def pending_mentions(self):
+        """
+        Get the number of bot mentions which have not been replied to yet
+        """
+        with self._lock:
+            return sum([len(x) for x in self._pending_mentions.values()])
+
+    def latencies(self, first=0):
+        """
+        Get latencies for all bot mentions that have been replied to
+
+        :param int first: Index in self.sent of the first sent message to include
+
+        :return: list of latencies in seconds
+        :rtype: list
+        """
+        with self._lock:
+            return [x for m in self.sent[first:] for x in m.latencies]
+
+    async def receive_message(self, channel, author, content):
+        """
+        Deliver a fake inbound message to the bot. Messages which mention the bot
+        are remembered, and each complete message sent by the bot on the same channel
+        is assumed to be the reply to the oldest mention that has not been replied to
+        yet (see record_replies). This is only an approximation when replies are sent
+        out of order, or when a mention gets no reply at all.
+
+        :param FakeTextChannel channel: channel the message was sent on
+        :param FakeMember author: message author
+        :param str content: message text
+
+        :return: the new message
+        :rtype: FakeMessage
+        """
+        message = FakeMessage(self.next_message_id(), channel, author, content)
+        channel._add_to_history(message)
+
+        if self.user.mention in content:
+            with self._lock:
+                self._pending_mentions.setdefault(channel.id, []).append(time.perf_counter())
+
+        await self.dispatch("on_message", message)
+        return message
+
+    def post_message(self, channel, author, content):
+        """
+        Same as receive_message, but may be called from any thread
+
+        :return: Future for the new message
+        :rtype: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(self.receive_message(channel, author, content),
+                                                main_event_loop)
+
+    async def start(self, token=None):
+        """
+        "Connect", and make all guilds available. Returns when close() is called.
+        """
+        self._closed = asyncio.Event()
+        await self.dispatch("on_connect")
+        for guild in self.guilds:
+            await self.dispatch("on_guild_available", guild)
+
+        await self._closed.wait()
+        await self.dispatch("on_disconnect")
+
+    def run(self, token=None):
+        """
+        Run the main event loop until close() is called, same as discord.Client.run
+        """
+        try:
+            main_event_loop.run_until_complete(self.start(token))
+        except KeyboardInterrupt:
+            pass
+
+    async def close(self):
+        # May be called from any event loop, e.g. DiscordBot.stop uses asyncio.run
+        if self._closed is not None:
+            main_event_loop.call_soon_threadsafe(self._closed.set)
+
+
+def create_offline_bot(config_filename, client):
+    """
+    Create a DiscordBot that uses a fake discord client, with no twitch monitor and
+    with all built-in plugins enabled. Plugins that fail to enable (e.g. because they
+    need network access) are skipped.
+
+    :param str config_filename: bot config file to read, if it exists. The config\
+        file is never written.
+    :param FakeClient client: fake discord client for the bot to use
+
+    :return: new bot instance
+    :rtype: nedry.discord_bot.DiscordBot
+    """
+    config = BotConfigManager(config_filename)
+    if os.path.isfile(config_filename):
+        config.load_from_file()
+
+    bot = DiscordBot(config, None, client=client)
+
+    plugin_manager = PluginModuleManager(bot, [])
+    for plugin in builtin_plugin_modules:
+        plugin_manager.add_plugin_class(plugin)
+
+    plugin_manager.startup_plugins()
+
+    for plugin in builtin_plugin_modules:
+        try:
+            plugin_manager.enable_plugins([plugin.plugin_name])
+        except Exception as e:
+            logger.warning("unable to enable plugin %s (%s)" % (plugin.plugin_name, e))
+
+    # Plugins are only used in guilds where they are enabled in the config
+    config.config.enabled_plugins = [p.plugin_name.lower() for p in plugin_manager.enabled_plugins()]
+    bot.plugin_manager = plugin_manager
+    bot.outbound.sent_callback = client.record_replies
+    return bot
@@ -0,0 +1,132 @@
+# Implements a FuzzyIndex class, for finding the closest match to a misspelled word
+# among a large set of known words (e.g. command words) without comparing against
+# every known word.
+
+import collections
+import heapq
+import threading
+from difflib import SequenceMatcher
+
+# Max. number of candidates (most shared trigrams first) to compare in full
+DEFAULT_MAX_CANDIDATES = 8
+
+# Max. number of lookup results to remember
+RESULT_CACHE_SIZE = 256
+
+
+def _trigrams(word):
+    # Padded, so that words shorter than 3 characters still have trigrams, and
+    # matching first/last characters count for more
+    padded = "$$%s$" % word
+    return frozenset([padded[i:i + 3] for i in range(len(padded) - 2)])
+
+
+class FuzzyIndex(object):
+    """
+    Trigram index over a set of words. Lookups only compare the query against words
+    that share the most trigrams with it, so the cost of a lookup depends on how many
+    similar words there are, not on the total number of words.
+
+    Similarity is measured the same way as difflib.SequenceMatcher.ratio(). Words that
+    share no trigrams at all with the query are never suggested.
+    """
+    def __init__(self, words=(), max_candidates=DEFAULT_MAX_CANDIDATES):
+        """
+        :param words: initial words to index
+        :param int max_candidates: Max. number of indexed words to compare in full for\
+            each lookup
+        """
+        self.max_candidates = max_candidates
+
+        self._lock = threading.Lock()
+        self._postings = {}         # Set of words, keyed by trigram
+        self._word_trigrams = {}    # Set of trigrams, keyed by word
+        self._order = {}            # Order each word was added, for breaking ties
+        self._next_order = 0
+        self._results = collections.OrderedDict()
+
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        """
+        Add a word to the index. Does nothing if the word is already indexed.
+
+        :param str word: word to add
+        """
+        with self._lock:
+            if word in self._word_trigrams:
+                return
+
+            trigrams = _trigrams(word)
+            self._word_trigrams[word] = trigrams
+            self._order[word] = self._next_order
+            self._next_order += 1
+
+            for t in trigrams:
+                self._postings.setdefault(t, set()).add(word)
+
+            self._results.clear()
+
+    def remove(self, word):
+        """
+        Remove a word from the index, if it is indexed
+
+        :param str word: word to remove
+        """
+        with self._lock:
+            trigrams = self._word_trigrams.pop(word, None)
+            if trigrams is None:
+                return
+
+            del self._order[word]
+            for t in trigrams:
+                words = self._postings[t]
+                words.discard(word)
+                if not words:
+                    del self._postings[t]
+
+            self._results.clear()
+
+    def nearest(self, word):
+        """
+        Find the indexed word most similar to the given word
+
+        :param str word: word to look up
+
+        :return: tuple of the form (nearest_word, ratio), where ratio is between 0.0 and\
+            1.0. If no indexed word is similar at all, nearest_word is None and ratio is 0.0.
+        :rtype: tuple
+        """
+        with self._lock:
+            result = self._results.get(word, None)
+            if result is not None:
+                self._results.move_to_end(word)
+                return result
+
+            query = _trigrams(word)
+            shared = collections.Counter()
+            for t in query:
+                shared.update(self._postings.get(t, ()))
+
+            # Dice coefficient of the trigram sets, a cheap estimate of similarity
+            def _estimate(w):
+                return (2.0 * shared[w]) / (len(query) + len(self._word_trigrams[w]))
+
+            candidates = heapq.nlargest(self.max_candidates, shared, key=_estimate)
+            candidates.sort(key=lambda w: self._order[w])
+
+            result = (None, 0.0)
+            for candidate in candidates:
+                ratio = SequenceMatcher(None, candidate, word).ratio()
+                if ratio > result[1]:
+                    result = (candidate, ratio)
+
+            self._results[word] = result
+            if len(self._results) > RESULT_CACHE_SIZE:
+                self._results.popitem(last=False)
+
+            return result
+
+    def __len__(self):
+        return len(self._word_trigrams)
@@ -0,0 +1,39 @@
+# Implements a GuildState class, which holds everything the bot tracks separately
+# for each discord guild it is connected to.
+
+from nedry.channel_index import ChannelIndex
+
+
+class GuildState(object):
+    """
+    Runtime state for a single discord guild. Created the first time the guild is
+    seen, and kept for as long as the bot runs, even while the guild is unavailable.
+    """
+    def __init__(self, guild_id, config):
+        """
+        :param int guild_id: discord guild ID
+        :param config: configuration for this guild; BotConfig object for the main guild,\
+            or GuildConfig object for any other guild
+        """
+        self.guild_id = guild_id
+        self.config = config
+        self.guild = None             # discord.py guild object, None while guild is unavailable
+        self.channels = ChannelIndex()
+        self.channel = None           # Channel for stream announcements
+
+    def is_available(self):
+        return self.guild is not None
+
+    def on_available(self, guild):
+        """
+        Index the guild's channels and find the stream announcements channel
+
+        :param guild: discord.py guild object
+        """
+        self.guild = guild
+        self.channels.rebuild(guild.text_channels)
+        self.channel = self.channels.get_by_name(self.config.discord_channel_name)
+
+    def on_unavailable(self):
+        self.guild = None
+        self.channels.clear()
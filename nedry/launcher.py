@@ -0,0 +1,272 @@
+# Runs the bot as several worker processes on one host, each connecting a subset of
+# discord gateway shards, so that a bot in many guilds can use more than one CPU core.
+#
+# Usage:
+#
+#     python -m nedry.launcher my_bot_config.json --workers 4
+#
+# Worker 0 connects shard 0 (which receives all DMs) and the shard of the main guild
+# (discord_server_id). It is the only worker that monitors twitch streams and writes
+# the config file. Configuration and plugin data for all other guilds is kept in a
+# shared SQLite database, written only by the worker that handles each guild. Changes
+# to the rest of the configuration (e.g. timezones, streamers and stream start messages)
+# made by any worker are forwarded to all other workers, and written to the config file
+# by worker 0. Twitch events are forwarded from worker 0 to all other workers, so that
+# every worker can send stream announcements to its own guilds.
+
+import argparse
+import logging
+import multiprocessing
+import os
+import threading
+
+from nedry import events
+from nedry.event_types import EventType
+from nedry.config import BotConfigManager
+from nedry.shared_state import SharedStateStore
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Events which are forwarded to all other workers when emitted by any worker
+FORWARDED_EVENT_TYPES = [
+    EventType.TWITCH_STREAM_STARTED,
+    EventType.TWITCH_STREAM_ENDED,
+    EventType.HOST_STREAM_STARTED,
+    EventType.HOST_STREAM_ENDED
+]
+
+# Kinds of message sent from one worker to another
+FORWARDED_EVENT = 0
+FORWARDED_CONFIG_CHANGES = 1
+
+
+def shard_for_guild(guild_id, shard_count):
+    """
+    Get the ID of the shard that receives events for a guild, same as discord does
+
+    :param int guild_id: discord guild ID
+    :param int shard_count: total number of shards
+
+    :return: shard ID
+    :rtype: int
+    """
+    return (guild_id >> 22) % shard_count
+
+
+def assign_shards(worker_count, shard_count, main_guild_id):
+    """
+    Decide which shards each worker should connect. Worker 0 always gets shard 0 (DMs
+    are only sent to shard 0) and the main guild's shard, and the remaining shards are
+    shared as evenly as possible by the other workers.
+
+    :param int worker_count: number of worker processes
+    :param int shard_count: total number of shards, must be at least worker_count
+    :param int main_guild_id: discord guild ID of the main guild
+
+    :return: list of shard ID lists, one for each worker
+    :rtype: list
+    """
+    main_shards = sorted(set([0, shard_for_guild(main_guild_id, shard_count)]))
+    assignments = [list(main_shards)] + [[] for _ in range(worker_count - 1)]
+
+    other_shards = [s for s in range(shard_count) if s not in main_shards]
+    for i in range(len(other_shards)):
+        if worker_count > 1:
+            worker = 1 + (i % (worker_count - 1))
+        else:
+            worker = 0
+
+        assignments[worker].append(other_shards[i])
+
+    return assignments
+
+
+class EventForwarder(object):
+    """
+    Forwards events emitted in one worker process to all other worker processes, over
+    one multiprocessing.Queue per worker. Events received from another worker are
+    emitted locally, but not forwarded again. Configuration changes are forwarded the
+    same way, if a BotConfigManager is provided.
+    """
+    def __init__(self, worker_index, queues, event_types=FORWARDED_EVENT_TYPES, config=None):
+        """
+        :param int worker_index: index of this worker
+        :param list queues: multiprocessing.Queue for each worker, in worker order
+        :param list event_types: event types to forward
+        :param config: BotConfigManager instance to forward configuration changes for.\
+            If None, configuration changes are not forwarded.
+        """
+        self.worker_index = worker_index
+        self.queues = queues
+        self.event_types = event_types
+        self.config = config
+        self.forwarded = 0
+        self.received = 0
+
+        self._receiving = threading.local()
+        self._handlers = {}
+        self._thread = None
+
+    def _make_handler(self, event_type):
+        def _forward(*event_args):
+            if getattr(self._receiving, "active", False):
+                # Event came from another worker
+                return
+
+            self._put_all(FORWARDED_EVENT, (event_type, event_args))
+
+        return _forward
+
+    def _forward_config_changes(self, changed, removed):
+        self._put_all(FORWARDED_CONFIG_CHANGES, (changed, removed))
+
+    def _put_all(self, kind, data):
+        for i in range(len(self.queues)):
+            if i != self.worker_index:
+                self.queues[i].put((kind, data))
+
+        self.forwarded += 1
+
+    def _receive_task(self):
+        queue = self.queues[self.worker_index]
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+
+            kind, data = item
+            self.received += 1
+
+            if kind == FORWARDED_CONFIG_CHANGES:
+                try:
+                    self.config.apply_shared_changes(*data)
+                except Exception:
+                    logger.exception("failed to apply forwarded config changes")
+
+                continue
+
+            event_type, event_args = data
+            self._receiving.active = True
+            try:
+                events.emit(event_type, *event_args)
+            except Exception:
+                logger.exception("failed to emit forwarded event(%d)" % event_type)
+            finally:
+                self._receiving.active = False
+
+    def start(self):
+        for event_type in self.event_types:
+            self._handlers[event_type] = self._make_handler(event_type)
+            events.subscribe(event_type, self._handlers[event_type])
+
+        if self.config is not None:
+            self.config.share_changes(self._forward_config_changes)
+
+        self._thread = threading.Thread(target=self._receive_task)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        for event_type, handler in self._handlers.items():
+            events.unsubscribe(event_type, handler)
+
+        self._handlers = {}
+
+        if self.config is not None:
+            self.config.share_changes(None)
+
+        if self._thread is not None:
+            self.queues[self.worker_index].put(None)
+            self._thread.join()
+            self._thread = None
+
+
+def _worker_main(worker_index, config_file, state_file, shard_ids, shard_count, queues):
+    # Imported here so that the launcher process itself never imports discord.py
+    from nedry.__main__ import run_bot
+
+    config = BotConfigManager(config_file)
+    config.load_from_file()
+
+    store = SharedStateStore(state_file)
+    config.store = store
+    config.write_file = worker_index == 0
+
+    forwarder = EventForwarder(worker_index, queues, config=config)
+    forwarder.start()
+
+    logger.info("worker %d starting with shards %s" % (worker_index, shard_ids))
+    try:
+        run_bot(config, shard_ids=shard_ids, shard_count=shard_count, primary=(worker_index == 0))
+    finally:
+        forwarder.stop()
+        store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bot as multiple worker processes, "
+                                     "each handling a subset of discord gateway shards")
+    parser.add_argument('config_file', help="Path to bot config file")
+    parser.add_argument('-w', '--workers', default=os.cpu_count(), type=int, dest='workers',
+                        help="Number of worker processes (default=%(default)s)")
+    parser.add_argument('-s', '--shards', default=None, type=int, dest='shards',
+                        help="Total number of gateway shards, must be at least the number of workers "
+                        "(default=same as number of workers)")
+    parser.add_argument('--state-file', default=None, dest='state_file',
+                        help="SQLite database file for state shared by all workers "
+                        "(default=config file name with '_state.db' extension)")
+    args = parser.parse_args()
+
+    shard_count = args.workers if args.shards is None else args.shards
+    if (args.workers < 1) or (shard_count < args.workers):
+        parser.error("need at least 1 worker, and at least as many shards as workers")
+
+    state_file = args.state_file
+    if state_file is None:
+        state_file = os.path.splitext(args.config_file)[0] + "_state.db"
+
+    # Load (and migrate, if needed) config file once, before any workers are started
+    config = BotConfigManager(args.config_file)
+    result = config.load_from_file()
+    if result is not None:
+        logger.info("migrated config file from version %s to version %s" % (result.old_version, result.version_reached))
+        config.save_to_file()
+        config.stop()
+
+    store = SharedStateStore(state_file)
+    copied = config.copy_guild_configs_to_store(store)
+    if copied:
+        logger.info("copied %d guild configurations to %s" % (copied, state_file))
+
+    store.close()
+
+    assignments = assign_shards(args.workers, shard_count, config.config.discord_server_id)
+    if not all(assignments):
+        # Worker 0 may need 2 shards, if the main guild is not on shard 0
+        parser.error("not enough shards for %d workers, use --shards %d or more" %
+                     (args.workers, args.workers + 1))
+
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(args.workers)]
+    processes = []
+
+    for i in range(args.workers):
+        proc = ctx.Process(target=_worker_main, name="nedry-worker-%d" % i,
+                           args=(i, args.config_file, state_file, assignments[i], shard_count, queues))
+        proc.start()
+        processes.append(proc)
+
+    for proc in processes:
+        try:
+            proc.join()
+        except KeyboardInterrupt:
+            # Workers get the same interrupt and shut down on their own
+            proc.join()
+
+    logger.info("all workers stopped")
+
+
+if __name__ == "__main__":
+    main()
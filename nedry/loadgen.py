@@ -0,0 +1,345 @@
+# Entry point for load testing. Runs a local bot with all built-in plugins enabled
+# against the fake discord client from nedry.fake_discord, and simulates many
+# virtual users sending a configurable mix of traffic across many channels.
+#
+# Example, 2000 users across 200 channels for 60 seconds:
+#
+#     python -m nedry.loadgen --users 2000 --channels 200 --duration 60
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on windows
+    resource = None
+
+from nedry import utils
+from nedry.discord_bot import main_event_loop
+from nedry.fake_discord import FakeClient, create_offline_bot
+from nedry.rate_limiter import CommandRateLimiter
+from nedry.builtin_plugins import trivia
+
+
+GUILD_ID = 1000
+CHANNEL_ID_BASE = 2000
+USER_ID_BASE = 100000
+
+# How often the event loop lag monitor wakes up
+LAG_SAMPLE_INTERVAL_SECS = 0.1
+
+# Max. time to wait for replies to all bot mentions after the load has stopped
+DRAIN_TIMEOUT_SECS = 30.0
+
+CHATTER_WORDS = [
+    "lol", "anyone", "playing", "tonight", "that", "stream", "was", "great", "what",
+    "do", "you", "think", "about", "the", "new", "update", "honestly", "no", "idea",
+    "brb", "dinner", "gg", "nice", "one", "haha", "this", "server", "is", "wild"
+]
+
+REMINDER_TASKS = [
+    "take the bins out", "call my mother", "water the plants", "check the oven",
+    "start the raid", "feed the cat", "drink some water"
+]
+
+STORY_SENTENCES = [
+    "and then the lights went out", "nobody expected the dinosaurs to open doors",
+    "the gate was left open", "a storm rolled in from the east",
+    "the raptor looked at the door handle"
+]
+
+JOKES = [
+    ("lettuce", "lettuce in, it's cold out here"),
+    ("boo", "don't cry, it's only a joke"),
+    ("cow says", "no silly, cow says moooo"),
+    ("interrupting cow", "moo")
+]
+
+ACTION_NAMES = ["chatter", "remindme", "trivia", "story", "knock", "typo"]
+
+
+def _make_typo(word):
+    """
+    Mangle a command word by dropping, doubling or swapping letters
+    """
+    if len(word) < 3:
+        return word + word[-1]
+
+    i = random.randrange(len(word) - 1)
+    op = random.randrange(3)
+    if op == 0:
+        return word[:i] + word[i + 1:]
+    elif op == 1:
+        return word[:i] + word[i] + word[i:]
+
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+class LoadState(object):
+    """
+    Holds everything shared by all virtual users during a load test
+    """
+    def __init__(self, bot, channels, trivia_channels, weights, rate_per_user):
+        self.bot = bot
+        self.client = bot.client
+        self.mention = bot.mention()
+        self.channels = channels
+        self.trivia_channels = trivia_channels
+
+        # Knock-knock jokes take over all mentions on a channel until finished, so
+        # they must not share a channel with trivia questions, or with each other
+        trivia_ids = set([c.id for c in trivia_channels])
+        self.knock_channels = [c for c in channels if c.id not in trivia_ids]
+        self.knock_locks = {c.id: asyncio.Lock() for c in self.knock_channels}
+
+        self.command_words = list(bot.cmdprocessor.cmds.keys())
+        self.rate_per_user = rate_per_user
+        self.messages_sent = 0
+        self.action_counts = {x: 0 for x in ACTION_NAMES}
+
+        self.actions = []
+        self.weights = []
+        for name in ACTION_NAMES:
+            if weights[name] <= 0:
+                continue
+
+            if (name == "trivia") and not trivia_channels:
+                continue
+
+            if (name == "knock") and not self.knock_channels:
+                continue
+
+            self.actions.append(name)
+            self.weights.append(weights[name])
+
+    async def send(self, channel, user, text):
+        self.messages_sent += 1
+        await self.client.receive_message(channel, user, text)
+
+    async def run_action(self, name, user):
+        self.action_counts[name] += 1
+
+        if name == "chatter":
+            text = " ".join(random.choices(CHATTER_WORDS, k=random.randint(2, 12)))
+            await self.send(random.choice(self.channels), user, text)
+
+        elif name == "remindme":
+            text = "%s !remindme to %s in %d hours" % (self.mention, random.choice(REMINDER_TASKS),
+                                                       random.randint(1, 48))
+            await self.send(random.choice(self.channels), user, text)
+
+        elif name == "trivia":
+            text = "%s %d" % (self.mention, random.randint(1, 4))
+            await self.send(random.choice(self.trivia_channels), user, text)
+
+        elif name == "story":
+            text = "%s !story add %s" % (self.mention, random.choice(STORY_SENTENCES))
+            await self.send(random.choice(self.channels), user, text)
+
+        elif name == "knock":
+            channel = random.choice(self.knock_channels)
+            setup, punchline = random.choice(JOKES)
+            async with self.knock_locks[channel.id]:
+                for text in ["knock knock", setup, punchline]:
+                    await self.send(channel, user, "%s %s" % (self.mention, text))
+                    await asyncio.sleep(random.uniform(0.05, 0.2))
+
+        elif name == "typo":
+            text = "%s !%s" % (self.mention, _make_typo(random.choice(self.command_words)))
+            await self.send(random.choice(self.channels), user, text)
+
+
+async def _virtual_user(state, user, end_time):
+    while True:
+        delay = random.expovariate(state.rate_per_user)
+        if (time.monotonic() + delay) >= end_time:
+            return
+
+        await asyncio.sleep(delay)
+
+        action = random.choices(state.actions, weights=state.weights)[0]
+        await state.run_action(action, user)
+
+
+async def _monitor_lag(lags, stop_event):
+    while not stop_event.is_set():
+        start = time.monotonic()
+        await asyncio.sleep(LAG_SAMPLE_INTERVAL_SECS)
+        lags.append(max(0.0, time.monotonic() - start - LAG_SAMPLE_INTERVAL_SECS))
+
+
+async def _run_load(state, users, duration_secs):
+    lags = []
+    stop_event = asyncio.Event()
+    lag_task = asyncio.ensure_future(_monitor_lag(lags, stop_event))
+
+    end_time = time.monotonic() + duration_secs
+    await asyncio.gather(*[_virtual_user(state, u, end_time) for u in users])
+
+    stop_event.set()
+    await lag_task
+    return lags
+
+
+async def _create_state(bot, channels, trivia_channels, weights, rate):
+    # asyncio.Lock objects must be created on the loop that uses them
+    return LoadState(bot, channels, trivia_channels, weights, rate)
+
+
+def _seed_trivia(bot, channels, duration_secs):
+    # Trivia questions normally come from opentdb.com; put a canned question in
+    # progress on each trivia channel instead, so answers can be sent offline
+    question = trivia.TriviaQuestion("general knowledge", "Which of these is a dinosaur?",
+                                     ["Velociraptor", "Dodo", "Mammoth", "Megalodon"],
+                                     "Velociraptor")
+
+    with trivia.trivia_by_channel_lock:
+        for channel in channels:
+            trivia.trivia_by_channel[channel.id] = trivia.TriviaSession(question, duration_secs * 2,
+                                                                        channel, bot)
+        trivia._update_mention_subscription()
+
+
+def _clear_trivia(channels):
+    with trivia.trivia_by_channel_lock:
+        for channel in channels:
+            trivia.trivia_by_channel.pop(channel.id, None)
+
+        trivia._update_mention_subscription()
+
+
+def _wait_for_replies(client, bot, timeout_secs):
+    # Wait until every mention has been replied to, and nothing else is waiting to be sent
+    deadline = time.perf_counter() + timeout_secs
+    while ((client.pending_mentions() > 0) or (bot.outbound.queue_depth() > 0)) and \
+            (time.perf_counter() < deadline):
+        time.sleep(0.01)
+
+    return client.pending_mentions()
+
+
+def _rss_kb():
+    if resource is None:
+        return None
+
+    # Peak resident set size, in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _print_report(args, state, elapsed, lags, latencies, unanswered, mem):
+    print("\n%d users, %d channels (%d with trivia in progress), %.1fs\n" %
+          (args.users, args.channels, len(state.trivia_channels), elapsed))
+
+    print("messages sent to bot:   %d (%.1f/sec)" % (state.messages_sent, state.messages_sent / elapsed))
+    print("replies from bot:       %d (%.1f/sec)" % (len(latencies), len(latencies) / elapsed))
+    print("unanswered mentions:    %d" % unanswered)
+    print("traffic mix:            %s" % ", ".join(["%s=%d" % (k, v) for k, v in state.action_counts.items()]))
+
+    print("\n%-24s %10s %10s %10s %10s" % ("", "p50", "p90", "p99", "max"))
+    for name, values in [("reply latency (ms)", latencies), ("event loop lag (ms)", lags)]:
+        values = sorted(values)
+        if not values:
+            continue
+
+        pcts = [utils.percentile(values, p) * 1000.0 for p in [50.0, 90.0, 99.0, 100.0]]
+        print("%-24s %10.2f %10.2f %10.2f %10.2f" % tuple([name] + pcts))
+
+    print("")
+    for name, before, after in mem:
+        if before is not None:
+            print("%-24s %d KB -> %d KB (%+d KB)" % (name, before, after, after - before))
+
+    for section, values in state.bot.metrics().items():
+        print("%s: %s" % (section, ", ".join(["%s=%s" % (k, v) for k, v in values.items()])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many discord users talking to the bot")
+    parser.add_argument('-u', '--users', default=1000, type=int,
+                        help="Number of virtual users (default=%(default)s)")
+    parser.add_argument('-c', '--channels', default=100, type=int,
+                        help="Number of discord channels (default=%(default)s)")
+    parser.add_argument('-d', '--duration', default=30.0, type=float,
+                        help="How long to generate load for, in seconds (default=%(default)s)")
+    parser.add_argument('-r', '--rate', default=0.1, type=float,
+                        help="Average number of actions per second, per user (default=%(default)s)")
+    parser.add_argument('--trivia-channels', default=0.1, type=float,
+                        help="Fraction of channels with a trivia question in progress (default=%(default)s)")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Also measure python heap growth with tracemalloc (slows everything down)")
+    parser.add_argument('--config-file', default=None,
+                        help="Bot config file to use. This file is never written to. "
+                             "If unset, a default empty configuration is used.")
+
+    for name, default in zip(ACTION_NAMES, [70, 5, 10, 5, 5, 5]):
+        parser.add_argument('--%s' % name, default=default, type=int,
+                            help="Relative weight of '%s' actions in the traffic mix (default=%%(default)s)" % name)
+
+    args = parser.parse_args()
+
+    config_file = args.config_file
+    if config_file is None:
+        config_file = os.path.join(tempfile.gettempdir(), "nedry_loadgen_config.json")
+
+    client = FakeClient()
+    guild = client.add_guild(GUILD_ID, "loadgen")
+    channels = [client.add_text_channel(guild, CHANNEL_ID_BASE + i, "channel-%d" % i)
+                for i in range(args.channels)]
+    users = [client.add_member(guild, USER_ID_BASE + i, "user%d" % i) for i in range(args.users)]
+    trivia_channels = channels[:int(args.channels * args.trivia_channels)]
+
+    bot = create_offline_bot(config_file, client)
+    bot.guild_id = GUILD_ID
+    bot.config.config.discord_channel_name = channels[0].name
+
+    # Simulated users send commands much faster than real users, don't rate limit them
+    bot.cmdprocessor.rate_limiter = CommandRateLimiter()
+
+    bot_thread = threading.Thread(target=bot.run)
+    bot_thread.daemon = True
+    bot_thread.start()
+    bot.guild_available.wait()
+
+    # Start a story on every channel, so that '!story add' always has something to add to
+    for channel in channels:
+        client.post_message(channel, users[0], "%s !story continue Once upon a time" % bot.mention()).result()
+
+    _wait_for_replies(client, bot, DRAIN_TIMEOUT_SECS)
+    _seed_trivia(bot, trivia_channels, args.duration)
+
+    weights = {x: getattr(args, x) for x in ACTION_NAMES}
+    state = asyncio.run_coroutine_threadsafe(_create_state(bot, channels, trivia_channels, weights, args.rate),
+                                             main_event_loop).result()
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    heap_before = tracemalloc.get_traced_memory()[0] // 1024 if args.trace_memory else None
+    rss_before = _rss_kb()
+    first_sent = len(client.sent)
+
+    start = time.perf_counter()
+    lags = asyncio.run_coroutine_threadsafe(_run_load(state, users, args.duration), main_event_loop).result()
+    unanswered = _wait_for_replies(client, bot, DRAIN_TIMEOUT_SECS)
+    elapsed = time.perf_counter() - start
+
+    heap_after = tracemalloc.get_traced_memory()[0] // 1024 if args.trace_memory else None
+    mem = [("peak RSS", rss_before, _rss_kb()), ("python heap", heap_before, heap_after)]
+
+    _clear_trivia(trivia_channels)
+    _print_report(args, state, elapsed, lags, client.latencies(first_sent), unanswered, mem)
+
+    bot.plugin_manager.stop()
+    bot.stop()
+    bot_thread.join()
+
+
+if __name__ == "__main__":
+    main()
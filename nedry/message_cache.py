@@ -0,0 +1,203 @@
+# Implements a MessageCache class that remembers the most recent messages seen on
+# each discord channel, so that recent history can be read without API requests.
+
+import collections
+import threading
+
+# Rough size of a discord.py message object, not counting the message text
+MESSAGE_OVERHEAD_BYTES = 512
+
+
+def _message_size(message):
+    return MESSAGE_OVERHEAD_BYTES + len(message.content)
+
+
+class ChannelMessages(object):
+    """
+    Holds cached messages for a single channel, oldest first
+    """
+    def __init__(self):
+        self.messages = collections.OrderedDict()  # discord.py message objects, keyed by message ID
+        self.by_author = {}                        # OrderedDict of message IDs, keyed by author ID
+
+
+class MessageCache(object):
+    """
+    Bounded cache of recent messages. Each channel keeps at most 'max_per_channel'
+    messages, and the oldest messages (across all channels) are evicted when the total
+    estimated size of cached messages goes over 'max_bytes'.
+
+    Messages are also indexed by (channel ID, author ID), so that the last message
+    sent by a specific user on a specific channel can be found without a search.
+
+    Messages are added from the event loop, but the cache may be read from any thread.
+    """
+    def __init__(self, max_per_channel=200, max_bytes=16 * 1024 * 1024):
+        """
+        :param int max_per_channel: Max. number of messages to cache for each channel.\
+            If less than 1, nothing will be cached.
+        :param int max_bytes: Max. estimated memory used by all cached messages
+        """
+        self.max_per_channel = max_per_channel
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._channels = {}
+        self._order = collections.OrderedDict()  # (channel ID, message ID) of all messages, oldest first
+        self._bytes = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def _remove(self, chan, channel_id, message_id):
+        # Must be called with self._lock held
+        message = chan.messages.pop(message_id)
+        self._order.pop((channel_id, message_id), None)
+        self._bytes -= _message_size(message)
+
+        author_messages = chan.by_author.get(message.author.id, None)
+        if author_messages is not None:
+            author_messages.pop(message_id, None)
+            if not author_messages:
+                del chan.by_author[message.author.id]
+
+        if not chan.messages:
+            del self._channels[channel_id]
+
+    def _evict_oldest(self):
+        # Must be called with self._lock held
+        channel_id, message_id = next(iter(self._order))
+        self._remove(self._channels[channel_id], channel_id, message_id)
+        self._evictions += 1
+
+    def add(self, message):
+        """
+        Add a new message to the cache
+
+        :param message: discord.py message object
+        """
+        if self.max_per_channel < 1:
+            return
+
+        channel_id = message.channel.id
+
+        with self._lock:
+            chan = self._channels.get(channel_id, None)
+            if chan is None:
+                chan = ChannelMessages()
+                self._channels[channel_id] = chan
+
+            if message.id in chan.messages:
+                self._remove(chan, channel_id, message.id)
+                chan = self._channels.setdefault(channel_id, chan)
+
+            chan.messages[message.id] = message
+            chan.by_author.setdefault(message.author.id, collections.OrderedDict())[message.id] = None
+            self._order[(channel_id, message.id)] = None
+            self._bytes += _message_size(message)
+
+            if len(chan.messages) > self.max_per_channel:
+                self._remove(chan, channel_id, next(iter(chan.messages)))
+                self._evictions += 1
+
+            while (self._bytes > self.max_bytes) and (len(self._order) > 1):
+                self._evict_oldest()
+
+    def update(self, message):
+        """
+        Replace a cached message with an edited version of the same message. Does
+        nothing if the message is not cached.
+
+        :param message: discord.py message object
+        """
+        with self._lock:
+            chan = self._channels.get(message.channel.id, None)
+            if (chan is None) or (message.id not in chan.messages):
+                return
+
+            self._bytes += _message_size(message) - _message_size(chan.messages[message.id])
+            chan.messages[message.id] = message
+
+    def remove(self, channel_id, message_id):
+        """
+        Remove a deleted message from the cache, if it is cached
+
+        :param int channel_id: ID of channel the message was sent on
+        :param int message_id: ID of deleted message
+        """
+        with self._lock:
+            chan = self._channels.get(channel_id, None)
+            if (chan is not None) and (message_id in chan.messages):
+                self._remove(chan, channel_id, message_id)
+
+    def history(self, channel_id, limit):
+        """
+        Get the most recent cached messages for a channel, newest first
+
+        :param int channel_id: channel ID
+        :param int limit: Max. number of messages to return
+
+        :return: list of discord.py message objects, or None if fewer than 'limit'\
+            messages are cached for this channel
+        :rtype: list
+        """
+        with self._lock:
+            chan = self._channels.get(channel_id, None)
+            if (chan is None) or (len(chan.messages) < limit):
+                self._misses += 1
+                return None
+
+            self._hits += 1
+            ret = []
+            for message_id in reversed(chan.messages):
+                if len(ret) >= limit:
+                    break
+
+                ret.append(chan.messages[message_id])
+
+            return ret
+
+    def last_message_by(self, channel_id, author_id, predicate=None):
+        """
+        Get the most recent cached message sent by a specific user on a specific channel
+
+        :param int channel_id: channel ID
+        :param int author_id: ID of message author
+        :param predicate: Optional function that accepts a discord.py message object and\
+            returns False if the message should be skipped
+
+        :return: discord.py message object, or None if no matching message is cached
+        """
+        with self._lock:
+            chan = self._channels.get(channel_id, None)
+            author_messages = None if chan is None else chan.by_author.get(author_id, None)
+            if author_messages is None:
+                self._misses += 1
+                return None
+
+            for message_id in reversed(author_messages):
+                message = chan.messages[message_id]
+                if (predicate is None) or predicate(message):
+                    self._hits += 1
+                    return message
+
+            self._misses += 1
+            return None
+
+    def metrics(self):
+        """
+        Get current values of all metrics
+
+        :return: dict of metric values, keyed by metric name
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                "channels": len(self._channels),
+                "messages": len(self._order),
+                "estimated_bytes": self._bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions
+            }
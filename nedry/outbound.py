@@ -0,0 +1,408 @@
+# Implements an OutboundQueue class that sends all of the bot's messages to discord
+# through one queue per destination channel, so that bursts of messages to the same
+# channel are merged together and kept within discord's rate limits.
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import time
+
+from nedry.utils import TokenBucket
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+# Discord allows 5 messages per 5 seconds on each channel
+CHANNEL_BUCKET_CAPACITY = 5
+CHANNEL_BUCKET_REFILL_PER_SEC = 1.0
+
+# Discord allows 50 requests per second across all routes
+GLOBAL_BUCKET_CAPACITY = 50
+GLOBAL_BUCKET_REFILL_PER_SEC = 50.0
+
+# Max. number of DM channels to remember
+DEFAULT_DM_CACHE_SIZE = 1024
+
+# After sending a message on a channel, wait at least this long before sending the
+# next one, so that messages queued in the meantime can be merged together
+DEFAULT_COALESCE_WINDOW_SECS = 0.1
+
+# Max. time close() waits for queued messages to be sent
+DEFAULT_CLOSE_TIMEOUT_SECS = 5.0
+
+
+class OutboundMessage(object):
+    """
+    Represents a single message waiting to be sent
+    """
+    def __init__(self, content, message_end=True):
+        self.content = content
+        self.message_end = message_end   # False for all but the last part of a split message
+        self.future = concurrent.futures.Future()
+        self.enqueue_time = time.monotonic()
+
+
+class ChannelQueue(object):
+    """
+    Holds all messages waiting to be sent to a single destination
+    """
+    def __init__(self, key, target):
+        self.key = key
+        self.target = target
+        self.pending = collections.deque()
+        self.bucket = TokenBucket(CHANNEL_BUCKET_CAPACITY, CHANNEL_BUCKET_REFILL_PER_SEC)
+        self.last_send_time = 0.0
+        self.task = None
+        self.wakeup = asyncio.Event()   # Set when a message is queued while the task is idle
+
+
+class DMChannelCache(object):
+    """
+    Remembers the DM channel for recently messaged users, so that sending a DM does
+    not need a create_dm API call every time. Least recently used channels are
+    evicted once the cache is full. Only used from the event loop.
+    """
+    def __init__(self, max_size=DEFAULT_DM_CACHE_SIZE):
+        self.max_size = max_size
+        self._channels = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, member):
+        """
+        Get the DM channel for a user, creating it if it is not cached
+
+        :param member: discord.py user or member object
+
+        :return: discord.py DM channel object
+        """
+        channel = self._channels.get(member.id, None)
+        if channel is not None:
+            self._channels.move_to_end(member.id)
+            self.hits += 1
+            return channel
+
+        self.misses += 1
+        channel = await member.create_dm()
+
+        self._channels[member.id] = channel
+        if len(self._channels) > self.max_size:
+            self._channels.popitem(last=False)
+            self.evictions += 1
+
+        return channel
+
+    def discard(self, member):
+        """
+        Forget the cached DM channel for a user, if there is one
+
+        :param member: discord.py user or member object
+        """
+        self._channels.pop(member.id, None)
+
+    def __len__(self):
+        return len(self._channels)
+
+
+class OutboundQueue(object):
+    """
+    Queues messages for sending to discord. Each destination channel (or user, for DMs)
+    has its own queue, drained by a task on the event loop, so that messages to the same
+    destination are always sent in the order they were queued.
+
+    Consecutive queued messages are merged into a single discord message, as long as the
+    result is within the message limit. Sends are delayed as needed to stay within local
+    copies of discord's per-channel and global rate limits.
+
+    Once a queue is empty, it is kept until its rate limit bucket has refilled (so that
+    forgetting it doesn't change the rate limit), and then removed.
+    """
+    def __init__(self, loop, message_limit, coalesce_window=DEFAULT_COALESCE_WINDOW_SECS,
+                 dm_cache_size=DEFAULT_DM_CACHE_SIZE):
+        """
+        :param loop: Event loop used for sending messages
+        :param int message_limit: Max. length of a merged message. Messages that\
+            are already longer than this are sent as-is.
+        :param float coalesce_window: Minimum time in seconds between sends on the\
+            same channel, during which new messages are merged together
+        :param int dm_cache_size: Max. number of DM channels to remember
+        """
+        self.loop = loop
+        self.message_limit = message_limit
+        self.coalesce_window = coalesce_window
+        self.dm_channels = DMChannelCache(dm_cache_size)
+
+        # If set, called on the event loop after each successful send, with the channel
+        # and the number of complete messages that the send finished (parts of a split
+        # message only count once the last part is sent). Used for measuring reply
+        # latency with nedry.fake_discord.
+        self.sent_callback = None
+
+        self._queues = {}
+        self._closing = False
+        self._global_bucket = TokenBucket(GLOBAL_BUCKET_CAPACITY, GLOBAL_BUCKET_REFILL_PER_SEC)
+
+        # Channels take turns waiting for the global bucket, instead of all polling it
+        self._global_lock = None
+
+        self._queued = 0
+        self._sent = 0
+        self._merged = 0
+        self._failed = 0
+        self._rate_limited = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._delivered = 0
+
+    def send(self, channel, content, message_end=True):
+        """
+        Queue a message for sending to a discord channel. May be called from any thread.
+
+        :param channel: discord.py channel object (or any object with an async send method)
+        :param str content: message to send
+        :param bool message_end: False if content is one part of a longer message that\
+            was split, and is not the last part
+
+        :return: Future which will resolve to the sent discord.py message object,\
+            once the message has been delivered
+        :rtype: concurrent.futures.Future
+        """
+        return self._queue_message(channel.id, channel, content, message_end)
+
+    def send_dm(self, member, content, message_end=True):
+        """
+        Queue a message for sending as a DM to a discord user. May be called from any thread.
+
+        :param member: discord.py user or member object
+        :param str content: message to send
+        :param bool message_end: False if content is one part of a longer message that\
+            was split, and is not the last part
+
+        :return: Future which will resolve to the sent discord.py message object,\
+            once the message has been delivered
+        :rtype: concurrent.futures.Future
+        """
+        return self._queue_message(("dm", member.id), member, content, message_end)
+
+    def queue_depth(self):
+        """
+        Get the total number of messages waiting to be sent, across all channels
+        """
+        return self._queued - self._delivered
+
+    def metrics(self):
+        """
+        Get current values of all metrics
+
+        :return: dict of metric values, keyed by metric name
+        :rtype: dict
+        """
+        delivered = self._delivered
+        avg_latency = (self._latency_total / delivered) if delivered else 0.0
+
+        queues = list(self._queues.values())
+
+        return {
+            "queue_depth": self.queue_depth(),
+            "active_channels": len([q for q in queues if q.pending]),
+            "tracked_channels": len(queues),
+            "queued": self._queued,
+            "sent": self._sent,
+            "merged": self._merged,
+            "failed": self._failed,
+            "rate_limited_sends": self._rate_limited,
+            "avg_latency_ms": round(avg_latency * 1000.0, 2),
+            "max_latency_ms": round(self._latency_max * 1000.0, 2),
+            "dm_channels_cached": len(self.dm_channels),
+            "dm_cache_hits": self.dm_channels.hits,
+            "dm_cache_evictions": self.dm_channels.evictions,
+            "create_dm_calls": self.dm_channels.misses,
+            "create_dm_calls_saved": self.dm_channels.hits
+        }
+
+    def close(self, timeout=DEFAULT_CLOSE_TIMEOUT_SECS):
+        """
+        Stop accepting messages, wait for all queued messages to be sent, and stop all
+        queue tasks. Messages that could not be sent in time are cancelled. Must not be
+        called from the event loop.
+
+        :param float timeout: Max. time to wait for queued messages to be sent, in seconds
+        """
+        if self.loop.is_closed():
+            # Event loop has already cancelled all tasks
+            self._closing = True
+            return
+
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._close(timeout), self.loop).result()
+        else:
+            self.loop.run_until_complete(self._close(timeout))
+
+    async def _close(self, timeout):
+        self._closing = True
+
+        queues = list(self._queues.values())
+        for queue in queues:
+            # Idle tasks don't need to wait for their rate limit bucket any more
+            queue.wakeup.set()
+
+        tasks = [q.task for q in queues if q.task is not None]
+        if tasks:
+            _, not_done = await asyncio.wait(tasks, timeout=timeout)
+            if not_done:
+                logger.warning("timed out sending queued messages on %d channels" % len(not_done))
+                for task in not_done:
+                    task.cancel()
+
+                await asyncio.gather(*not_done, return_exceptions=True)
+
+        for queue in queues:
+            while queue.pending:
+                queue.pending.popleft().future.cancel()
+
+        self._queues.clear()
+
+    def _queue_message(self, key, target, content, message_end):
+        message = OutboundMessage(content, message_end)
+        self.loop.call_soon_threadsafe(self._enqueue, key, target, message)
+        return message.future
+
+    def _enqueue(self, key, target, message):
+        if self._closing:
+            message.future.cancel()
+            return
+
+        self._queued += 1
+
+        queue = self._queues.get(key, None)
+        if queue is None:
+            queue = ChannelQueue(key, target)
+            self._queues[key] = queue
+
+        queue.pending.append(message)
+        if queue.task is None:
+            queue.task = self.loop.create_task(self._drain(queue))
+        else:
+            queue.wakeup.set()
+
+    def _next_batch(self, queue):
+        batch = [queue.pending.popleft()]
+        size = len(batch[0].content)
+
+        while queue.pending:
+            next_size = size + 1 + len(queue.pending[0].content)
+            if next_size > self.message_limit:
+                break
+
+            batch.append(queue.pending.popleft())
+            size = next_size
+
+        return batch
+
+    async def _resolve_channel(self, target):
+        if hasattr(target, "create_dm"):
+            return await self.dm_channels.get(target)
+
+        return target
+
+    async def _wait_for_global_bucket(self):
+        # Returns True if we had to wait
+        if self._global_lock is None:
+            self._global_lock = asyncio.Lock()
+
+        async with self._global_lock:
+            delay = self._global_bucket.time_until_available()
+            if delay > 0.0:
+                await asyncio.sleep(delay)
+
+            self._global_bucket.consume()
+
+        return delay > 0.0
+
+    def _idle_time(self, queue):
+        # Time until an empty queue can be removed without changing its rate limit
+        now = time.monotonic()
+        bucket = queue.bucket
+        return max(bucket.time_until_available(bucket.capacity, now),
+                   queue.last_send_time + self.coalesce_window - now)
+
+    async def _drain(self, queue):
+        try:
+            while True:
+                await self._send_pending(queue)
+
+                delay = self._idle_time(queue)
+                if self._closing or (delay <= 0.0):
+                    break
+
+                queue.wakeup.clear()
+                try:
+                    await asyncio.wait_for(queue.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            queue.task = None
+            if (not queue.pending) and (self._queues.get(queue.key, None) is queue):
+                del self._queues[queue.key]
+
+    async def _send_pending(self, queue):
+        while queue.pending:
+            now = time.monotonic()
+            coalesce_delay = queue.last_send_time + self.coalesce_window - now
+            rate_limit_delay = queue.bucket.time_until_available(now=now)
+
+            delay = max(coalesce_delay, rate_limit_delay)
+            if delay > 0.0:
+                await asyncio.sleep(delay)
+
+            rate_limited = rate_limit_delay > max(coalesce_delay, 0.0)
+            if await self._wait_for_global_bucket():
+                rate_limited = True
+
+            if rate_limited:
+                self._rate_limited += 1
+
+            queue.bucket.consume()
+            batch = self._next_batch(queue)
+            await self._send_batch(queue, batch)
+
+    async def _send_batch(self, queue, batch):
+        queue.last_send_time = time.monotonic()
+        self._sent += 1
+        self._merged += len(batch) - 1
+
+        try:
+            channel = await self._resolve_channel(queue.target)
+            sent_message = await channel.send("\n".join([m.content for m in batch]))
+        except asyncio.CancelledError:
+            for m in batch:
+                m.future.cancel()
+
+            raise
+        except Exception as e:
+            self._failed += 1
+            logger.exception("failed to send message")
+
+            # Cached DM channel may be the cause, get a new one next time
+            if hasattr(queue.target, "create_dm"):
+                self.dm_channels.discard(queue.target)
+
+            for m in batch:
+                m.future.set_exception(e)
+        else:
+            for m in batch:
+                m.future.set_result(sent_message)
+
+            if self.sent_callback is not None:
+                self.sent_callback(channel, len([m for m in batch if m.message_end]))
+
+        now = time.monotonic()
+        for m in batch:
+            latency = now - m.enqueue_time
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+
+        self._delivered += len(batch)
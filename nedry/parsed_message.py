@@ -0,0 +1,101 @@
+# Implements a ParsedMessage class, which holds the results of parsing the text of a
+# discord message, so that the bot and all plugins can share a single parse of each
+# message instead of each cleaning up and splitting the text themselves.
+
+import collections
+import threading
+
+COMMAND_PREFIX = '!'
+
+# Max. number of parsed messages to remember
+PARSE_CACHE_SIZE = 256
+
+# Text of all mentions of the bot, set by the bot once it has logged in
+_bot_mentions = ()
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class ParsedMessage(str):
+    """
+    Text of a discord message, with any bot mention removed and leading/trailing
+    whitespace stripped. Since this is a str, it can be used anywhere that the message
+    text is expected, but also provides the following pre-computed attributes:
+
+    - content: original message text, unchanged
+    - mentions_bot: True if the message text contains a mention of the bot
+    - tokens: list of whitespace-separated words
+    - normalized: lower case, with all whitespace collapsed to single spaces
+    - is_command: True if the text starts with the command prefix
+    - command_word: lower case command word (without prefix), or "" if not a command
+    - arg_text: text after the command word, or "" if not a command
+    """
+    def __new__(cls, content, bot_mentions=()):
+        mention = None
+        for m in bot_mentions:
+            if m in content:
+                mention = m
+                break
+
+        if mention is None:
+            text = content.strip()
+        else:
+            text = content.replace(mention, '', 1).strip()
+
+        self = super(ParsedMessage, cls).__new__(cls, text)
+        self.content = content
+        self.mentions_bot = mention is not None
+        self.tokens = text.split()
+        self.normalized = ' '.join(self.tokens).lower()
+        self.is_command = text.startswith(COMMAND_PREFIX)
+        self.command_word = ""
+        self.arg_text = ""
+
+        if self.is_command:
+            command_text = text.lstrip(COMMAND_PREFIX)
+            words = command_text.split(None, 1)
+            if words:
+                self.command_word = words[0].lower()
+                self.arg_text = words[1] if len(words) > 1 else ""
+
+        return self
+
+
+def set_bot_mentions(mentions):
+    """
+    Set the text of all possible mentions of the bot, and forget all parsed messages
+
+    :param list mentions: list of mention strings, e.g. ["<@1234>", "<@!1234>"]
+    """
+    global _bot_mentions
+    _bot_mentions = tuple(mentions)
+
+    with _cache_lock:
+        _cache.clear()
+
+
+def parse(message):
+    """
+    Get the parsed text of a discord message. Each message is only parsed once; the
+    same ParsedMessage object is returned for later calls with the same message,
+    unless the message has been edited.
+
+    :param message: discord.py message object
+
+    :return: parsed message text
+    :rtype: ParsedMessage
+    """
+    with _cache_lock:
+        parsed = _cache.get(message.id, None)
+        if (parsed is not None) and (parsed.content == message.content):
+            return parsed
+
+    parsed = ParsedMessage(message.content, _bot_mentions)
+
+    with _cache_lock:
+        _cache[message.id] = parsed
+        if len(_cache) > PARSE_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return parsed
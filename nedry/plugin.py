@@ -2,10 +2,26 @@ import inspect
 import os
 import importlib
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Name of the plugin whose open method is currently running on each thread
+_opening = threading.local()
+
+
+def current_plugin_name():
+    """
+    Get the name of the plugin that is currently being opened on this thread. Used
+    to record which plugin owns each command and event handler, so that they only
+    run in guilds where that plugin is enabled.
+
+    :return: lower case plugin name, or None if no plugin is being opened
+    :rtype: str
+    """
+    return getattr(_opening, "name", None)
+
 
 class PluginModule(object):
     """
@@ -17,6 +33,17 @@ class PluginModule(object):
     plugin_short_description = "Short description of the plugin, no line breaks"
     plugin_long_description = "Longer description, as many line breaks as you like"
 
+    # Names of discord.Intents flags needed by this plugin, in addition to the intents
+    # the bot always asks for (guilds, guild_messages, dm_messages), e.g. ["reactions"]
+    plugin_intents = []
+
+    # Names of discord.MemberCacheFlags flags needed by this plugin, e.g. ["joined"]
+    plugin_member_cache_flags = []
+
+    # Set to True if this plugin needs all guild members to be fetched on startup,
+    # e.g. to look up arbitrary users by ID with client.get_user
+    plugin_needs_all_members = False
+
     def __init__(self, discord_bot):
         """
         :param bot: discord bot object, which allows you to send messages to discord channels,\
@@ -126,9 +153,19 @@ class PluginModuleManager(object):
                 # Plugin is already enabled
                 continue
 
-            plugin.open()
+            _opening.name = plugin.plugin_name.lower()
+            try:
+                plugin.open()
+            finally:
+                _opening.name = None
+
             plugin.enabled = True
 
+            missing = self._discord_bot.missing_intents(plugin)
+            if missing:
+                logger.warning("plugin %s needs gateway intents that are not enabled (%s), "
+                               "restart the bot to enable them" % (plugin.plugin_name, ", ".join(missing)))
+
     def disable_plugins(self, plugin_names=None):
         """
         Call close method on multiple specific plugins by name
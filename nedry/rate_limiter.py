@@ -0,0 +1,165 @@
+# Implements a CommandRateLimiter class, which limits how often bot commands may be
+# used by each user, on each channel, and for each command word.
+
+import collections
+import threading
+import time
+
+from nedry.utils import TokenBucket
+
+# Max. number of buckets to keep. Buckets that are full (i.e. have not been used
+# for a while) are evicted long before this; it only matters under heavy spam from
+# many different users.
+DEFAULT_MAX_BUCKETS = 100000
+
+
+class _LimitedKey(object):
+    """
+    Holds the token bucket for a single user, channel or (user, command word) pair
+    """
+    __slots__ = ("bucket", "notified")
+
+    def __init__(self, capacity, refill_per_sec):
+        self.bucket = TokenBucket(capacity, refill_per_sec)
+        self.notified = False   # True if user has been told about the cooldown for this bucket
+
+
+class CommandRateLimiter(object):
+    """
+    Token bucket rate limits for bot commands. Every command takes one token from each
+    of the following buckets, and is only allowed if all of them have a token available:
+
+    - One bucket per user ('user_limit'), or per admin user ('admin_limit')
+    - One bucket per channel ('channel_limit'), not used for admin users
+    - One bucket per user for each command word in 'command_limits', not used for admin users
+
+    Each limit is a (burst, per_minute) pair, where 'burst' is the number of commands
+    that may be used at once, and 'per_minute' is the rate at which tokens are refilled.
+    A limit of None means no limit.
+
+    Buckets are created the first time they are needed, and evicted once they are full
+    again, so memory is only used for users and channels that sent commands recently.
+    """
+    def __init__(self, user_limit=None, admin_limit=None, channel_limit=None, command_limits=None,
+                 max_buckets=DEFAULT_MAX_BUCKETS):
+        """
+        :param user_limit: (burst, per_minute) limit for each user, or None
+        :param admin_limit: (burst, per_minute) limit for each admin user, or None
+        :param channel_limit: (burst, per_minute) limit for each channel, or None
+        :param dict command_limits: (burst, per_minute) limit for each user using a\
+            specific command, keyed by command word, or None
+        :param int max_buckets: Max. number of buckets to keep
+        """
+        self.user_limit = user_limit
+        self.admin_limit = admin_limit
+        self.channel_limit = channel_limit
+        self.command_limits = {} if command_limits is None else dict(command_limits)
+        self.max_buckets = max_buckets
+
+        self._lock = threading.Lock()
+        self._keys = collections.OrderedDict()   # _LimitedKey objects, least recently used first
+
+        self._allowed = 0
+        self._limited = 0
+        self._notified = 0
+        self._evicted = 0
+
+    def is_enabled(self):
+        return any([self.user_limit, self.admin_limit, self.channel_limit, self.command_limits])
+
+    def _get_key(self, key, limit):
+        limited_key = self._keys.get(key, None)
+        if limited_key is None:
+            burst, per_minute = limit
+            limited_key = _LimitedKey(burst, per_minute / 60.0)
+            self._keys[key] = limited_key
+        else:
+            self._keys.move_to_end(key)
+
+        return limited_key
+
+    def _evict(self, now):
+        # Least recently used buckets first; a full bucket is the same as a new one,
+        # so it can be thrown away without changing any limits
+        while self._keys:
+            key, limited_key = next(iter(self._keys.items()))
+            bucket = limited_key.bucket
+            full = bucket.time_until_available(bucket.capacity, now) == 0.0
+            if (not full) and (len(self._keys) < self.max_buckets):
+                break
+
+            del self._keys[key]
+            self._evicted += 1
+
+    def check(self, user_id, channel_id, command, is_admin=False):
+        """
+        Check whether a command is allowed, and take tokens for it if it is
+
+        :param int user_id: discord ID of the user who sent the command
+        :param int channel_id: discord ID of the channel the command was sent on
+        :param str command: command word
+        :param bool is_admin: True if the user is an admin user
+
+        :return: tuple of the form (allowed, retry_after_secs, notify). If allowed is False,\
+            retry_after_secs is the time until the command would be allowed, and notify is\
+            True only for the first command limited by the same bucket(s), so that the user\
+            is only told about the cooldown once.
+        :rtype: tuple
+        """
+        limits = []
+        if is_admin:
+            if self.admin_limit:
+                limits.append((("admin", user_id), self.admin_limit))
+        else:
+            if self.user_limit:
+                limits.append((("user", user_id), self.user_limit))
+            if self.channel_limit:
+                limits.append((("channel", channel_id), self.channel_limit))
+            if self.command_limits.get(command, None):
+                limits.append((("command", user_id, command), self.command_limits[command]))
+
+        if not limits:
+            return True, 0.0, False
+
+        now = time.monotonic()
+
+        with self._lock:
+            self._evict(now)
+
+            limited_keys = [self._get_key(key, limit) for key, limit in limits]
+            waits = [k.bucket.time_until_available(1.0, now) for k in limited_keys]
+
+            if max(waits) <= 0.0:
+                for limited_key in limited_keys:
+                    limited_key.bucket.consume(1.0, now)
+                    limited_key.notified = False
+
+                self._allowed += 1
+                return True, 0.0, False
+
+            blocking = [limited_keys[i] for i in range(len(limited_keys)) if waits[i] > 0.0]
+            notify = not any([k.notified for k in blocking])
+            for limited_key in blocking:
+                limited_key.notified = True
+
+            self._limited += 1
+            if notify:
+                self._notified += 1
+
+            return False, max(waits), notify
+
+    def metrics(self):
+        """
+        Get a snapshot of rate limiter metrics
+
+        :return: dict of metric values, keyed by metric name
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                "buckets": len(self._keys),
+                "allowed": self._allowed,
+                "limited": self._limited,
+                "cooldown_replies": self._notified,
+                "evicted": self._evicted
+            }
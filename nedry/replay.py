@@ -0,0 +1,220 @@
+# Entry point for replaying events captured by nedry.event_capture.EventRecorder
+# through a local bot instance with all plugins enabled, without connecting to
+# discord (see nedry.fake_discord). Useful for reproducing production load and
+# measuring handler throughput.
+
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import tempfile
+import time
+
+from nedry import events, event_capture
+from nedry.event_types import EventType
+from nedry.discord_bot import main_event_loop
+from nedry.fake_discord import FakeClient, FakeMessage, create_offline_bot
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+# Events that are fed back into the bot. All other captured events are either
+# produced by the bot itself in response to these, or come from twitch.
+REPLAY_EVENT_TYPES = [
+    EventType.DISCORD_MESSAGE_RECEIVED,
+    EventType.DISCORD_BOT_MENTION,
+    EventType.BOT_COMMAND_RECEIVED,
+    EventType.NEW_DISCORD_MEMBER
+]
+
+class ReplayObjects(object):
+    """
+    Rebuilds fake discord objects from captured records, adding them to a FakeClient.
+    The same object is returned every time a given user, channel or guild ID is seen.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.guilds = {}
+
+        # Channels created since the last call to take_new_channels
+        self.new_channels = []
+
+    def guild(self, guild_id):
+        if guild_id is None:
+            return None
+
+        if guild_id not in self.guilds:
+            self.guilds[guild_id] = self.client.add_guild(guild_id, "guild-%d" % guild_id)
+
+        return self.guilds[guild_id]
+
+    def user(self, attrs):
+        user = self.client.get_user(attrs["id"])
+        if user is None:
+            user = self.client.add_member(None, attrs["id"], attrs["name"], attrs["nick"])
+
+        return user
+
+    def channel(self, attrs):
+        channel = self.client.get_channel(attrs["id"])
+        if channel is None:
+            guild = self.guild(attrs["guild"])
+            if guild is None:
+                guild = self.guild(0)
+
+            channel = self.client.add_text_channel(guild, attrs["id"], attrs["name"])
+            self.new_channels.append(channel)
+
+        return channel
+
+    def take_new_channels(self):
+        ret = self.new_channels
+        self.new_channels = []
+        return ret
+
+    def build(self, arg):
+        if not isinstance(arg, dict):
+            return arg
+
+        record_type = arg["_t"]
+        if record_type == event_capture.RECORD_USER:
+            return self.user(arg)
+        elif record_type == event_capture.RECORD_CHANNEL:
+            return self.channel(arg)
+        elif record_type == event_capture.RECORD_MESSAGE:
+            message = FakeMessage(arg["id"], self.channel(arg["chan"]), self.user(arg["author"]),
+                                  arg["content"])
+            if arg["ts"] is not None:
+                message.created_at = datetime.datetime.utcfromtimestamp(arg["ts"])
+
+            message.channel._add_to_history(message)
+            return message
+
+        raise ValueError("unrecognized record type '%s'" % record_type)
+
+
+class HandlerStats(object):
+    """
+    Tracks time spent handling each replayed event type
+    """
+    def __init__(self):
+        self.counts = {}
+        self.total_secs = {}
+        self.max_secs = {}
+
+    def record(self, event_type, secs):
+        self.counts[event_type] = self.counts.get(event_type, 0) + 1
+        self.total_secs[event_type] = self.total_secs.get(event_type, 0.0) + secs
+        self.max_secs[event_type] = max(self.max_secs.get(event_type, 0.0), secs)
+
+
+def _event_type_name(event_type):
+    for name in dir(EventType):
+        if getattr(EventType, name) == event_type:
+            return name
+
+    return str(event_type)
+
+
+async def replay_events(client, captured, speed, stats):
+    """
+    Emit captured events, preserving the original timing between events (scaled by
+    the given speed factor)
+
+    :param FakeClient client: fake discord client used by the bot
+    :param list captured: captured events, as returned by event_capture.load_capture
+    :param float speed: Replay speed multiplier (e.g. 10.0 to replay 10x faster than\
+        real time). If 0, events are replayed as fast as possible.
+    :param HandlerStats stats: object to record handler times in
+    """
+    objects = ReplayObjects(client)
+    start_time = time.monotonic()
+
+    for time_offset, event_type, args in captured:
+        if event_type not in REPLAY_EVENT_TYPES:
+            continue
+
+        if speed > 0:
+            delay = (time_offset / speed) - (time.monotonic() - start_time)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        event_args = [objects.build(x) for x in args]
+
+        # Let the bot know about channels that did not exist yet, as discord would
+        for channel in objects.take_new_channels():
+            await client.dispatch("on_guild_channel_create", channel)
+
+        handler_start = time.perf_counter()
+        await events.emit_async(event_type, *event_args)
+        stats.record(event_type, time.perf_counter() - handler_start)
+
+
+
+async def _run_replay(bot, captured, speed):
+    stats = HandlerStats()
+    start = time.perf_counter()
+    await replay_events(bot.client, captured, speed, stats)
+    emit_secs = time.perf_counter() - start
+
+    # Wait for queued commands and async handlers to finish
+    await main_event_loop.run_in_executor(None, bot.command_executor.stop)
+    pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    if pending:
+        await asyncio.wait(pending, timeout=10.0)
+
+    total_secs = time.perf_counter() - start
+    return stats, emit_secs, total_secs
+
+
+def _print_report(stats, emit_secs, total_secs, bot):
+    event_count = sum(stats.counts.values())
+    sent_count = len(bot.client.sent)
+
+    print("\nReplayed %d events in %.3fs (%.1f events/sec), all work finished after %.3fs" %
+          (event_count, emit_secs, event_count / emit_secs if emit_secs else 0.0, total_secs))
+    print("%d messages sent by the bot\n" % sent_count)
+
+    print("%-28s %8s %12s %12s" % ("event", "count", "avg (ms)", "max (ms)"))
+    for event_type in stats.counts:
+        count = stats.counts[event_type]
+        print("%-28s %8d %12.3f %12.3f" % (_event_type_name(event_type), count,
+                                           (stats.total_secs[event_type] / count) * 1000.0,
+                                           stats.max_secs[event_type] * 1000.0))
+
+    print("")
+    for section, values in bot.metrics().items():
+        print("%s: %s" % (section, ", ".join(["%s=%s" % (k, v) for k, v in values.items()])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay events captured from a live bot")
+    parser.add_argument('capture_file', help="Capture file written by a bot started with --capture")
+    parser.add_argument('-s', '--speed', default=1.0, type=float,
+                        help="Replay speed multiplier, 0 means as fast as possible (default=%(default)s)")
+    parser.add_argument('-c', '--config-file', default=None,
+                        help="Bot config file to use. This file is never written to. "
+                             "If unset, a default empty configuration is used.")
+    args = parser.parse_args()
+
+    config_file = args.config_file
+    if config_file is None:
+        config_file = os.path.join(tempfile.gettempdir(), "nedry_replay_config.json")
+
+    captured = event_capture.load_capture(args.capture_file)
+    bot = create_offline_bot(config_file, FakeClient())
+    bot.command_executor.start()
+    bot.cmdprocessor.watchdog.start()
+
+    try:
+        results = main_event_loop.run_until_complete(_run_replay(bot, captured, args.speed))
+    finally:
+        bot.plugin_manager.stop()
+
+    _print_report(*results, bot)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# Implements a ResponseCache class, which remembers the responses of commands whose
+# response only depends on the command text and the bot's state, and a SingleFlight
+# class, which lets identical commands that are running at the same time share one
+# execution.
+
+import collections
+import concurrent.futures
+import itertools
+import threading
+import time
+
+# Max. number of responses to remember
+DEFAULT_MAX_ENTRIES = 256
+
+# Cached responses are never used after this many seconds, even if nothing has
+# invalidated them, in case they depend on state that changes without a config save
+# (e.g. twitch usernames found to be invalid)
+DEFAULT_TTL_SECS = 60.0
+
+
+class ResponseCache(object):
+    """
+    Bounded LRU cache of command responses. Every cached response is tagged with the
+    cache generation at the time the response was created, and is only used while the
+    generation is unchanged. invalidate() starts a new generation, so all cached
+    responses are dropped in O(1).
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl_secs=DEFAULT_TTL_SECS):
+        """
+        :param int max_entries: Max. number of responses to remember
+        :param float ttl_secs: Max. age of a cached response, in seconds
+        """
+        self.max_entries = max_entries
+        self.ttl_secs = ttl_secs
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()   # (generation, expiry time, response), keyed by cache key
+        self._generations = itertools.count()
+        self._generation = next(self._generations)
+
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def generation(self):
+        """
+        Get the current cache generation. Should be read before creating a response,
+        and passed to put() along with the response, so that a response created while
+        the cache was being invalidated is never used.
+
+        :return: current cache generation
+        :rtype: int
+        """
+        return self._generation
+
+    def invalidate(self):
+        """
+        Drop all cached responses
+        """
+        with self._lock:
+            self._generation = next(self._generations)
+            self._entries.clear()
+            self._invalidations += 1
+
+    def get(self, key):
+        """
+        Get a cached response
+
+        :param key: cache key
+
+        :return: cached response, or None if there is no valid cached response
+        :rtype: str
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if (entry is None) or (entry[0] != self._generation) or (entry[1] <= now):
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[2]
+
+    def put(self, key, response, generation):
+        """
+        Cache a response. Does nothing if the cache has been invalidated since
+        'generation' was read.
+
+        :param key: cache key
+        :param str response: response to cache
+        :param int generation: value returned by generation() before the response was created
+        """
+        with self._lock:
+            if generation != self._generation:
+                return
+
+            self._entries[key] = (generation, time.monotonic() + self.ttl_secs, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def metrics(self):
+        """
+        Get a snapshot of response cache metrics
+
+        :return: dict of metric values, keyed by metric name
+        :rtype: dict
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate_pct": round((100.0 * self._hits) / lookups, 1) if lookups else 0.0,
+                "invalidations": self._invalidations
+            }
+
+
+class SingleFlight(object):
+    """
+    Tracks commands that are currently running, so that an identical command received
+    while the first one is still running can wait for the first one's response instead
+    of running again.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}   # concurrent.futures.Future for each running command, keyed by key
+        self._started = 0
+        self._shared = 0
+
+    def join(self, key):
+        """
+        Join the running command with the given key, or start a new one
+
+        :param key: key identifying the command
+
+        :return: tuple of the form (future, leader). If leader is True, the caller must\
+            run the command and then call finish() with the result. Otherwise, the caller\
+            should wait for the future, which resolves to the leader's result.
+        :rtype: tuple
+        """
+        with self._lock:
+            future = self._flights.get(key, None)
+            if future is not None:
+                self._shared += 1
+                return future, False
+
+            future = concurrent.futures.Future()
+            self._flights[key] = future
+            self._started += 1
+            return future, True
+
+    def finish(self, key, result=None, exception=None):
+        """
+        Finish a running command, and give its result to all callers waiting for it
+
+        :param key: key identifying the command
+        :param result: command result
+        :param Exception exception: exception raised by the command, if any
+        """
+        with self._lock:
+            future = self._flights.pop(key, None)
+
+        if future is None:
+            return
+
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def metrics(self):
+        """
+        Get a snapshot of single-flight metrics
+
+        :return: dict of metric values, keyed by metric name
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                "running": len(self._flights),
+                "started": self._started,
+                "shared": self._shared
+            }
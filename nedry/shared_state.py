@@ -0,0 +1,102 @@
+# Implements a SharedStateStore class, a small key/value store backed by an SQLite
+# database in WAL mode, which can be used by several bot processes at once.
+
+import json
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Max. time to wait for another process to finish writing, in seconds
+BUSY_TIMEOUT_SECS = 30.0
+
+
+class SharedStateStore(object):
+    """
+    Persistent key/value store shared by all bot worker processes on one host. Values
+    may be anything that can be serialized to JSON.
+
+    The database uses write-ahead logging, so any number of processes can read while
+    one process writes. Each key should only be written by one process (e.g. the process
+    that handles the guild the key belongs to); the store does not merge concurrent
+    changes to the same key.
+    """
+    def __init__(self, filename):
+        """
+        :param str filename: database filename. Created if it does not exist.
+        """
+        self.filename = filename
+        self._lock = threading.Lock()
+
+        # Connection is shared by all threads in this process, access is serialized by self._lock
+        self._conn = sqlite3.connect(filename, timeout=BUSY_TIMEOUT_SECS, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def get(self, key, default=None):
+        """
+        Get the value stored for a key
+
+        :param str key: key to look up
+        :param default: value to return if key does not exist
+
+        :return: stored value
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            return default
+
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        """
+        Store a value for a key, replacing any existing value
+
+        :param str key: key to store value under
+        :param value: value to store
+        """
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        """
+        Store values for multiple keys in a single transaction
+
+        :param dict items: values to store, keyed by key
+        """
+        rows = [(key, json.dumps(value)) for key, value in items.items()]
+        if not rows:
+            return
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", rows)
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+            self._conn.execute("COMMIT")
+
+    def keys(self, prefix=""):
+        """
+        Get all stored keys that start with a prefix
+
+        :param str prefix: key prefix
+
+        :return: list of keys
+        :rtype: list
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT key FROM state").fetchall()
+
+        return [row[0] for row in rows if row[0].startswith(prefix)]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -86,7 +86,19 @@ class TwitchMonitor(object):
 
         return True
 
+    def _sync_usernames(self):
+        # When running as one of several worker processes (see nedry.launcher), streamers
+        # may have been added or removed by another worker, which only changes the config
+        usernames = self.config.config.streamers_to_monitor
+        for name in [n for n in self.usernames if n not in usernames]:
+            del self.usernames[name]
+
+        for name in usernames:
+            if name not in self.usernames:
+                self.usernames[name] = True
+
     def _check_streamers(self):
+        self._sync_usernames()
         channels = self.read_all_streamer_info()
 
         # See if host stream status changed state
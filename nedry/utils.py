@@ -1,5 +1,7 @@
 import random
+import re
 import datetime
+import time
 import zoneinfo
 
 tz_names = zoneinfo.available_timezones()
@@ -16,6 +18,17 @@ FMT_TOK_YEAR = "year"
 
 FMT_TOK_BOT_NAME = "botname"
 
+# Discord rejects messages longer than this
+DISCORD_MESSAGE_MAX = 2000
+
+CODE_FENCE = "```"
+
+# Smallest chunk size that split_message can work with
+MIN_SPLIT_LIMIT = 16
+
+# Matches the language tag on a line that opens a code block, e.g. "```python"
+_code_fence_lang_regex = re.compile(r"^[\w+#.-]{1,32}$")
+
 format_args = {
     FMT_TOK_STREAMER_NAME: None,
     FMT_TOK_STREAM_URL: None,
@@ -181,3 +194,218 @@ def random_line_from_file(filename):
             ch = fh.read(1)
 
         return ret.decode("utf-8")
+
+def percentile(sorted_values, pct):
+    """
+    Get a percentile from a list of values, using the nearest-rank method
+
+    :param list sorted_values: values to get percentile from, sorted in ascending order
+    :param float pct: percentile to get, between 0.0 and 100.0
+
+    :return: percentile value, or None if list is empty
+    """
+    if not sorted_values:
+        return None
+
+    rank = int(round((pct / 100.0) * (len(sorted_values) - 1)))
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter. Holds up to 'capacity' tokens, which are refilled
+    continuously at 'refill_per_sec' tokens per second. Not thread-safe.
+    """
+    def __init__(self, capacity, refill_per_sec):
+        self.capacity = float(capacity)
+        self.refill_per_sec = float(refill_per_sec)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        if elapsed > 0.0:
+            self.tokens = min(self.capacity, self.tokens + (elapsed * self.refill_per_sec))
+            self.last_refill = now
+
+    def time_until_available(self, tokens=1.0, now=None):
+        """
+        Get the time until the requested number of tokens will be available
+
+        :param float tokens: Number of tokens needed
+        :param float now: Current time.monotonic() value, if already known
+
+        :return: Time in seconds, 0.0 if tokens are available now
+        :rtype: float
+        """
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= tokens:
+            return 0.0
+
+        return (tokens - self.tokens) / self.refill_per_sec
+
+    def consume(self, tokens=1.0, now=None):
+        """
+        Take tokens from the bucket, if enough are available
+
+        :param float tokens: Number of tokens to take
+        :param float now: Current time.monotonic() value, if already known
+
+        :return: True if tokens were taken, False if not enough tokens were available
+        :rtype: bool
+        """
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens < tokens:
+            return False
+
+        self.tokens -= tokens
+        return True
+
+
+class _MessageSplitter(object):
+    """
+    Builds message chunks one line at a time, keeping track of whether the current
+    position is inside a code block, so that code blocks which span multiple chunks
+    can be closed at the end of one chunk and re-opened at the start of the next.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.chunks = []
+        self.parts = []
+        self.size = 0
+        self.has_content = False
+
+        # Text that opened the current code block (e.g. "```python"), or None if
+        # not inside a code block
+        self.fence = None
+
+    def _fence_after(self, text, fence, whole_line):
+        # Returns the code block state after 'text', starting with state 'fence'
+        count = text.count(CODE_FENCE)
+        if count == 0:
+            return fence
+
+        if (count % 2) == 0:
+            return fence
+
+        if fence is not None:
+            return None
+
+        # Opening a new code block, remember the language tag if there is one
+        tag = text[text.rfind(CODE_FENCE) + len(CODE_FENCE):]
+        if whole_line and text.strip() == (CODE_FENCE + tag.strip()) and _code_fence_lang_regex.match(tag.strip()):
+            return CODE_FENCE + tag.strip()
+
+        return CODE_FENCE
+
+    def _space_needed(self, text, fence_after):
+        needed = len(text) + (1 if self.parts else 0)
+        if fence_after is not None:
+            # Leave room for closing the code block
+            needed += 1 + len(CODE_FENCE)
+
+        return needed
+
+    def _append(self, text, fence_after):
+        if self.parts:
+            self.size += 1
+
+        self.parts.append(text)
+        self.size += len(text)
+        self.has_content = True
+        self.fence = fence_after
+
+    def flush(self):
+        if not self.has_content:
+            return
+
+        if self.fence is not None:
+            self.parts.append(CODE_FENCE)
+
+        self.chunks.append("\n".join(self.parts))
+
+        if self.fence is None:
+            self.parts = []
+            self.size = 0
+        else:
+            self.parts = [self.fence]
+            self.size = len(self.fence)
+
+        self.has_content = False
+
+    def _cut_point(self, text, max_len):
+        # Find a place to cut 'text' that is at most 'max_len' characters in,
+        # and does not split up a run of backticks
+        cut = max_len
+        while (cut > 0) and (text[cut - 1] == "`") and (text[cut] == "`"):
+            cut -= 1
+
+        return cut if cut > 0 else max_len
+
+    def add_line(self, line):
+        # Fast path for the common case of a line with no code block markers, that
+        # fits in the current chunk
+        if CODE_FENCE not in line:
+            new_size = self.size + len(line) + (1 if self.parts else 0)
+            reserve = 0 if self.fence is None else (1 + len(CODE_FENCE))
+            if (new_size + reserve) <= self.limit:
+                self.parts.append(line)
+                self.size = new_size
+                self.has_content = True
+                return
+
+        fence_after = self._fence_after(line, self.fence, True)
+        if (self.size + self._space_needed(line, fence_after)) <= self.limit:
+            self._append(line, fence_after)
+            return
+
+        self.flush()
+
+        # Line is too long even for an empty chunk, split it up
+        while (self.size + self._space_needed(line, self._fence_after(line, self.fence, True))) > self.limit:
+            # Leave room for closing a code block, in case this piece opens one
+            max_len = self.limit - self.size - (1 if self.parts else 0) - (1 + len(CODE_FENCE))
+            if max_len <= 0:
+                # Language tag on re-opened code block is taking up all the space
+                self.parts = []
+                self.size = 0
+                self.fence = None
+                continue
+
+            cut = self._cut_point(line, max_len)
+            piece = line[:cut]
+            self._append(piece, self._fence_after(piece, self.fence, False))
+            self.flush()
+            line = line[cut:]
+
+        self._append(line, self._fence_after(line, self.fence, True))
+
+    def finish(self):
+        # Don't close a code block that was never closed in the original message
+        self.fence = None
+        self.flush()
+        return self.chunks
+
+
+def split_message(message, limit=DISCORD_MESSAGE_MAX):
+    """
+    Split a message into chunks that are each no longer than 'limit' characters.
+    Chunks are split on line boundaries where possible, and lines longer than the
+    limit are split up. Code blocks that span multiple chunks are closed at the end
+    of each chunk and re-opened at the start of the next. Runs in linear time.
+
+    :param str message: Message to split
+    :param int limit: Max. chunk length. Values larger than the discord message\
+        length limit are capped to the discord limit.
+
+    :return: list of message chunks
+    :rtype: list
+    """
+    if limit < MIN_SPLIT_LIMIT:
+        raise ValueError("Message limit must be at least %d" % MIN_SPLIT_LIMIT)
+
+    splitter = _MessageSplitter(min(limit, DISCORD_MESSAGE_MAX))
+    for line in message.split("\n"):
+        splitter.add_line(line)
+
+    return splitter.finish()
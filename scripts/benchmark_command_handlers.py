@@ -0,0 +1,117 @@
+# Benchmarks regular (sync) command handlers running on the command worker pool,
+# against coroutine (async) command handlers running on the main event loop.
+#
+# Both handlers simulate an I/O-bound command (e.g. !wiki) by waiting for a fixed
+# amount of time; the sync handler blocks a worker thread while it waits, and the
+# async handler yields to the event loop while it waits.
+
+import argparse
+import asyncio
+import os
+import tempfile
+import threading
+import time
+
+from nedry.command_processor import CommandProcessor, main_event_loop
+from nedry.command_executor import CommandExecutor
+from nedry.config import BotConfigManager
+
+
+class FakeUser(object):
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = "user%d" % user_id
+        self.mention = "<@%d>" % user_id
+
+
+class FakeChannel(object):
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+
+def sync_handler(cmd_word, args, message, proc, config, twitch_monitor):
+    time.sleep(proc.io_delay_secs)
+    return "sync response"
+
+
+async def async_handler(cmd_word, args, message, proc, config, twitch_monitor):
+    await asyncio.sleep(proc.io_delay_secs)
+    return "async response"
+
+
+def run_sync(proc, num_commands, num_channels, num_workers):
+    executor = CommandExecutor(num_workers, num_commands)
+    executor.start()
+    done = threading.Semaphore(0)
+
+    def job(channel, author):
+        try:
+            proc.process_command(channel, author, "!synccmd")
+        finally:
+            done.release()
+
+    start = time.perf_counter()
+    for i in range(num_commands):
+        channel = FakeChannel(i % num_channels)
+        executor.submit(channel.id, job, channel, FakeUser(i))
+
+    for _ in range(num_commands):
+        done.acquire()
+
+    elapsed = time.perf_counter() - start
+    executor.stop()
+    return elapsed
+
+
+def run_async(proc, num_commands, num_channels):
+    start = time.perf_counter()
+    futures = []
+    for i in range(num_commands):
+        channel = FakeChannel(i % num_channels)
+        futures.append(proc.process_command(channel, FakeUser(i), "!asynccmd"))
+
+    for fut in futures:
+        fut.result()
+
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sync and async command handler throughput")
+    parser.add_argument('-n', '--num-commands', default=2000, type=int,
+                        help="Number of commands to process (default=%(default)s)")
+    parser.add_argument('-c', '--num-channels', default=50, type=int,
+                        help="Number of discord channels commands are spread across (default=%(default)s)")
+    parser.add_argument('-w', '--workers', default=4, type=int,
+                        help="Number of command worker threads for sync handlers (default=%(default)s)")
+    parser.add_argument('-d', '--delay-ms', default=20.0, type=float,
+                        help="Simulated I/O time per command, in milliseconds (default=%(default)s)")
+    args = parser.parse_args()
+
+    config = BotConfigManager(os.path.join(tempfile.gettempdir(), "nedry_benchmark_config.json"))
+    proc = CommandProcessor(config, None, None, [])
+    proc.io_delay_secs = args.delay_ms / 1000.0
+    proc.add_command("synccmd", sync_handler, False, "")
+    proc.add_command("asynccmd", async_handler, False, "")
+
+    loop_thread = threading.Thread(target=main_event_loop.run_forever)
+    loop_thread.daemon = True
+    loop_thread.start()
+
+    sync_secs = run_sync(proc, args.num_commands, args.num_channels, args.workers)
+    async_secs = run_async(proc, args.num_commands, args.num_channels)
+
+    main_event_loop.call_soon_threadsafe(main_event_loop.stop)
+    loop_thread.join()
+
+    print("%d commands, %d channels, %.1fms simulated I/O per command\n" %
+          (args.num_commands, args.num_channels, args.delay_ms))
+    print("%-32s %10s %14s" % ("", "total (s)", "commands/sec"))
+    print("%-32s %10.3f %14.1f" % ("sync handler (%d workers)" % args.workers,
+                                   sync_secs, args.num_commands / sync_secs))
+    print("%-32s %10.3f %14.1f" % ("async handler (event loop)", async_secs,
+                                   args.num_commands / async_secs))
+
+
+if __name__ == "__main__":
+    main()
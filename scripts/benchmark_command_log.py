@@ -0,0 +1,127 @@
+# Measures how long logging a command takes for the caller (i.e. how long the discord.py
+# event loop would be held up), comparing nedry.command_log.CommandLogWriter against the
+# previous way of writing the command log (buffer 10 lines in memory, then open the log
+# file and append them synchronously). A delay can be added to every write, to simulate
+# a slow or busy disk.
+#
+# Also measures how long it takes to get the last 25 commands from a log with the same
+# number of commands, comparing the index against the previous way (read all lines of
+# the log file), and how long filtered queries take.
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from nedry import utils
+from nedry.command_log import CommandLogWriter, make_record, format_record
+
+NUM_USERS = 200
+COMMAND_WORDS = ["help", "wiki", "trivia", "joke", "quote", "mock", "remind", "timezone", "streamers", "info"]
+
+
+class OldCommandLog(object):
+    def __init__(self, filename, write_delay_secs):
+        self.filename = filename
+        self.write_delay_secs = write_delay_secs
+        self.buf = []
+
+    def write(self, line):
+        self.buf.append(line)
+        if len(self.buf) >= 10:
+            with open(self.filename, 'a') as fh:
+                time.sleep(self.write_delay_secs)
+                fh.write("\n".join(self.buf) + "\n")
+
+            self.buf = []
+
+
+def random_record(i, num_commands):
+    # Spread over the last day
+    timestamp = time.time() - (24 * 60 * 60) + ((24 * 60 * 60 * i) / num_commands)
+    user_id = random.randint(1, NUM_USERS)
+    return make_record(timestamp, user_id, "user%d" % user_id, 2000, 1000, random.choice(COMMAND_WORDS), "arg %d" % i)
+
+
+def measure(log, records, formatted):
+    times = []
+    for i in range(len(records)):
+        start = time.perf_counter()
+        log.write(formatted[i] if formatted else records[i])
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def old_command_history(filename, last):
+    with open(filename, 'r') as fh:
+        lines = [l.strip() for l in fh.readlines()]
+
+    return lines[-last:]
+
+
+def time_query(name, func, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+
+    print("%-36s %10.3fms (%d results)" % (name, ((time.perf_counter() - start) / repeat) * 1000.0, len(result)))
+
+
+def report(name, times):
+    times = sorted(times)
+    print("%-10s avg %8.1fus   p50 %8.1fus   p99 %8.1fus   max %8.1fus" %
+          (name, (sum(times) / len(times)) * 1000000.0, utils.percentile(times, 50) * 1000000.0,
+           utils.percentile(times, 99) * 1000000.0, times[-1] * 1000000.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare command log write latency")
+    parser.add_argument('-n', '--num-commands', default=5000, type=int,
+                        help="Number of commands to log (default=%(default)s)")
+    parser.add_argument('-d', '--write-delay-ms', default=0.0, type=float,
+                        help="Extra delay added to every file write, in milliseconds (default=%(default)s)")
+    args = parser.parse_args()
+
+    random.seed(0)
+    delay_secs = args.write_delay_ms / 1000.0
+    tmpdir = tempfile.mkdtemp()
+
+    records = [random_record(i, args.num_commands) for i in range(args.num_commands)]
+    formatted = [format_record(r) for r in records]
+
+    old_filename = os.path.join(tmpdir, "old_log.txt")
+    old_log = OldCommandLog(old_filename, delay_secs)
+    report("old", measure(old_log, records, formatted))
+
+    new_log = CommandLogWriter(os.path.join(tmpdir, "new_log.txt"), max_bytes=0)
+    new_log.start()
+
+    if delay_secs > 0.0:
+        write_records = new_log._write_records
+        def _slow_write_records(records):
+            time.sleep(delay_secs)
+            write_records(records)
+
+        new_log._write_records = _slow_write_records
+
+    report("new", measure(new_log, records, None))
+
+    start = time.perf_counter()
+    new_log.flush()
+    print("new log writer took %.1fms to write remaining records" % ((time.perf_counter() - start) * 1000.0))
+    print()
+
+    time_query("old: last 25", lambda: old_command_history(old_filename, 25))
+    time_query("new: last 25", lambda: new_log.query(25))
+    time_query("new: last 25, user:7", lambda: new_log.query(25, user_id=7))
+    time_query("new: last 25, cmd:wiki", lambda: new_log.query(25, command="wiki"))
+    time_query("new: last 25, user:7 cmd:wiki", lambda: new_log.query(25, user_id=7, command="wiki"))
+    time_query("new: last 25, user:7 since:1h", lambda: new_log.query(25, user_id=7, since=time.time() - 3600))
+
+    new_log.close(timeout=None)
+
+
+if __name__ == "__main__":
+    main()
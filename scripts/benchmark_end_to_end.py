@@ -0,0 +1,94 @@
+# End-to-end benchmark of the bot with all built-in plugins enabled, using the fake
+# discord client from nedry.fake_discord instead of a real discord connection.
+#
+# Messages mentioning the bot are delivered to the bot's on_message handler from
+# a separate thread, and the time until the bot has sent the whole reply on the same
+# channel is measured for each one. The timer stops once every reply has been sent
+# and the bot's outbound queue is empty.
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from nedry import utils
+from nedry.fake_discord import FakeClient, create_offline_bot
+from nedry.rate_limiter import CommandRateLimiter
+
+
+GUILD_ID = 1000
+CHANNEL_ID_BASE = 2000
+USER_ID_BASE = 100000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure end-to-end command throughput and latency")
+    parser.add_argument('-n', '--num-commands', default=2000, type=int,
+                        help="Number of commands to send (default=%(default)s)")
+    parser.add_argument('-c', '--num-channels', default=50, type=int,
+                        help="Number of discord channels commands are spread across (default=%(default)s)")
+    parser.add_argument('-u', '--num-users', default=200, type=int,
+                        help="Number of discord users sending commands (default=%(default)s)")
+    parser.add_argument('-m', '--message', default="!help",
+                        help="Text to send after the bot mention, must produce a "
+                             "reply (default=%(default)s)")
+    parser.add_argument('-t', '--timeout', default=60.0, type=float,
+                        help="Max. time to wait for all replies, in seconds (default=%(default)s)")
+    args = parser.parse_args()
+
+    client = FakeClient()
+    guild = client.add_guild(GUILD_ID, "benchmark")
+    channels = [client.add_text_channel(guild, CHANNEL_ID_BASE + i, "channel-%d" % i)
+                for i in range(args.num_channels)]
+    users = [client.add_member(guild, USER_ID_BASE + i, "user%d" % i)
+             for i in range(args.num_users)]
+
+    bot = create_offline_bot(os.path.join(tempfile.gettempdir(), "nedry_benchmark_config.json"), client)
+    bot.guild_id = GUILD_ID
+    bot.config.config.discord_channel_name = channels[0].name
+
+    # Simulated users send commands much faster than real users, don't rate limit them
+    bot.cmdprocessor.rate_limiter = CommandRateLimiter()
+
+    bot_thread = threading.Thread(target=bot.run)
+    bot_thread.daemon = True
+    bot_thread.start()
+    bot.guild_available.wait()
+
+    text = "%s %s" % (bot.mention(), args.message)
+    start = time.perf_counter()
+    futures = []
+    for i in range(args.num_commands):
+        futures.append(client.post_message(channels[i % len(channels)], users[i % len(users)], text))
+
+    for fut in futures:
+        fut.result()
+
+    deadline = time.perf_counter() + args.timeout
+    while ((client.pending_mentions() > 0) or (bot.outbound.queue_depth() > 0)) and \
+            (time.perf_counter() < deadline):
+        time.sleep(0.005)
+
+    elapsed = time.perf_counter() - start
+    unanswered = client.pending_mentions()
+
+    bot.plugin_manager.stop()
+    bot.stop()
+    bot_thread.join()
+
+    latencies = sorted(client.latencies())
+    print("%d commands ('%s'), %d channels, %d users\n" %
+          (args.num_commands, args.message, args.num_channels, args.num_users))
+    print("total time:      %.3fs" % elapsed)
+    print("commands/sec:    %.1f" % ((args.num_commands - unanswered) / elapsed))
+    print("unanswered:      %d" % unanswered)
+
+    for pct in [50.0, 90.0, 99.0, 100.0]:
+        value = utils.percentile(latencies, pct)
+        if value is not None:
+            print("p%-5g latency:  %.2fms" % (pct, value * 1000.0))
+
+
+if __name__ == "__main__":
+    main()
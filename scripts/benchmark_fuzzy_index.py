@@ -0,0 +1,113 @@
+# Benchmarks nedry.fuzzy_index.FuzzyIndex against the previous way of suggesting a
+# command for an unrecognized command word (SequenceMatcher against every command
+# word, then sort), with 50, 500 and 5000 registered commands. Also reports how often
+# both give the same suggestion (only suggestions with ratio > 0.5 are shown to users),
+# separately for typos of real commands and for random junk.
+
+import argparse
+import random
+import string
+import time
+from difflib import SequenceMatcher
+
+from nedry.fuzzy_index import FuzzyIndex
+
+COMMAND_COUNTS = [50, 500, 5000]
+
+# Same threshold the command processor uses before suggesting a command
+SUGGEST_RATIO = 0.5
+
+
+def old_nearest_command(cmd_words, unrec_cmd_word):
+    sorted_cmd_words = []
+
+    for cmd_word in cmd_words:
+        ratio = SequenceMatcher(None, cmd_word, unrec_cmd_word).ratio()
+        sorted_cmd_words.append((cmd_word, ratio))
+
+    sorted_cmd_words.sort(reverse=True, key=lambda x: x[1])
+    return sorted_cmd_words[0]
+
+
+def random_command_words(count):
+    words = set()
+    while len(words) < count:
+        length = random.randint(3, 16)
+        words.add("".join([random.choice(string.ascii_lowercase) for _ in range(length)]))
+
+    return list(words)
+
+
+def typo(word):
+    # Mimic a user mistyping a command: drop, swap, repeat or replace one character
+    i = random.randint(0, len(word) - 1)
+    kind = random.randint(0, 3)
+    if kind == 0:
+        return word[:i] + word[i + 1:]
+    elif (kind == 1) and (i < (len(word) - 1)):
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    elif kind == 2:
+        return word[:i] + word[i] + word[i:]
+
+    return word[:i] + random.choice(string.ascii_lowercase) + word[i + 1:]
+
+
+def junk_word():
+    return "".join([random.choice(string.ascii_lowercase) for _ in range(random.randint(3, 16))])
+
+
+def suggestion(result):
+    word, ratio = result
+    return word if ratio > SUGGEST_RATIO else None
+
+
+def agreement(old_results, new_results):
+    agree = sum([suggestion(old_results[i]) == suggestion(new_results[i]) for i in range(len(old_results))])
+    return (100.0 * agree) / len(old_results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare unrecognized command suggestion performance")
+    parser.add_argument('-q', '--queries', default=1000, type=int,
+                        help="Number of unrecognized command words to look up (default=%(default)s)")
+    args = parser.parse_args()
+
+    random.seed(0)
+
+    print("%-10s %14s %14s %10s %12s %12s" % ("commands", "old (us/query)", "new (us/query)", "speedup",
+                                              "typo agree", "junk agree"))
+
+    for count in COMMAND_COUNTS:
+        cmd_words = random_command_words(count)
+
+        # Half are typos of real commands, half are random junk (e.g. spam)
+        typos = [typo(random.choice(cmd_words)) for _ in range(args.queries // 2)]
+        junk = [junk_word() for _ in range(args.queries // 2)]
+        words = typos + junk
+
+        start = time.perf_counter()
+        old_results = [old_nearest_command(cmd_words, w) for w in words]
+        old_elapsed = time.perf_counter() - start
+
+        # Lookup results are cached by the index, time a fresh index for each lookup
+        # (but don't count the time taken to build it)
+        new_results = []
+        new_elapsed = 0.0
+        index = FuzzyIndex(cmd_words)
+        for w in words:
+            index.remove(cmd_words[0])
+            index.add(cmd_words[0])
+            start = time.perf_counter()
+            new_results.append(index.nearest(w))
+            new_elapsed += time.perf_counter() - start
+
+        old_us = (old_elapsed / len(words)) * 1000000.0
+        new_us = (new_elapsed / len(words)) * 1000000.0
+        print("%-10d %14.1f %14.1f %9.1fx %11.1f%% %11.1f%%" %
+              (count, old_us, new_us, old_us / new_us,
+               agreement(old_results[:len(typos)], new_results[:len(typos)]),
+               agreement(old_results[len(typos):], new_results[len(typos):])))
+
+
+if __name__ == "__main__":
+    main()
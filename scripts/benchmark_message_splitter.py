@@ -0,0 +1,136 @@
+# Benchmarks nedry.utils.split_message against the previous message splitter
+# (string concatenation, with a heuristic for tracking code blocks), on large
+# generated messages shaped like the output of commands such as !cmdhistory,
+# !story show and !pluginfo.
+
+import argparse
+import random
+import time
+
+from nedry.utils import split_message
+
+MESSAGE_LIMIT = 1600
+
+WORDS = ["the", "bot", "quickly", "said", "nothing", "about", "dinosaurs", "while",
+         "streaming", "park", "gate", "fence", "ah", "you", "didn't", "magic", "word"]
+
+
+def old_split_message(message, limit):
+    msgs = []
+    code_marker_count = 0
+    current_message = ""
+    inside_code_marker = False
+
+    for line in message.split("\n"):
+        if len(current_message) + len(line) > limit:
+            if (code_marker_count % 6) != 0:
+                inside_code_marker = not inside_code_marker
+
+            code_marker_count = 0
+
+            if inside_code_marker:
+                current_message += '\n```'
+
+            msgs.append(current_message)
+            current_message = "```" + line + '\n'
+            continue
+
+        code_marker_count += line.count('```')
+
+        if current_message == "```":
+            line = line.lstrip()
+
+        current_message += line + "\n"
+
+    if current_message:
+        msgs.append(current_message)
+
+    return msgs
+
+
+def random_words(count):
+    return " ".join([random.choice(WORDS) for _ in range(count)])
+
+
+def cmdhistory_message(size):
+    # One code block containing many short lines
+    lines = []
+    total = 0
+    while total < size:
+        line = "2024-01-01 12:00:00 user%d!%s %s" % (random.randint(0, 999),
+                                                       random.choice(WORDS), random_words(4))
+        lines.append(line)
+        total += len(line) + 1
+
+    return "Last %d commands:\n```\n%s```" % (len(lines), "\n".join(lines))
+
+
+def story_message(size):
+    # Long paragraphs of prose, many lines longer than the message limit
+    paragraphs = []
+    total = 0
+    while total < size:
+        paragraph = random_words(random.randint(50, 800))
+        paragraphs.append(paragraph)
+        total += len(paragraph) + 2
+
+    return "\n\n".join(paragraphs)
+
+
+def pluginfo_message(size):
+    # Many short code blocks, some with a language tag, mixed with text
+    blocks = []
+    total = 0
+    while total < size:
+        lines = [random_words(6) for _ in range(random.randint(1, 20))]
+        if random.random() < 0.5:
+            block = "%s\n```python\n%s\n```" % (random_words(8), "\n".join(lines))
+        else:
+            block = "%s:\n```%s```" % (random_words(3), "\n".join(lines))
+
+        blocks.append(block)
+        total += len(block) + 1
+
+    return "\n".join(blocks)
+
+
+def time_splitter(func, message, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = func(message, MESSAGE_LIMIT)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare message splitter performance on large messages")
+    parser.add_argument('-s', '--size-mb', default=4.0, type=float,
+                        help="Size of each generated message in megabytes (default=%(default)s)")
+    parser.add_argument('-r', '--repeat', default=3, type=int,
+                        help="Number of times to run each splitter, best time is used (default=%(default)s)")
+    args = parser.parse_args()
+
+    random.seed(0)
+    size = int(args.size_mb * 1024 * 1024)
+
+    messages = [
+        ("cmdhistory", cmdhistory_message(size)),
+        ("story show", story_message(size)),
+        ("pluginfo", pluginfo_message(size))
+    ]
+
+    print("%d char message limit, %.1fMB per message\n" % (MESSAGE_LIMIT, args.size_mb))
+    print("%-12s %-10s %10s %8s %12s" % ("message", "splitter", "time (s)", "chunks", "longest"))
+
+    for name, message in messages:
+        for splitter_name, func in [("old", old_split_message), ("new", split_message)]:
+            elapsed, chunks = time_splitter(func, message, args.repeat)
+            print("%-12s %-10s %10.3f %8d %12d" % (name, splitter_name, elapsed, len(chunks),
+                                                   max([len(c) for c in chunks])))
+
+
+if __name__ == "__main__":
+    main()
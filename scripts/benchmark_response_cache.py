@@ -0,0 +1,91 @@
+# Measures how long the bot takes to handle commands whose responses are cached
+# ("help", "plugins", "info"), with and without the response cache, with all built-in
+# plugins enabled and a number of extra commands registered (like a bot with many
+# plugins). Also checks that identical slow commands sent at the same time from
+# several threads only run once.
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from nedry.fake_discord import FakeClient, create_offline_bot
+from nedry.response_cache import ResponseCache
+
+GUILD_ID = 1000
+CHANNEL_ID = 2000
+USER_ID = 100000
+
+EXTRA_HELPTEXT = """
+{0}
+
+Extra command added for benchmarking.
+"""
+
+
+def _extra_command_handler(cmd_word, args, message, proc, config, twitch_monitor):
+    return cmd_word
+
+
+def _slow_command_handler(cmd_word, args, message, proc, config, twitch_monitor):
+    time.sleep(0.2)
+    return "done"
+
+
+def time_commands(proc, channel, user, text, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        proc.process_command(channel, user, text)
+
+    return ((time.perf_counter() - start) / count) * 1000000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure command response cache performance")
+    parser.add_argument('-n', '--num-commands', default=2000, type=int,
+                        help="Number of times to send each command (default=%(default)s)")
+    parser.add_argument('-e', '--extra-commands', default=200, type=int,
+                        help="Number of extra commands to register (default=%(default)s)")
+    args = parser.parse_args()
+
+    client = FakeClient()
+    guild = client.add_guild(GUILD_ID, "benchmark")
+    channel = client.add_text_channel(guild, CHANNEL_ID, "general")
+    user = client.add_member(guild, USER_ID, "user")
+
+    bot = create_offline_bot(os.path.join(tempfile.gettempdir(), "nedry_benchmark_config.json"), client)
+    bot.guild_id = GUILD_ID
+    bot.config.config.discord_admin_users = [USER_ID]
+    proc = bot.cmdprocessor
+
+    for i in range(args.extra_commands):
+        proc.add_command("extra%d" % i, _extra_command_handler, False, EXTRA_HELPTEXT)
+
+    print("%-12s %16s %16s %10s" % ("command", "uncached (us)", "cached (us)", "speedup"))
+    for text in ["!help", "!plugins", "!info"]:
+        # A cache that never keeps anything
+        proc.response_cache = ResponseCache(max_entries=0)
+        uncached = time_commands(proc, channel, user, text, args.num_commands)
+
+        proc.response_cache = ResponseCache()
+        cached = time_commands(proc, channel, user, text, args.num_commands)
+        print("%-12s %16.1f %16.1f %9.1fx" % (text, uncached, cached, uncached / cached))
+
+    proc.add_command("slow", _slow_command_handler, False, EXTRA_HELPTEXT, single_flight=True)
+    threads = [threading.Thread(target=proc.process_command, args=(channel, user, "!slow")) for _ in range(10)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print("\n10 identical 200ms commands at once took %.0fms, single flight metrics: %s" %
+          ((time.perf_counter() - start) * 1000.0, proc.single_flight.metrics()))
+
+    bot.plugin_manager.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -12,7 +12,10 @@ OUTPUT_FILE = "bot_command_reference.txt"
 CMD_TITLE_UNDERLINE_CHAR = '-'
 
 with mock.patch('nedry.discord_bot.discord') as mock_discord:
-    bot = DiscordBot(mock.MagicMock(), mock.MagicMock())
+    # No command log file, otherwise the mock file name is opened as a file descriptor
+    config = mock.MagicMock()
+    config.config.command_log_file = None
+    bot = DiscordBot(config, mock.MagicMock())
     plugin_manager = PluginModuleManager(bot, [])
 
     # Load built-in plugins